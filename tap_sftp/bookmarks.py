@@ -0,0 +1,55 @@
+import pytz  # type: ignore
+import singer  # type: ignore
+from singer import utils  # type: ignore
+
+
+def last_modified(f):
+    """ A file's last_modified in UTC; listings are UTC already, a naive datetime is taken to be UTC. """
+    modified = f['last_modified']
+    return modified if modified.tzinfo else modified.replace(tzinfo=pytz.UTC)
+
+
+def fingerprint(f):
+    """ A file as (path, size, mtime), enough to tell a rewritten file from the one already synced. """
+    return [f['filepath'], f.get('file_size'), last_modified(f).timestamp()]
+
+
+def get_bookmark(state, table_name):
+    """
+    Returns the bookmark of a table: the latest `last_modified` synced and the fingerprints of the files synced at
+    exactly that time. Older files are not fingerprinted, anything before the bookmark counts as synced.
+    """
+    bookmark = singer.get_bookmark(state or {}, table_name, 'last_modified')
+    if bookmark is None:
+        return None
+    return {
+        'last_modified': utils.strptime_to_utc(bookmark),
+        'fingerprints': {tuple(fp) for fp in singer.get_bookmark(state, table_name, 'fingerprints', [])}
+    }
+
+
+def is_new(bookmark, f):
+    """ Whether a file was added or changed since the bookmark. """
+    if bookmark is None or last_modified(f) > bookmark['last_modified']:
+        return True
+    return last_modified(f) == bookmark['last_modified'] and tuple(fingerprint(f)) not in bookmark['fingerprints']
+
+
+def write_file_bookmark(state, table_name, f):
+    """
+    Moves the table's bookmark up to a file that finished syncing and emits the state. Files are synced oldest first,
+    so the bookmark only ever moves forward.
+    """
+    bookmark = get_bookmark(state, table_name)
+    modified = last_modified(f)
+    if bookmark is None or modified > bookmark['last_modified']:
+        fingerprints = []
+    else:
+        fingerprints = [list(fp) for fp in singer.get_bookmark(state, table_name, 'fingerprints', [])
+                        if fp[0] != f['filepath']]
+
+    if bookmark is None or modified >= bookmark['last_modified']:
+        state = singer.write_bookmark(state, table_name, 'last_modified', utils.strftime(modified))
+        state = singer.write_bookmark(state, table_name, 'fingerprints', fingerprints + [fingerprint(f)])
+    singer.write_state(state)
+    return state
@@ -1,32 +1,56 @@
 import logging
 import os
-import re
 import stat
 import tempfile
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
-import backoff  # type: ignore
 import paramiko  # type: ignore
 import pytz  # type: ignore
 import singer  # type: ignore
-from paramiko.ssh_exception import AuthenticationException, SSHException  # type: ignore
-from file_processors.utils import decrypt, find_encoding  # type: ignore
+from paramiko.ssh_exception import ChannelException, SSHException  # type: ignore
+from file_processors.utils import decrypt  # type: ignore
 from file_processors.utils.symon_exception import SymonException # type: ignore
-from tap_sftp import helper
+from tap_sftp import bookmarks, defaults, encoding_detection, excel_sample, helper, listing_index, matching, \
+    profiling, streaming, transfer
+from tap_sftp.connector import Connector, breaker_for
+from tap_sftp.listing_cache import ListingCache
 
 LOGGER = singer.get_logger()
 logging.getLogger("paramiko").setLevel(logging.CRITICAL)
 
+# Payloads that zlib transport compression cannot shrink
+INCOMPRESSIBLE_EXTENSIONS = ['.gz', '.gzip', '.zip', '.bz2', '.xz', '.7z', '.tgz', '.xlsx', '.gpg', '.pgp']
 
-def handle_backoff(details):
-    LOGGER.warn(
-        "SSH Connection closed unexpectedly. Waiting {wait} seconds and retrying...".format(
-            **details)
-    )
+
+def prefer_algorithms(preferred, available, kind):
+    """ Orders the available algorithms so the supported preferred ones come first, in the order given. """
+    unsupported = [name for name in preferred if name not in available]
+    if unsupported:
+        LOGGER.warning('Ignoring unsupported SSH %s: %s', kind, ', '.join(unsupported))
+    first = [name for name in preferred if name in available]
+    return tuple(first + [name for name in available if name not in first])
+
+
+def is_incompressible(file_path):
+    return os.path.splitext(file_path)[1].lower() in INCOMPRESSIBLE_EXTENSIONS
+
+
+def mtime_of(f):
+    last_modified = f.get("last_modified")
+    return int(last_modified.timestamp()) if last_modified else None
 
 
 class SFTPConnection():
-    def __init__(self, host, username, password=None, private_key_file=None, port=None):
+    def __init__(self, host, username, password=None, private_key_file=None, port=None, list_concurrency=None,
+                 max_sessions=None, download_concurrency=None, download_segment_size=None, compression='auto',
+                 preferred_ciphers=None, preferred_macs=None, listing_index=None, encoding_cache=None,
+                 connect_timeout=None, banner_timeout=None, auth_timeout=None, connect_deadline=None,
+                 connect_retries=None, circuit_breaker_threshold=None, circuit_breaker_reset=None,
+                 progress_interval=None, stall_timeout=None, abort_stalled_transfers=False,
+                 stat_literal_patterns=True, listing_cache=None):
         self.host = host
         self.username = username
         self.password = password
@@ -34,27 +58,49 @@ class SFTPConnection():
         self.decrypted_file = None
         self.key = None
         self.transport = None
-        self.retries = 5
+        # connects are retried up to defaults.CONNECT_ATTEMPTS - 1 times unless connect_retries is configured
+        self.retries = None if connect_retries is None else int(connect_retries)
+        self.connect_timeout = connect_timeout
+        self.banner_timeout = banner_timeout
+        self.auth_timeout = auth_timeout
+        self.connect_deadline = connect_deadline
+        self.circuit_breaker_threshold = circuit_breaker_threshold
+        self.circuit_breaker_reset = circuit_breaker_reset
+        self.progress_interval = progress_interval
+        self.stall_timeout = stall_timeout
+        self.abort_stalled_transfers = abort_stalled_transfers
+        self.stat_literal_patterns = stat_literal_patterns
+        self.listing_cache = listing_cache
+        self.list_concurrency = max(int(list_concurrency or defaults.LIST_CONCURRENCY), 1)
+        self.max_sessions = max(int(max_sessions or defaults.MAX_SESSIONS), 1)
+        self.download_concurrency = max(int(download_concurrency or defaults.DOWNLOAD_CONCURRENCY), 1)
+        self.download_segment_size = int(download_segment_size or defaults.DOWNLOAD_SEGMENT_SIZE)
+        # True or False force transport compression; 'auto' compresses listings and text but moves large
+        # already-compressed payloads to a separate uncompressed transport
+        self.compression = compression
+        self.preferred_ciphers = preferred_ciphers
+        self.preferred_macs = preferred_macs
+        self.listing_index = listing_index
+        self.encoding_cache = encoding_cache
         self.__sftp = None
+        self.__sessions = None
+        self.__uncompressed = None
         if private_key_file:
             key_path = os.path.expanduser(private_key_file)
             self.key = paramiko.RSAKey.from_private_key_file(key_path)
 
-    # If connection is snapped during connect flow, retry up to a
-    # minute for SSH connection to succeed. 2^6 + 2^5 + ...
-    @backoff.on_exception(
-        backoff.expo,
-        (EOFError),
-        max_tries=6,
-        on_backoff=handle_backoff,
-        jitter=None,
-        factor=2)
     def __connect(self):
-        for i in range(self.retries + 1):
+        connector = Connector(self.host, self.port, self.connect_timeout, self.banner_timeout, self.auth_timeout,
+                              self.connect_deadline, None if self.retries is None else self.retries + 1,
+                              breaker_for(self.host, self.port, self.circuit_breaker_threshold,
+                                          self.circuit_breaker_reset))
+
+        def establish(sock):
             try:
-                LOGGER.info('Creating new connection to SFTP...')
-                self.transport = paramiko.Transport((self.host, self.port))
-                self.transport.use_compression(True)
+                self.transport = paramiko.Transport(sock)
+                connector.apply_timeouts(self.transport)
+                self.transport.use_compression(self.compression is not False)
+                self.apply_security_options()
                 self.transport.default_window_size = paramiko.common.MAX_WINDOW_SIZE
                 self.transport.packetizer.REKEY_BYTES = pow(2, 40)
                 self.transport.packetizer.REKEY_PACKETS = pow(2, 40)
@@ -62,20 +108,18 @@ class SFTPConnection():
                     username=self.username, password=self.password, hostkey=None, pkey=self.key)
                 self.__sftp = paramiko.SFTPClient.from_transport(
                     self.transport)
-
-                LOGGER.info('Connection successful')
-                break
-            except (AuthenticationException, SSHException) as ex:
+            except BaseException:
                 if self.__sftp:
                     self.__sftp.close()
+                    self.__sftp = None
                 if self.transport:
                     self.transport.close()
-                time.sleep(5)
-                LOGGER.info('Connection failed, retrying...')
-                if i >= (self.retries):
-                    if isinstance(ex, AuthenticationException):
-                        raise SymonException('Authentication failed. Please check your credentials and SFTP server availability.','sftp.AuthenticationError')
-                    raise SymonException('Failed to connect to SFTP server. Please check your port configuration and connectivity to your SFTP server.', 'sftp.ServerError')
+                    self.transport = None
+                sock.close()
+                raise
+
+        with profiling.timer('connect'):
+            connector.connect(establish)
 
     @property
     def sftp(self):
@@ -87,14 +131,73 @@ class SFTPConnection():
     def sftp(self, sftp):
         self.__sftp = sftp
 
+    @property
+    def sessions(self):
+        """ Multiplexer handing out SFTP sessions that share this connection's authenticated transport. """
+        if self.__sessions is None:
+            sftp = self.sftp
+            self.__sessions = SFTPSessionMultiplexer(
+                self.transport, sftp, self.max_sessions)
+        return self.__sessions
+
+    def apply_security_options(self):
+        options = self.transport.get_security_options()
+        if self.preferred_ciphers:
+            options.ciphers = prefer_algorithms(
+                self.preferred_ciphers, options.ciphers, 'ciphers')
+        if self.preferred_macs:
+            options.digests = prefer_algorithms(
+                self.preferred_macs, options.digests, 'MACs')
+
+    def transfer_connection(self, f):
+        """
+        Returns the connection to transfer the file dict f over. With compression set to 'auto', large files that
+        are already compressed or encrypted go over a second, uncompressed transport to the same server, opened on
+        first use, so their bytes are not run through zlib on both ends.
+        """
+        if self.compression != 'auto' or not is_incompressible(f["filepath"]) or \
+                (f.get("file_size") or 0) < defaults.UNCOMPRESSED_TRANSFER_MIN_BYTES:
+            return self
+        if self.__uncompressed is None:
+            self.__uncompressed = SFTPConnection(self.host, self.username, password=self.password, port=self.port,
+                                                 list_concurrency=self.list_concurrency,
+                                                 max_sessions=self.max_sessions,
+                                                 download_concurrency=self.download_concurrency,
+                                                 download_segment_size=self.download_segment_size,
+                                                 compression=False, preferred_ciphers=self.preferred_ciphers,
+                                                 preferred_macs=self.preferred_macs,
+                                                 listing_index=self.listing_index,
+                                                 connect_timeout=self.connect_timeout,
+                                                 banner_timeout=self.banner_timeout,
+                                                 auth_timeout=self.auth_timeout,
+                                                 connect_deadline=self.connect_deadline,
+                                                 connect_retries=self.retries,
+                                                 circuit_breaker_threshold=self.circuit_breaker_threshold,
+                                                 circuit_breaker_reset=self.circuit_breaker_reset,
+                                                 progress_interval=self.progress_interval,
+                                                 stall_timeout=self.stall_timeout,
+                                                 abort_stalled_transfers=self.abort_stalled_transfers)
+            self.__uncompressed.key = self.key
+        return self.__uncompressed
+
     def close(self):
-        self.__sftp.close()
-        self.transport.close()
+        if self.encoding_cache:
+            self.encoding_cache.save()
+        if self.__uncompressed:
+            self.__uncompressed.close()
+            self.__uncompressed = None
+        if self.__sessions:
+            self.__sessions.close()
+            self.__sessions = None
+        if self.__sftp:
+            self.__sftp.close()
+        if self.transport:
+            self.transport.close()
 
     def match_files_for_table(self, files, table_name, search_pattern):
         LOGGER.info("Searching for files for table '%s', matching pattern: %s",
                     table_name, search_pattern)
-        matcher = re.compile(search_pattern)
+        matcher = matching.compile_pattern(search_pattern)
         return [f for f in files if matcher.search(f["filepath"])]
 
     def is_empty(self, file_attr):
@@ -109,71 +212,373 @@ class SFTPConnection():
 
         Returns a list of filepaths from the root.
         """
-        files = []
+        with profiling.timer('list'):
+            return list(self.iter_files_by_prefix(prefix, search_subdirectories))
 
+    def iter_files_by_prefix(self, prefix, search_subdirectories=True, filename_filter=None):
+        """
+        Lazily walks "prefix" and yields a file dict for each file as soon as its directory has been listed. If
+        `filename_filter` is given, it is called with each file name and files it rejects are skipped before a dict
+        is built for them.
+
+        Subdirectories are walked breadth-first, with up to `list_concurrency` directory listings in flight at a time,
+        each on its own SFTP session. Files are ordered level by level, then by directory and listing order, so the
+        result is the same whatever the concurrency. Only a bounded batch of listings is held at once, so memory does
+        not grow with the size of the tree.
+        """
         if prefix is None or prefix == '':
             prefix = '.'
 
         try:
-            result = self.sftp.listdir_attr(prefix)
+            with ThreadPoolExecutor(max_workers=self.list_concurrency) as executor:
+                directories = [prefix]
+                while directories:
+                    subdirectories = []
+                    for directory, result in self.list_directories(directories, executor):
+                        for file_attr in result:
+                            if self.is_directory(file_attr) and search_subdirectories:
+                                subdirectories.append(
+                                    directory + '/' + file_attr.filename)
+                            elif filename_filter is None or filename_filter(file_attr.filename):
+                                yield self.to_file_dict(directory, file_attr)
+                    directories = subdirectories
+        finally:
+            if self.listing_index is not None:
+                self.listing_index.save()
+
+    def list_directories(self, directories, executor):
+        """
+        Lists the given directories concurrently and yields (directory, listing) pairs in the order given. Directories
+        are listed in batches of a few per session, and each worker checks a session out of the multiplexer so no
+        session runs two requests at once.
+        """
+        if len(directories) == 1 or self.list_concurrency == 1:
+            for directory in directories:
+                yield directory, self.listdir_attr(self.sftp, directory)
+            return
+
+        def list_directory(directory):
+            with self.sessions.checkout() as session:
+                return directory, self.listdir_attr(session, directory)
+
+        batch_size = self.list_concurrency * defaults.LIST_BATCH_FACTOR
+        for i in range(0, len(directories), batch_size):
+            yield from executor.map(list_directory, directories[i:i + batch_size])
+
+    def listdir_attr(self, session, directory):
+        """
+        Lists a directory. With a listing index, the directory is stat'ed first and served from the index when its
+        mtime has not changed since it was last listed.
+        """
+        try:
+            if self.listing_index is None:
+                return session.listdir_attr(directory)
+
+            key = listing_index.index_key(self.host, self.port, directory)
+            mtime = session.stat(directory).st_mtime
+            listing = self.listing_index.get(key, mtime)
+            if listing is None:
+                listed_at = time.time()
+                listing = session.listdir_attr(directory)
+                self.listing_index.put(key, mtime, listing, listed_at)
+            return listing
         except FileNotFoundError as e:
             raise Exception(
-                "Directory '{}' does not exist".format(prefix)) from e
+                "Directory '{}' does not exist".format(directory)) from e
+
+    def to_file_dict(self, directory, file_attr):
+        last_modified = file_attr.st_mtime
+        if last_modified is None:
+            LOGGER.warning("Cannot read m_time for file %s, defaulting to current epoch time",
+                           os.path.join(directory, file_attr.filename))
+            last_modified = datetime.utcnow().timestamp()
+
+        # NB: SFTP specifies path characters to be '/'
+        #     https://tools.ietf.org/html/draft-ietf-secsh-filexfer-13#section-6
+        return {"filepath": directory + '/' + file_attr.filename,
+                "last_modified": datetime.utcfromtimestamp(last_modified).replace(tzinfo=pytz.UTC),
+                "file_size": file_attr.st_size}
+
+    def stat_file(self, prefix, filename):
+        """
+        Returns the file dict of "prefix/filename" from a single stat, or None when it is missing, a directory or can't
+        be stat'ed.
+        """
+        directory = prefix if prefix else '.'
+        try:
+            file_attr = self.sftp.stat(f'{directory}/{filename}')
+        except IOError as ex:
+            LOGGER.info('Could not stat "%s/%s": %s', directory, filename, ex)
+            return None
+        if file_attr.st_mode is not None and self.is_directory(file_attr):
+            return None
+        file_attr.filename = filename
+        return self.to_file_dict(directory, file_attr)
+
+    def literal_filename(self, search_pattern):
+        """ The file name an escaped filename pattern matches, when it is looked up with a stat rather than a walk. """
+        literal = matching.literal_of(search_pattern) if self.stat_literal_patterns else None
+        return literal if literal and '/' not in literal else None
+
+    def walk_matching(self, prefix, search_subdirectories, search_pattern):
+        """
+        Walks prefix once and returns the number of files seen and the files whose name matches search_pattern. With a
+        listing cache, the files matching the patterns of the other tables under the same prefix are sorted out of the
+        same walk and kept for them.
+        """
+        search_patterns = [search_pattern]
+        if self.listing_cache is not None:
+            search_patterns += [pattern for pattern in
+                                self.listing_cache.expected_patterns(prefix, search_subdirectories)
+                                if not self.literal_filename(pattern)]
+        matcher = matching.FilenameMatcher(search_patterns)
+        files_by_pattern = {pattern: [] for pattern in search_patterns}
+
+        # files are matched as the listing streams in, so only matching files are ever kept
+        file_count = 0
+
+        def matches(filename):
+            nonlocal file_count
+            file_count += 1
+            return bool(matcher.match(filename))
+
+        for f in self.iter_files_by_prefix(prefix, search_subdirectories, matches):
+            for pattern in matcher.match(f['filepath'].rsplit('/', 1)[-1]):
+                files_by_pattern[pattern].append(f)
+
+        if self.listing_cache is not None:
+            self.listing_cache.store(prefix, search_subdirectories, file_count, files_by_pattern)
+        return file_count, files_by_pattern[search_pattern]
+
+    def get_files(self, prefix, search_pattern, modified_since=None, search_subdirectories=True, bookmark=None):
+        """ Returns the files matching the pattern, leaving out the files already synced up to the table's bookmark. """
+        # for Symon import, we only import one file. search_pattern is escaped filename, force to match one file.
+        LOGGER.info(f"Searching for files for matching pattern: ^{search_pattern}$")
 
-        for file_attr in result:
-            # NB: This only looks at the immediate level beneath the prefix directory
-            if self.is_directory(file_attr) and search_subdirectories:
-                files += self.get_files_by_prefix(prefix +
-                                                  '/' + file_attr.filename)
+        matching_count = 0
+        empty_file_count = 0
+        unchanged_count = 0
+        matching_files = []
+        with profiling.timer('list'):
+            # an escaped filename matches a single name, so it is stat'ed instead of listing the whole prefix; files of
+            # that name in subdirectories are only found by the listing, if the stat finds nothing
+            literal = self.literal_filename(search_pattern)
+            found = self.stat_file(prefix, literal) if literal else None
+            cached = None
+            if found is None and self.listing_cache is not None:
+                cached = self.listing_cache.lookup(prefix, search_subdirectories, search_pattern)
+            if found is not None:
+                LOGGER.info('Found "%s" without listing "%s"', found['filepath'], prefix)
+                file_count, files = 1, [found]
+            elif cached is not None:
+                LOGGER.info('Reusing the listing of "%s"', prefix)
+                file_count, files = cached
             else:
-                last_modified = file_attr.st_mtime
-                if last_modified is None:
-                    LOGGER.warning("Cannot read m_time for file %s, defaulting to current epoch time",
-                                   os.path.join(prefix, file_attr.filename))
-                    last_modified = datetime.utcnow().timestamp()
-
-                # NB: SFTP specifies path characters to be '/'
-                #     https://tools.ietf.org/html/draft-ietf-secsh-filexfer-13#section-6
-                files.append({"filepath": prefix + '/' + file_attr.filename,
-                              "last_modified": datetime.utcfromtimestamp(last_modified).replace(tzinfo=pytz.UTC),
-                              "file_size": file_attr.st_size})
-
-        return files
-
-    def get_files(self, prefix, search_pattern, modified_since=None, search_subdirectories=True):
-        files = self.get_files_by_prefix(prefix, search_subdirectories)
-        if files:
-            LOGGER.info('Found %s files in "%s"', len(files), prefix)
+                file_count, files = self.walk_matching(prefix, search_subdirectories, search_pattern)
+
+            for f in files:
+                matching_count += 1
+                if self.is_empty(f):
+                    empty_file_count += 1
+                LOGGER.info("Found file: %s", f['filepath'])
+
+                if modified_since is not None and f["last_modified"] <= modified_since:
+                    continue
+                if bookmarks.is_new(bookmark, f):
+                    matching_files.append(f)
+                else:
+                    unchanged_count += 1
+
+        if file_count:
+            LOGGER.info('Found %s files in "%s"', file_count, prefix)
         else:
             LOGGER.warning(
                 'Found no files on specified SFTP server at "%s"', prefix)
 
-        # for Symon import, we only import one file. search_pattern is escaped filename, force to match one file.
-        matching_files = self.get_files_matching_pattern(
-            files, f'^{search_pattern}$')
-
-        if matching_files:
+        if matching_count:
             LOGGER.info('Found %s files in "%s" matching "%s"',
-                        len(matching_files), prefix, search_pattern)
+                        matching_count, prefix, search_pattern)
         else:
             # rather than returning None, we throw error instead so we can catch it
             raise SymonException(f'Sorry, we couldn\'t find any files on specified SFTP server at "{prefix}/{search_pattern}"', 'sftp.FileNotFoundError')
 
-        empty_file_count = 0
-        for f in matching_files:
-            if self.is_empty(f):
-                empty_file_count += 1
-            LOGGER.info("Found file: %s", f['filepath'])
-
-        if empty_file_count == len(matching_files):
+        if empty_file_count == matching_count:
             raise SymonException('File is empty.', 'EmptyFile')
 
-        if modified_since is not None:
-            matching_files = [
-                f for f in matching_files if f["last_modified"] > modified_since]
+        if unchanged_count:
+            LOGGER.info('Skipping %s files unchanged since the last sync', unchanged_count)
 
         return matching_files
 
+    def download(self, f, local_path, callback=None):
+        """
+        Downloads the file dict {"filepath": "...", "file_size": ...} to local_path. Files larger than one segment are
+        split into byte ranges fetched concurrently over several sessions; the result is identical to `sftp.get`.
+        With a `callback(bytes_written, file_size)` the file is downloaded front to back instead.
+
+        Every attempt stats the file first, so a file that changed since it was listed is downloaded at its current
+        size. If the connection drops, the partial local file is kept and the download continues from the bytes
+        already written over a new connection, as long as the remote file's size and mtime have not changed; a file
+        that changed is downloaded again from the start. With a callback, the bytes it was told about may already be
+        consumed, so a file that changed raises FileChangedError instead.
+        """
+        conn = self.transfer_connection(f)
+        remote_path = f["filepath"]
+        downloader = None
+        expected = None
+        with profiling.timer('download', remote_path, f.get("file_size")) as measurement, \
+                conn.transfer_progress(remote_path, f.get("file_size")) as progress:
+            resume = False
+            for attempt in range(defaults.DOWNLOAD_RESUME_ATTEMPTS + 1):
+                try:
+                    # the listing may be older than the file, so every attempt is sized from a fresh stat
+                    attr = conn.sftp.stat(remote_path)
+                    if resume and (attr.st_size, attr.st_mtime) != expected:
+                        raise transfer.FileChangedError(f'File "{remote_path}" changed while it was downloaded')
+                    if not resume:
+                        file_size = attr.st_size
+                        expected = (attr.st_size, attr.st_mtime)
+                        measurement['transferred'] = progress.total = file_size
+                        downloader = conn.downloader_for(file_size, callback)
+                        downloader.transfer_progress = progress
+                    if isinstance(downloader, transfer.SegmentedDownloader):
+                        downloader.sessions = conn.sessions
+                        downloader.download(remote_path, local_path, file_size, resume)
+                    else:
+                        downloader.download(conn.sftp, remote_path, local_path, file_size, resume)
+                    return
+                except transfer.FileChangedError as ex:
+                    if callback is not None or attempt >= defaults.DOWNLOAD_RESUME_ATTEMPTS:
+                        raise
+                    LOGGER.warning('%s, downloading it again', ex)
+                    resume = False
+                except Exception as ex:
+                    if progress.aborted or attempt >= defaults.DOWNLOAD_RESUME_ATTEMPTS or \
+                            not (isinstance(ex, transfer.RESUMABLE_ERRORS) or conn.is_dropped()):
+                        raise
+                    LOGGER.warning('Connection dropped while downloading "%s" (%s), reconnecting to resume it',
+                                   remote_path, ex)
+                    conn.reconnect()
+                    time.sleep(defaults.DOWNLOAD_RESUME_WAIT * 2 ** attempt)
+                    resume = True
+
+    def downloader_for(self, file_size, callback=None):
+        """ Returns a downloader for a file of file_size bytes over this connection. """
+        if callback is None and self.download_concurrency > 1 and file_size > self.download_segment_size:
+            return transfer.SegmentedDownloader(self.sessions, self.download_concurrency, self.download_segment_size)
+        return transfer.SequentialDownloader(callback=callback)
+
+    def transfer_progress(self, label, total=None):
+        """ Returns a TransferProgress for a transfer over this connection, which a stall aborts by closing it. """
+        return transfer.TransferProgress(label, total, self.progress_interval, self.stall_timeout,
+                                         self.abort_stalled_transfers, abort=self.abort_transfers)
+
+    def abort_transfers(self):
+        """ Closes the transport, so reads blocked on it fail; the next use of the connection connects again. """
+        if self.transport is not None:
+            self.transport.close()
+
+    def is_dropped(self):
+        return self.transport is not None and not self.transport.is_active()
+
+    def reconnect(self):
+        """ Drops the transport and its sessions; the next use of `sftp` or `sessions` connects again. """
+        for closeable in [self.__sessions, self.__sftp, self.transport]:
+            try:
+                if closeable:
+                    closeable.close()
+            except Exception as ex:
+                LOGGER.warning('Failed to close dropped SFTP connection: %s', ex)
+        self.__sessions = None
+        self.__sftp = None
+        self.transport = None
+
+    def detect_encoding(self, f, read_leading_bytes):
+        """ Returns the cached encoding of the file dict's file, or detects it from its leading bytes, read through
+            `read_leading_bytes(size)`, and caches it. """
+        key = encoding_detection.cache_key(self.host, self.port, f)
+        enc = self.encoding_cache.get(key) if self.encoding_cache else None
+        if enc is None:
+            with profiling.timer('encoding', f['filepath']):
+                enc = encoding_detection.detect_encoding(read_leading_bytes)
+            if self.encoding_cache:
+                self.encoding_cache.put(key, enc)
+        return enc
+
+    @contextmanager
+    def following_download(self, f, local_path):
+        """
+        Downloads the file dict's file to local_path in a background thread and yields a reader of the local file
+        that follows the download, so the file can be consumed while it is still arriving.
+
+        The download is not restarted under the reader when the remote file changes, as the bytes already read are of
+        the old version: the reader fails and FileChangedError is raised for the caller to start over. A consumer
+        that stops reading cancels the rest of the download.
+        """
+        open(local_path, 'wb').close()
+        reader = transfer.FollowingFileReader(local_path)
+        errors = []
+
+        def download():
+            try:
+                self.download(f, local_path, callback=reader.progress)
+            except Exception as ex:
+                errors.append(ex)
+                reader.finish(ex)
+            else:
+                reader.finish()
+
+        thread = threading.Thread(target=download, daemon=True)
+        thread.start()
+        try:
+            with reader:
+                yield reader
+        except BaseException as ex:
+            # the closed reader cancels the download at its next chunk
+            thread.join()
+            if errors and isinstance(errors[0], transfer.FileChangedError):
+                raise errors[0] from ex
+            raise
+        thread.join()
+        # a consumer such as gpg may end without surfacing the read error of a failed download
+        if errors and not isinstance(errors[0], transfer.TransferCancelledError):
+            raise errors[0]
+
+    def decrypt_following_download(self, f, local_path, decrypted_path, decryption_configs):
+        """ Decrypts the file dict's file with gpg while it downloads to local_path, starting over if it changes. """
+        for attempt in range(defaults.DOWNLOAD_RESUME_ATTEMPTS + 1):
+            try:
+                with self.following_download(f, local_path) as src_file_object:
+                    return decrypt.gpg_decrypt_to_file(src_file_object,
+                                                       decryption_configs.get('key'),
+                                                       decryption_configs.get('gnupghome'),
+                                                       decryption_configs.get('passphrase'),
+                                                       decrypted_path,
+                                                       None,
+                                                       decryption_configs.get('sign_key', None))
+            except transfer.FileChangedError as ex:
+                if attempt >= defaults.DOWNLOAD_RESUME_ATTEMPTS:
+                    raise
+                LOGGER.warning('%s, decrypting it again', ex)
+                if os.path.exists(decrypted_path):
+                    os.remove(decrypted_path)
+
+    def open_stream(self, f, encoding, skip_footer_row=0, on_close=None):
+        """
+        Takes a file dict {"filepath": "...", "last_modified": "..."} for a plain csv/text/fwf file and returns a text
+        handle that reads it straight from the server through a bounded read-ahead buffer, without staging it on local
+        disk. The encoding, when not configured, is detected from the leading bytes.
+        """
+        sftp_file_path = f["filepath"]
+        LOGGER.info(f'Streaming file: {sftp_file_path}')
+        reader = streaming.ReadAheadReader(self.sftp.open(sftp_file_path, 'rb'))
+        try:
+            enc = encoding or self.detect_encoding(f, reader.peek)
+            return streaming.TextStream(reader, enc, sftp_file_path, skip_footer_row, on_close)
+        except BaseException:
+            reader.close()
+            raise
+
     def get_file_handle(self, f, file_type, encoding, decryption_configs=None):
         """ Takes a file dict {"filepath": "...", "last_modified": "..."} and returns a handle to the file. """
         enc = encoding
@@ -186,37 +591,38 @@ class SFTPConnection():
                 sftp_file_name = os.path.basename(sftp_file_path)
                 original_file_name = os.path.splitext(sftp_file_name)[0]
 
-                if not decrypt_remote:
-                    self.sftp.get(sftp_file_path, local_path)
-                    with open(local_path, 'rb') as src_file_object:
-                        decrypt_path = decrypt.gpg_decrypt_to_file(src_file_object,
-                                                                   decryption_configs.get(
-                                                                       'key'),
-                                                                   decryption_configs.get(
-                                                                       'gnupghome'),
-                                                                   decryption_configs.get(
-                                                                       'passphrase'),
-                                                                   f'{tmp_dir_name}/{original_file_name}',
-                                                                   None,
-                                                                   decryption_configs.get('sign_key', None)
-                                                                   )
-                else:
-                    with self.sftp.open(sftp_file_path, 'rb', 32768) as src_file_object:
-                        src_file_object.prefetch()
-                        decrypt_path = helper.load_file_decrypted(src_file_object,
-                                                                  decryption_configs.get(
-                                                                      'key'),
-                                                                  decryption_configs.get(
-                                                                      'gnupghome'),
-                                                                  decryption_configs.get(
-                                                                      'passphrase'),
-                                                                  f'{tmp_dir_name}/{original_file_name}',
-                                                                  None,
-                                                                  decryption_configs.get('sign_key', None))
+                # a local decryption's bytes are counted by its download
+                with profiling.timer('decrypt', sftp_file_path, f['file_size'] if decrypt_remote else None):
+                    if not decrypt_remote:
+                        decrypt_path = self.decrypt_following_download(
+                            f, local_path, f'{tmp_dir_name}/{original_file_name}', decryption_configs)
+                    else:
+                        conn = self.transfer_connection(f)
+                        # the file may have grown since it was listed
+                        file_size = conn.sftp.stat(sftp_file_path).st_size
+                        with conn.transfer_progress(sftp_file_path, file_size) as progress, \
+                                transfer.PipelinedReader(conn.sessions, sftp_file_path, file_size,
+                                                         decryption_configs.get('read_block_size'),
+                                                         decryption_configs.get('read_concurrency'),
+                                                         decryption_configs.get('read_ahead_blocks'),
+                                                         progress) as src_file_object:
+                            decrypt_path = helper.load_file_decrypted(src_file_object,
+                                                                      decryption_configs.get(
+                                                                          'key'),
+                                                                      decryption_configs.get(
+                                                                          'gnupghome'),
+                                                                      decryption_configs.get(
+                                                                          'passphrase'),
+                                                                      f'{tmp_dir_name}/{original_file_name}',
+                                                                      None,
+                                                                      decryption_configs.get('sign_key', None))
+                            # gpg may end without surfacing the read error of a failed transfer
+                            if src_file_object.error is not None:
+                                raise src_file_object.error
                 try:
                     if file_type in ["csv", "text", "fwf"]:
                         if not encoding:
-                            enc = find_encoding.find_encoding_v2(decrypt_path)
+                            enc = self.detect_encoding(f, encoding_detection.leading_bytes_of(decrypt_path))
                         return open(decrypt_path, 'r', encoding=enc, newline="", errors="replace")
                     else:
                         return open(decrypt_path, 'rb')
@@ -224,14 +630,32 @@ class SFTPConnection():
                     raise Exception(
                         f'tap_sftp.decryption_error: Decryption of file failed: {sftp_file_path}')
             else:
-                self.sftp.get(sftp_file_path, local_path)
+                self.download(f, local_path)
                 if file_type in ["csv", "text", "fwf"]:
                     if not encoding:
-                        enc = find_encoding.find_encoding_v2(local_path)
+                        enc = self.detect_encoding(f, encoding_detection.leading_bytes_of(local_path))
                     return open(local_path, 'r', encoding=enc, newline="", errors="replace")
                 else:
                     return open(local_path, 'rb')
 
+    def get_workbook_handle_for_sample(self, f, worksheets=None, max_records=None):
+        """ Takes a file dict of an xlsx workbook and returns a handle to a local copy holding only the leading rows of
+            its worksheets, read from the remote file with ranged reads instead of downloading it. """
+        with tempfile.TemporaryDirectory() as tmp_dir_name:
+            sftp_file_path = f["filepath"]
+            local_path = f'{tmp_dir_name}/{os.path.basename(sftp_file_path)}'
+            try:
+                with self.sftp.open(sftp_file_path, 'rb') as sftp_file_object, \
+                        self.transfer_progress(sftp_file_path, f['file_size']) as progress:
+                    remote_file = transfer.RemoteRangeFile(sftp_file_object, f['file_size'], transfer_progress=progress)
+                    excel_sample.sample_workbook(remote_file, local_path, worksheets, max_records)
+            except excel_sample.SAMPLE_ERRORS as ex:
+                LOGGER.warning('Could not sample workbook "%s" (%s), downloading it instead', sftp_file_path, ex)
+                return self.get_file_handle(f, 'excel', None)
+            LOGGER.info('Sampled workbook "%s" reading %s of %s bytes', sftp_file_path, remote_file.bytes_read,
+                        f['file_size'])
+            return open(local_path, 'rb')
+
     def get_file_handle_for_sample(self, f, file_type, encoding, decryption_configs=None, max_records=None):
         enc = encoding
         with tempfile.TemporaryDirectory() as tmp_dir_name:
@@ -253,7 +677,7 @@ class SFTPConnection():
                     try:
                         if file_type in ["csv", "text", "fwf"]:
                             if not encoding:
-                                enc = find_encoding.find_encoding_v2(sample_file)
+                                enc = self.detect_encoding(f, encoding_detection.leading_bytes_of(sample_file))
                             return open(sample_file, 'r', encoding=enc, newline="",errors="replace")
                         else:
                             return open(sample_file, 'rb')
@@ -261,11 +685,12 @@ class SFTPConnection():
                         raise Exception(
                             f'Decryption of file failed: {sftp_file_path}')
                 else:
-                    sample_file = helper.sample_file(
-                        sftp_file_object, sftp_file_name, tmp_dir_name, max_records)
+                    with self.transfer_progress(sftp_file_path, f.get('file_size')) as progress:
+                        sample_file = helper.sample_file(
+                            sftp_file_object, sftp_file_name, tmp_dir_name, max_records, progress)
                     if file_type in ["csv", "text", "fwf"]:
                         if not encoding:
-                            enc = find_encoding.find_encoding_v2(sample_file)
+                            enc = self.detect_encoding(f, encoding_detection.leading_bytes_of(sample_file))
                         return open(sample_file, 'r', encoding=enc, newline="", errors="replace")
                     else:
                         return open(sample_file, 'rb')
@@ -273,14 +698,220 @@ class SFTPConnection():
     def get_files_matching_pattern(self, files, pattern):
         """ Takes a file dict {"filepath": "...", "last_modified": "..."} and a regex pattern string, and returns
             files matching that pattern. """
-        matcher = re.compile(pattern)
+        matcher = matching.compile_pattern(pattern)
         LOGGER.info(f"Searching for files for matching pattern: {pattern}")
         return [f for f in files if matcher.search(os.path.basename(f["filepath"]))]
 
 
 def connection(config):
+    index = None
+    if config.get('listing_index_path'):
+        index = listing_index.open_index(config['listing_index_path'],
+                                         config.get('listing_index_max_directories'))
     return SFTPConnection(config['host'],
                           config['username'],
                           password=config.get('password'),
                           private_key_file=config.get('private_key_file'),
-                          port=config.get('port'))
+                          port=config.get('port'),
+                          list_concurrency=config.get('list_concurrency'),
+                          max_sessions=config.get('max_sessions'),
+                          download_concurrency=config.get('download_concurrency'),
+                          download_segment_size=config.get('download_segment_size'),
+                          compression=config.get('compression', 'auto'),
+                          preferred_ciphers=config.get('preferred_ciphers'),
+                          preferred_macs=config.get('preferred_macs'),
+                          listing_index=index,
+                          encoding_cache=encoding_detection.open_cache(config.get('encoding_cache_path')),
+                          connect_timeout=config.get('connect_timeout'),
+                          banner_timeout=config.get('banner_timeout'),
+                          auth_timeout=config.get('auth_timeout'),
+                          connect_deadline=config.get('connect_deadline'),
+                          connect_retries=config.get('connect_retries'),
+                          circuit_breaker_threshold=config.get('circuit_breaker_threshold'),
+                          circuit_breaker_reset=config.get('circuit_breaker_reset'),
+                          progress_interval=config.get('progress_interval'),
+                          stall_timeout=config.get('stall_timeout'),
+                          abort_stalled_transfers=config.get('abort_stalled_transfers', False),
+                          stat_literal_patterns=config.get('stat_literal_patterns', True))
+
+
+class SFTPSessionMultiplexer():
+    """
+    Hands out SFTP sessions opened as separate subsystem channels on one authenticated transport, so concurrent
+    listing and download work pays for a single handshake. Sessions are opened lazily up to `max_sessions`. If the
+    server refuses another channel, e.g. because of its MaxSessions limit, the multiplexer stops growing and callers
+    wait for a session to be released instead.
+    """
+
+    def __init__(self, transport, primary, max_sessions):
+        self.transport = transport
+        self.primary = primary
+        self.max_sessions = max_sessions
+        self.__sessions = [primary]
+        self.__idle = [primary]
+        self.__opening = 0
+        self.__condition = threading.Condition()
+
+    @contextmanager
+    def checkout(self):
+        session = self.acquire()
+        try:
+            yield session
+        finally:
+            self.release(session)
+
+    def acquire(self):
+        while True:
+            with self.__condition:
+                while not self.__idle and len(self.__sessions) + self.__opening >= self.max_sessions:
+                    self.__condition.wait()
+                if self.__idle:
+                    return self.__idle.pop()
+                # the slot is reserved and the session opened outside the lock, so releases and other acquires do not
+                # wait for its channel open and handshake
+                self.__opening += 1
+            try:
+                session = self.open_session()
+            except BaseException:
+                with self.__condition:
+                    self.__opening -= 1
+                    self.__condition.notify_all()
+                raise
+            with self.__condition:
+                self.__opening -= 1
+                if session is not None:
+                    self.__sessions.append(session)
+                    return session
+                self.max_sessions = len(self.__sessions) + self.__opening
+                LOGGER.info('Continuing with %s SFTP sessions per connection', self.max_sessions)
+                self.__condition.notify_all()
+
+    def release(self, session):
+        with self.__condition:
+            self.__idle.append(session)
+            self.__condition.notify()
+
+    def open_session(self):
+        """
+        Opens another session on the transport, or returns None when the server refuses it. A transport that is gone
+        raises instead, as its error says nothing about how many sessions the server allows.
+        """
+        try:
+            return paramiko.SFTPClient.from_transport(self.transport)
+        except (ChannelException, SSHException) as ex:
+            if not self.transport.is_active():
+                raise
+            LOGGER.info('SFTP server refused another session: %s', ex)
+            return None
+
+    def size(self):
+        with self.__condition:
+            return len(self.__sessions)
+
+    def close(self):
+        """ Closes every session except the primary one, which belongs to the owning connection. """
+        with self.__condition:
+            sessions = [session for session in self.__sessions if session is not self.primary]
+            self.__sessions = [self.primary]
+            self.__idle = [self.primary]
+        for session in sessions:
+            session.close()
+
+
+class SFTPConnectionPool():
+    """
+    Run-scoped pool of SFTP connections. Connections are checked out with `checkout()` and returned to the pool
+    afterwards with a keepalive set, are health-checked before being handed out again, and are all closed when the
+    pool is closed.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.keepalive_interval = config.get(
+            'keepalive_interval', defaults.KEEPALIVE_INTERVAL)
+        self.opened = 0
+        self.reused = 0
+        self.listing_cache = ListingCache()
+        self.__lock = threading.Lock()
+        self.__idle = []
+        self.__connections = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @contextmanager
+    def checkout(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def acquire(self):
+        while True:
+            with self.__lock:
+                if not self.__idle:
+                    break
+                conn = self.__idle.pop()
+            if self.is_healthy(conn):
+                with self.__lock:
+                    self.reused += 1
+                return conn
+            LOGGER.info('Discarding unhealthy SFTP connection')
+            self.discard(conn)
+
+        conn = connection(self.config)
+        conn.listing_cache = self.listing_cache
+        with self.__lock:
+            self.opened += 1
+            self.__connections.append(conn)
+        return conn
+
+    def release(self, conn):
+        if conn.transport is not None and conn.transport.is_active():
+            conn.transport.set_keepalive(self.keepalive_interval)
+        with self.__lock:
+            self.__idle.append(conn)
+
+    def discard(self, conn):
+        with self.__lock:
+            if conn in self.__connections:
+                self.__connections.remove(conn)
+        try:
+            conn.close()
+        except Exception as ex:
+            LOGGER.warning('Failed to close SFTP connection: %s', ex)
+
+    def is_healthy(self, conn):
+        # connections are opened lazily, so one that never connected has nothing to check
+        if conn.transport is None:
+            return True
+        if not conn.transport.is_active():
+            return False
+        try:
+            conn.sftp.normalize('.')
+        except (IOError, EOFError, SSHException):
+            return False
+        return True
+
+    def stats(self):
+        return {'opened': self.opened, 'reused': self.reused}
+
+    def close(self):
+        with self.__lock:
+            connections = self.__connections
+            self.__connections = []
+            self.__idle = []
+        for conn in connections:
+            try:
+                conn.close()
+            except Exception as ex:
+                LOGGER.warning('Failed to close SFTP connection: %s', ex)
+        LOGGER.info('SFTP connections opened: %s, reused: %s',
+                    self.opened, self.reused)
+        listing_stats = self.listing_cache.stats()
+        if listing_stats['hits'] or listing_stats['misses']:
+            LOGGER.info('Shared listings reused: %s, walked: %s', listing_stats['hits'], listing_stats['misses'])
@@ -0,0 +1,167 @@
+import random
+import socket
+import threading
+import time
+from typing import Dict
+import singer  # type: ignore
+from paramiko.ssh_exception import AuthenticationException, SSHException  # type: ignore
+from file_processors.utils.symon_exception import SymonException  # type: ignore
+from tap_sftp import defaults
+
+LOGGER = singer.get_logger()
+
+# Failures that will not go away by trying again, such as rejected credentials
+NON_RETRYABLE_ERRORS = (AuthenticationException,)
+# Failures of the network or the SSH handshake that a later attempt may not run into
+RETRYABLE_ERRORS = (SSHException, EOFError, OSError)
+
+BREAKERS: Dict[str, 'CircuitBreaker'] = {}
+BREAKERS_LOCK = threading.Lock()
+
+
+def breaker_for(host, port, threshold=None, reset_after=None):
+    """ Returns the run's shared CircuitBreaker for host and port, so parallel workers see each other's failures. """
+    with BREAKERS_LOCK:
+        key = f'{host}:{port}'
+        if key not in BREAKERS:
+            BREAKERS[key] = CircuitBreaker(threshold, reset_after)
+        return BREAKERS[key]
+
+
+def backoff_waits(base, cap):
+    """ Yields exponentially growing waits with full jitter, so workers that failed together retry apart. """
+    attempt = 0
+    while True:
+        yield random.uniform(0, min(cap, base * 2 ** attempt))
+        attempt += 1
+
+
+class CircuitBreaker():
+    """
+    Counts consecutive failed connects to one host. Once `threshold` of them have failed, the circuit opens and every
+    connect fails straight away for `reset_after` seconds, instead of each worker waiting out its own timeouts. After
+    that a single connect is let through to probe the host: it closes the circuit if it succeeds and opens it again
+    if it fails, whatever it fails with.
+    """
+
+    def __init__(self, threshold=None, reset_after=None):
+        self.threshold = max(int(threshold or defaults.CIRCUIT_BREAKER_THRESHOLD), 1)
+        self.reset_after = defaults.CIRCUIT_BREAKER_RESET if reset_after is None else reset_after
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.prober = None
+        self.last_error = None
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if self.probing or time.monotonic() - self.opened_at < self.reset_after:
+                return False
+            self.probing = True
+            self.prober = threading.get_ident()
+            return True
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def end_probe(self):
+        """ Opens the circuit again when the calling thread's probe ended without recording success or failure. """
+        with self.lock:
+            if self.probing and self.prober == threading.get_ident():
+                LOGGER.warning('Opening circuit again after a failed probe')
+                self.opened_at = time.monotonic()
+                self.probing = False
+
+    def record_failure(self, error):
+        with self.lock:
+            self.failures += 1
+            self.last_error = error
+            if self.probing or self.failures >= self.threshold:
+                if self.opened_at is None or self.probing:
+                    LOGGER.warning('Opening circuit after %s failed connects: %s', self.failures, error)
+                self.opened_at = time.monotonic()
+                self.probing = False
+
+
+class Connector():
+    """
+    Establishes SSH transports to one host. Each attempt is bounded by a TCP connect timeout, a timeout for the
+    server's banner and key exchange, and a timeout for authentication. Failed attempts are retried after a jittered
+    exponential wait as long as the next attempt can still start before `deadline` seconds have passed, while
+    rejected credentials fail at once. Attempts go through the host's shared circuit breaker, and each one is timed
+    as a `sftp_connect` metric.
+    """
+
+    def __init__(self, host, port, connect_timeout=None, banner_timeout=None, auth_timeout=None, deadline=None,
+                 max_attempts=None, breaker=None):
+        self.host = host
+        self.port = port
+        self.connect_timeout = connect_timeout or defaults.CONNECT_TIMEOUT
+        self.banner_timeout = banner_timeout or defaults.BANNER_TIMEOUT
+        self.auth_timeout = auth_timeout or defaults.AUTH_TIMEOUT
+        self.deadline = deadline or defaults.CONNECT_DEADLINE
+        self.max_attempts = max(int(max_attempts or defaults.CONNECT_ATTEMPTS), 1)
+        self.breaker = breaker or breaker_for(host, port)
+
+    def open_socket(self):
+        return socket.create_connection((self.host, self.port), timeout=self.connect_timeout)
+
+    def apply_timeouts(self, transport):
+        transport.banner_timeout = self.banner_timeout
+        transport.handshake_timeout = self.banner_timeout
+        transport.auth_timeout = self.auth_timeout
+
+    def connect(self, establish):
+        """
+        Calls `establish(sock)` with a newly connected socket until it returns, and returns its result. `establish`
+        creates and authenticates the transport over the socket, applying `apply_timeouts` to it, and closes whatever
+        it opened when it fails.
+        """
+        started = time.monotonic()
+        waits = backoff_waits(defaults.CONNECT_BACKOFF_BASE, defaults.CONNECT_BACKOFF_CAP)
+        for attempt in range(1, self.max_attempts + 1):
+            if not self.breaker.allow():
+                raise SymonException('Failed to connect to SFTP server. Connections to the server have failed '
+                                     'repeatedly, please check your port configuration and connectivity to your SFTP '
+                                     'server.', 'sftp.ServerError')
+            LOGGER.info('Creating new connection to SFTP...')
+            attempt_started = time.monotonic()
+            try:
+                result = establish(self.open_socket())
+            except NON_RETRYABLE_ERRORS as ex:
+                self.log_attempt(attempt, attempt_started, ex)
+                # the host answered, so it does not count against the circuit
+                self.breaker.record_success()
+                raise SymonException('Authentication failed. Please check your credentials and SFTP server '
+                                     'availability.', 'sftp.AuthenticationError') from ex
+            except RETRYABLE_ERRORS as ex:
+                self.log_attempt(attempt, attempt_started, ex)
+                self.breaker.record_failure(ex)
+                wait = next(waits)
+                if attempt >= self.max_attempts or time.monotonic() - started + wait >= self.deadline:
+                    raise SymonException('Failed to connect to SFTP server. Please check your port configuration '
+                                         'and connectivity to your SFTP server.', 'sftp.ServerError') from ex
+                LOGGER.info('Connection failed (%s), retrying in %.1f seconds...', ex, wait)
+                time.sleep(wait)
+            else:
+                self.breaker.record_success()
+                self.log_attempt(attempt, attempt_started)
+                LOGGER.info('Connection successful')
+                return result
+            finally:
+                # an unexpected error must not leave the circuit probing for good
+                self.breaker.end_probe()
+
+    def log_attempt(self, attempt, attempt_started, error=None):
+        tags = {'host': self.host, 'attempt': attempt,
+                'status': singer.metrics.Status.failed if error else singer.metrics.Status.succeeded}
+        if error:
+            tags['error'] = type(error).__name__
+        singer.metrics.log(LOGGER, singer.metrics.Point('timer', 'sftp_connect', time.monotonic() - attempt_started,
+                                                        tags))
@@ -2,3 +2,73 @@ MAX_FILE_SIZE_KB = 10485760
 MAX_ENCRYPTED_FILE_SIZE_KB = 5242880
 # Sample 1000 records + 1 for the header
 SAMPLE_SIZE = 1001
+# Number of directory listings kept in flight when searching subdirectories
+LIST_CONCURRENCY = 4
+# Directory listings queued per session before the walker hands results back
+LIST_BATCH_FACTOR = 4
+# Seconds between SSH keepalive packets on pooled connections
+KEEPALIVE_INTERVAL = 30
+# Maximum number of SFTP sessions opened on a single SSH connection
+MAX_SESSIONS = 8
+# Files larger than one segment are downloaded as concurrent byte ranges
+DOWNLOAD_CONCURRENCY = 4
+DOWNLOAD_SEGMENT_SIZE = 64 * 1024 * 1024
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_MAX_PREFETCH_REQUESTS = 64
+# A segment running this many times longer than the median finished segment is re-requested
+DOWNLOAD_HEDGE_AFTER_FACTOR = 3
+DOWNLOAD_POLL_INTERVAL = 0.5
+# Files downloaded ahead of the one being parsed, and the most bytes they may stage on disk
+PREFETCH_FILES = 2
+PREFETCH_MAX_BYTES = 2 * 1024 * 1024 * 1024
+# Streaming sync reads ahead in blocks of this size, keeping at most this many blocks buffered
+STREAM_BLOCK_SIZE = 1024 * 1024
+STREAM_BUFFER_BLOCKS = 8
+# Leading bytes first used to detect the encoding of a file
+ENCODING_SAMPLE_BYTES = 1024 * 1024
+# Encoding detection grows its window up to this many bytes while the detector is not confident
+ENCODING_MAX_SAMPLE_BYTES = 16 * 1024 * 1024
+# Detector confidence above which the window stops growing; chardet caps single-byte latin encodings at 0.73
+ENCODING_MIN_CONFIDENCE = 0.7
+# Files kept in the encoding cache before the least recently used are evicted
+ENCODING_CACHE_MAX_ENTRIES = 100000
+# Already-compressed files at least this large are worth a separate uncompressed transport
+UNCOMPRESSED_TRANSFER_MIN_BYTES = 16 * 1024 * 1024
+# Most directories kept in the listing index before the least recently used are evicted
+LISTING_INDEX_MAX_DIRECTORIES = 100000
+# Listings taken within this many seconds of the directory's mtime are not trusted
+LISTING_INDEX_RACY_SECONDS = 2
+# Newest matching files sampled per table during discovery
+DISCOVERY_SAMPLE_FILES = 1
+# Size of the pipelined ranged reads used to sample files without downloading them
+RANGE_READ_BLOCK_SIZE = 1024 * 1024
+# Size of the blocks read when sampling the leading lines of a file
+SAMPLE_BLOCK_SIZE = 64 * 1024
+# Size of the blocks read ahead of gpg when decrypting a remote file
+DECRYPT_BLOCK_SIZE = 8 * 1024 * 1024
+# Sessions reading blocks ahead of gpg
+DECRYPT_READ_CONCURRENCY = 2
+# Blocks held in memory ahead of gpg
+DECRYPT_MAX_BLOCKS = 8
+# Times an interrupted download is resumed over a new connection before giving up
+DOWNLOAD_RESUME_ATTEMPTS = 5
+# Seconds to wait before the first resume, doubled for every further one
+DOWNLOAD_RESUME_WAIT = 1
+# Seconds allowed for the TCP connect, for the server's banner and key exchange, and for authentication
+CONNECT_TIMEOUT = 15
+BANNER_TIMEOUT = 15
+AUTH_TIMEOUT = 30
+# Seconds after which a failing connect is no longer retried
+CONNECT_DEADLINE = 120
+# Attempts made to connect before giving up
+CONNECT_ATTEMPTS = 6
+# Waits between connect attempts grow from this many seconds up to the cap, with full jitter
+CONNECT_BACKOFF_BASE = 1
+CONNECT_BACKOFF_CAP = 30
+# Consecutive failed connects to a host after which connects to it fail at once, and the seconds until one is retried
+CIRCUIT_BREAKER_THRESHOLD = 5
+CIRCUIT_BREAKER_RESET = 60
+# Seconds between progress reports of a running transfer
+PROGRESS_INTERVAL = 30
+# Table patterns joined into one alternation when matching streams to tables
+TABLE_MATCHER_CHUNK = 200
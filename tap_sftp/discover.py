@@ -1,6 +1,6 @@
 import singer  # type: ignore
 from tap_sftp import client
-from tap_sftp import defaults, helper
+from tap_sftp import defaults, excel_sample, helper, profiling
 from file_processors.clients.csv_client import CSVClient  # type: ignore
 from file_processors.clients.excel_client import ExcelClient  # type: ignore
 from file_processors.clients.fwf_client import FWFClient  # type: ignore
@@ -9,13 +9,19 @@ LOGGER = singer.get_logger()
 
 
 def discover_streams(config):
+    with client.SFTPConnectionPool(config) as pool, pool.checkout() as conn:
+        return discover_streams_with_connection(config, conn)
+
+
+def discover_streams_with_connection(config, conn):
     streams = []
-    conn = client.connection(config)
     decryption_configs = config.get('decryption_configs')
     if decryption_configs:
         helper.update_decryption_key(decryption_configs)
 
     tables = config.get('tables')
+    if conn.listing_cache is not None:
+        conn.listing_cache.expect_tables(tables, False)
     for table_spec in tables:
         LOGGER.info('Sampling records to determine table JSON schema "%s".',
                     table_spec.get('table_name'))
@@ -28,7 +34,12 @@ def discover_streams(config):
 
         sorted_files = sorted(
             files, key=lambda f: f['last_modified'], reverse=True)
-        for f in sorted_files:
+        sample_files = select_sample_files(config, sorted_files)
+        LOGGER.info('Sampling the %s newest of %s matching files for table "%s", skipping %s.',
+                    len(sample_files), len(sorted_files), table_spec.get('table_name'),
+                    len(sorted_files) - len(sample_files))
+        table_streams = []
+        for f in sample_files:
             file_path = f['filepath']
             file_type = table_spec.get('file_type').lower()
             if file_type in ["csv", "text"]:
@@ -37,33 +48,113 @@ def discover_streams(config):
                 skip_footer_row = table_spec.get('skip_footer_row', 0)
                 # update sample size for get_file_handle_for_sample to write SAMPLE_SIZE rows excluding skipped rows
                 sample_size = defaults.SAMPLE_SIZE + skip_header_row + skip_footer_row
-                with conn.get_file_handle_for_sample(f, file_type, table_spec.get('encoding'), decryption_configs, sample_size) as file_handle:
+                with profiling.timer('sample', file_path):
+                    sample = conn.get_file_handle_for_sample(f, file_type, table_spec.get('encoding'),
+                                                             decryption_configs, sample_size)
+                with sample as file_handle, profiling.timer('parse', file_path):
                     csv_client = CSVClient(file_path, '',
                                            table_spec.get('key_properties', []), has_header, skip_header_row=skip_header_row, skip_footer_row=skip_footer_row)
                     csv_client.delimiter = table_spec.get('delimiter', ',')
                     csv_client.quotechar = table_spec.get('quotechar', '"')
                     csv_client.encoding = table_spec.get('encoding')
-                    streams += csv_client.build_streams(
+                    table_streams += csv_client.build_streams(
                         file_handle, defaults.SAMPLE_SIZE, tap_stream_id=table_name)
             elif file_type in ["excel"]:
-                with conn.get_file_handle(f, file_type, table_spec.get('encoding'), decryption_configs) as file_handle:
+                with profiling.timer('sample', file_path):
+                    if excel_sample.is_sampled(file_path, decryption_configs):
+                        workbook = conn.get_workbook_handle_for_sample(f, table_spec.get('worksheets', []),
+                                                                       defaults.SAMPLE_SIZE)
+                    else:
+                        workbook = conn.get_file_handle(f, file_type, table_spec.get('encoding'), decryption_configs)
+                with workbook as file_handle, profiling.timer('parse', file_path):
                     excel_client = ExcelClient(file_path, '', table_spec.get(
                         'key_properties', []), has_header)
-                    streams += excel_client.build_streams(file_handle, defaults.SAMPLE_SIZE,
-                                                          worksheets=table_spec.get('worksheets', []))
+                    table_streams += excel_client.build_streams(file_handle, defaults.SAMPLE_SIZE,
+                                                                worksheets=table_spec.get('worksheets', []))
             elif file_type in ["fwf"]:
                 table_name = table_spec.get('table_name')
-                with conn.get_file_handle_for_sample(f, file_type, table_spec.get('encoding'), None, defaults.SAMPLE_SIZE) as file_handle:
+                with profiling.timer('sample', file_path):
+                    sample = conn.get_file_handle_for_sample(f, file_type, table_spec.get('encoding'), None,
+                                                             defaults.SAMPLE_SIZE)
+                with sample as file_handle, profiling.timer('parse', file_path):
                     skip_header_row = table_spec.get('skip_header_row', 0)
                     skip_footer_row = table_spec.get('skip_footer_row', 0)
                     fwf_client = FWFClient(file_path, '', table_spec.get(
                 'key_properties', []), has_header, skip_header_row=skip_header_row, skip_footer_row=skip_footer_row)
                     fwf_client.delimiter = table_spec.get('delimiter', ' ')
                     fwf_client.encoding = table_spec.get('encoding')
-                    streams += fwf_client.build_streams(
+                    table_streams += fwf_client.build_streams(
                         file_handle, defaults.SAMPLE_SIZE, tap_stream_id=table_name)
             else:
                 raise BaseException(
                     f'file_type_error: Unsupported file type "{file_type}"')
 
+        streams += merge_streams(table_streams)
+
     return streams
+
+
+def select_sample_files(config, sorted_files):
+    """
+    Takes matching files sorted newest first and returns the ones to sample: at most `discovery_sample_files` files,
+    further limited to `discovery_sample_bytes` in total when set. The newest file is always sampled.
+    """
+    sample_file_count = config.get('discovery_sample_files', defaults.DISCOVERY_SAMPLE_FILES)
+    sample_bytes = config.get('discovery_sample_bytes')
+    sample_files = []
+    total_bytes = 0
+    for f in sorted_files[:max(sample_file_count, 1)]:
+        total_bytes += f.get('file_size') or 0
+        if sample_files and sample_bytes is not None and total_bytes > sample_bytes:
+            break
+        sample_files.append(f)
+    return sample_files
+
+
+def merge_streams(streams):
+    """
+    Merges the streams built from several sample files into one stream per tap_stream_id. The newest file's stream
+    is kept and extended with the columns only found in older files; a column typed differently across files gets
+    the union of its types.
+    """
+    merged = {}
+    for stream in streams:
+        stream_id = stream.get('tap_stream_id')
+        if stream_id not in merged:
+            merged[stream_id] = stream
+        else:
+            merged[stream_id] = merge_stream(merged[stream_id], stream)
+    return list(merged.values())
+
+
+def merge_stream(stream, other):
+    properties = dict(stream.get('schema', {}).get('properties', {}))
+    other_properties = other.get('schema', {}).get('properties', {})
+    for name, property_schema in other_properties.items():
+        properties[name] = merge_property_schema(properties[name], property_schema) \
+            if name in properties else property_schema
+
+    merged = dict(stream)
+    merged['schema'] = dict(stream.get('schema', {}), properties=properties)
+    if 'metadata' in stream:
+        breadcrumbs = [tuple(entry.get('breadcrumb', [])) for entry in stream['metadata']]
+        merged['metadata'] = stream['metadata'] + [
+            entry for entry in other.get('metadata', []) if tuple(entry.get('breadcrumb', [])) not in breadcrumbs]
+    return merged
+
+
+def merge_property_schema(property_schema, other):
+    if property_schema == other:
+        return property_schema
+    types = as_list(property_schema.get('type'))
+    types += [t for t in as_list(other.get('type')) if t not in types]
+    merged = dict(property_schema, type=types)
+    if property_schema.get('format') != other.get('format'):
+        merged.pop('format', None)
+    return merged
+
+
+def as_list(value):
+    if value is None:
+        return []
+    return list(value) if isinstance(value, list) else [value]
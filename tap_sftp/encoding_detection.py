@@ -0,0 +1,98 @@
+import copy
+import tempfile
+import chardet  # type: ignore
+import singer  # type: ignore
+from file_processors.utils import find_encoding  # type: ignore
+from tap_sftp import defaults
+from tap_sftp.json_store import JsonStore, open_store
+
+LOGGER = singer.get_logger()
+
+# Size of the chunks fed to the confidence detector
+FEED_SIZE = 64 * 1024
+
+
+def open_cache(path=None, max_entries=None):
+    """
+    Returns the run's shared EncodingCache for path, loading it from disk on first use. Without a path the cache only
+    lives for the run.
+    """
+    return open_store(EncodingCache, path, max_entries)
+
+
+def cache_key(host, port, f):
+    return f'{host}:{port}:{f["filepath"]}:{f.get("file_size")}:{f["last_modified"].timestamp()}'
+
+
+def leading_bytes_of(path):
+    """ Returns a function reading up to `size` leading bytes of a local file. """
+    def read(size):
+        with open(path, 'rb') as local_file:
+            return local_file.read(size)
+    return read
+
+
+def detect_encoding(read_leading_bytes):
+    """
+    Detects an encoding from a bounded leading window of the content, read through `read_leading_bytes(size)`. The
+    window starts at ENCODING_SAMPLE_BYTES and only grows, up to ENCODING_MAX_SAMPLE_BYTES, while the detector is
+    not confident enough, so the cost does not depend on the size of the file.
+    """
+    detector = chardet.UniversalDetector()
+    window = defaults.ENCODING_SAMPLE_BYTES
+    fed = 0
+    while True:
+        data = read_leading_bytes(window)
+        while fed < len(data) and not detector.done:
+            chunk = data[fed:fed + FEED_SIZE]
+            detector.feed(chunk)
+            fed += len(chunk)
+        complete = len(data) < window
+        if complete:
+            sample = data
+        else:
+            # a multi-byte character may be cut at the end of the window
+            sample = data[:data.rfind(b'\n') + 1] or data
+        if detector.done or complete or window >= defaults.ENCODING_MAX_SAMPLE_BYTES or \
+                confidence_of(detector) >= defaults.ENCODING_MIN_CONFIDENCE:
+            break
+        window = min(window * 4, defaults.ENCODING_MAX_SAMPLE_BYTES)
+    detector.close()
+    return encoding_of(sample)
+
+
+def confidence_of(detector):
+    """
+    Returns the confidence the detector would report for what it was fed so far. Until it is done the detector only
+    reports one once closed, so a copy of it is closed instead, leaving the original to be fed more.
+    """
+    snapshot = copy.deepcopy(detector)
+    snapshot.close()
+    return (snapshot.result or {}).get('confidence') or 0
+
+
+def encoding_of(sample):
+    with tempfile.NamedTemporaryFile(suffix='.sample') as sample_file:
+        sample_file.write(sample)
+        sample_file.flush()
+        return find_encoding.find_encoding_v2(sample_file.name)
+
+
+class EncodingCache(JsonStore):
+    """
+    Detected encodings keyed by host, port, path, size and mtime, so a file is only detected once: discovery and sync
+    share it within a run, and with a `path` it is also written to disk for later runs. A rewritten file gets a new
+    size or mtime and is detected again. Holds at most `max_entries` files, evicting the least recently used.
+    """
+
+    section = 'files'
+    description = 'encoding cache'
+
+    def __init__(self, path=None, max_entries=None):
+        super().__init__(path, max_entries or defaults.ENCODING_CACHE_MAX_ENTRIES)
+
+    def get(self, key):
+        return self.lookup(key)
+
+    def put(self, key, encoding):
+        self.store(key, encoding)
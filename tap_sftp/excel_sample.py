@@ -0,0 +1,169 @@
+import posixpath
+import re
+import zipfile
+import xml.etree.ElementTree as ElementTree
+import singer  # type: ignore
+from tap_sftp import defaults
+
+LOGGER = singer.get_logger()
+
+# Workbooks that are zip archives and can be sampled without downloading them
+SAMPLED_EXTENSIONS = ['.xlsx', '.xlsm']
+
+RELATIONSHIPS_NS = '{http://schemas.openxmlformats.org/package/2006/relationships}'
+OFFICE_DOCUMENT_REL = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument'
+REL_ID = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}id'
+CONTENT_TYPES = '[Content_Types].xml'
+
+# Parts of the workbook copied into a sample by the last component of their relationship type, besides the worksheets:
+# what openpyxl reads to load a workbook. Tables are tiny and are looked up for the tableParts of a worksheet.
+WORKBOOK_PART_TYPES = ['styles', 'sharedStrings', 'theme']
+WORKSHEET_PART_TYPES = ['table']
+RELATIONSHIP = re.compile(rb'<(?:\w+:)?Relationship\b[^>]*?(?:/>|>.*?</(?:\w+:)?Relationship>)', re.S)
+RELATIONSHIP_ATTRIBUTE = re.compile(rb'\b(Id|Target|TargetMode)="([^"]*)"')
+# the external workbooks they refer to are left out of a sample
+EXTERNAL_REFERENCES = re.compile(
+    rb'<(\w+:)?externalReferences\b(?:[^>]*?/>|.*?</(?:\w+:)?externalReferences>)', re.S)
+
+# Worksheet xml is decompressed in small reads so that no more than needed is fetched past the sampled rows
+ROW_READ_SIZE = 64 * 1024
+ROW_END = re.compile(rb'</(\w+:)?row>')
+ROW_NUMBER = re.compile(rb'<(?:\w+:)?row\b[^>]*?\br="(\d+)"')
+DIMENSION = re.compile(rb'(<(?:\w+:)?dimension\b[^>]*?\bref="[A-Z]*\d+:[A-Z]*)\d+(")')
+# Raised for files that are not the xlsx zip package their extension claims
+SAMPLE_ERRORS = (zipfile.BadZipFile, KeyError, ElementTree.ParseError)
+
+EMPTY_WORKSHEET = (b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                   b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData/>'
+                   b'</worksheet>')
+
+
+def is_sampled(file_path, decryption_configs):
+    extension = posixpath.splitext(file_path)[1].lower()
+    return extension in SAMPLED_EXTENSIONS and not decryption_configs
+
+
+def sample_workbook(remote_file, out_path, worksheets=None, max_records=None):
+    """
+    Writes a copy of the remote xlsx to out_path that holds only what openpyxl reads to load it: the content types,
+    the relationships, the workbook, its styles, shared strings and theme, and the worksheets with their tables. The
+    worksheets are cut after the header and their first `max_records` rows, and those not listed in `worksheets` are
+    left empty. Every other part, such as images, drawings, pivot caches and embedded objects, is left out together
+    with the relationships pointing to it. Only the zip central directory, the parts that are copied and the leading
+    rows of each worksheet are read from the remote file.
+    """
+    max_records = max_records or defaults.SAMPLE_SIZE
+    with zipfile.ZipFile(remote_file) as source, zipfile.ZipFile(out_path, 'w', zipfile.ZIP_DEFLATED) as target:
+        workbook_path, sheets, parts = sampled_parts(source)
+        for info in source.infolist():
+            name = info.filename
+            if name in sheets:
+                if worksheets and sheets[name] not in worksheets:
+                    data = EMPTY_WORKSHEET
+                else:
+                    data = read_leading_rows(source, info, max_records)
+            elif name.endswith('.rels'):
+                owner = relationships_owner(name)
+                if owner != '' and owner not in parts:
+                    continue
+                data = filter_relationships(source.read(info), posixpath.dirname(owner), parts)
+            elif name == workbook_path:
+                data = EXTERNAL_REFERENCES.sub(b'', source.read(info))
+            elif name == CONTENT_TYPES or name in parts:
+                data = source.read(info)
+            else:
+                continue
+            target.writestr(name, data)
+    return out_path
+
+
+def sampled_parts(source):
+    """
+    Returns the workbook part, {part name: sheet name} of its worksheets and the names of all the parts a sample is
+    made of, following the workbook's relationships.
+    """
+    workbook_path = 'xl/workbook.xml'
+    for rel in read_relationships(source, '_rels/.rels'):
+        if rel.get('Type') == OFFICE_DOCUMENT_REL:
+            workbook_path = rel.get('Target').lstrip('/')
+    workbook_dir, workbook_name = posixpath.split(workbook_path)
+    targets = {}
+    parts = {workbook_path}
+    for rel in read_relationships(source, posixpath.join(workbook_dir, '_rels', f'{workbook_name}.rels')):
+        targets[rel.get('Id')] = resolve_target(workbook_dir, rel.get('Target'))
+        if relationship_type(rel) in WORKBOOK_PART_TYPES:
+            parts.add(targets[rel.get('Id')])
+
+    sheets = {}
+    workbook = ElementTree.fromstring(source.read(workbook_path))
+    for sheet in workbook.iter():
+        if sheet.tag.endswith('}sheet') and targets.get(sheet.get(REL_ID)):
+            sheets[targets[sheet.get(REL_ID)]] = sheet.get('name')
+    for sheet_path in sheets:
+        sheet_dir, sheet_name = posixpath.split(sheet_path)
+        for rel in read_relationships(source, posixpath.join(sheet_dir, '_rels', f'{sheet_name}.rels')):
+            if relationship_type(rel) in WORKSHEET_PART_TYPES:
+                parts.add(resolve_target(sheet_dir, rel.get('Target')))
+    return workbook_path, sheets, parts | set(sheets)
+
+
+def relationship_type(rel):
+    # transitional and strict workbooks name the same types under different namespaces
+    return (rel.get('Type') or '').rsplit('/', 1)[-1]
+
+
+def relationships_owner(path):
+    """ The part a relationships part belongs to, '' for the package's own `_rels/.rels`. """
+    rels_dir, name = posixpath.split(path)
+    return posixpath.join(posixpath.dirname(rels_dir), name[:-len('.rels')])
+
+
+def filter_relationships(data, base_dir, parts):
+    """ Drops the relationships to internal parts that are not among parts, leaving the rest of the xml as is. """
+    def keep(match):
+        attributes = {key.decode(): value.decode() for key, value in RELATIONSHIP_ATTRIBUTE.findall(match.group(0))}
+        if attributes.get('TargetMode') == 'External' or resolve_target(base_dir, attributes.get('Target', '')) in parts:
+            return match.group(0)
+        return b''
+    return RELATIONSHIP.sub(keep, data)
+
+
+def read_relationships(source, path):
+    try:
+        return ElementTree.fromstring(source.read(path)).iter(f'{RELATIONSHIPS_NS}Relationship')
+    except KeyError:
+        return []
+
+
+def resolve_target(base_dir, target):
+    if target.startswith('/'):
+        return target.lstrip('/')
+    return posixpath.normpath(posixpath.join(base_dir, target))
+
+
+def read_leading_rows(source, info, max_records):
+    """
+    Decompresses a worksheet part until the header and `max_records` rows are complete, then closes the xml after the
+    last complete row and shortens the declared dimension to match. A worksheet with fewer rows is returned whole.
+    """
+    data = b''
+    rows = 0
+    with source.open(info) as part:
+        while True:
+            chunk = part.read(ROW_READ_SIZE)
+            if not chunk:
+                return data
+            # a closing tag can straddle two chunks
+            rows += len(ROW_END.findall(data[-16:] + chunk)) - len(ROW_END.findall(data[-16:]))
+            data += chunk
+            if rows > max_records:
+                break
+
+    row_ends = list(ROW_END.finditer(data))
+    last_row_end = row_ends[max_records]
+    prefix = last_row_end.group(1) or b''
+    sample = data[:last_row_end.end()]
+    last_rows = ROW_NUMBER.findall(sample)
+    if last_rows:
+        sample = DIMENSION.sub(lambda m: m.group(1) + last_rows[-1] + m.group(2), sample, count=1)
+    return sample + b'</' + prefix + b'sheetData></' + prefix + b'worksheet>'
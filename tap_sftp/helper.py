@@ -1,7 +1,12 @@
 import singer  # type: ignore
+import io
+import itertools
 import json
 import os
 import base64
+import threading
+import time
+from typing import Dict, Tuple
 from file_processors.utils import compression  # type: ignore
 from zipfile import ZipFile
 from file_processors.utils.aws_secrets_manager import AWSSecretsManager  # type: ignore
@@ -11,25 +16,45 @@ from file_processors.utils import decrypt  # type: ignore
 from file_processors.utils.capturer import GPGDataCapturer  # type: ignore
 from file_processors.utils.symon_exception import SymonException  # type: ignore
 from tap_sftp import defaults  # type: ignore
+from tap_sftp.transfer import RemoteRangeFile
 
 LOGGER = singer.get_logger()
 
 
+# Decryption secrets fetched during the run, keyed by key storage type and key name
+DECRYPTION_KEYS: Dict[Tuple[str, str], Tuple[float, dict]] = {}
+DECRYPTION_KEYS_LOCK = threading.Lock()
+
+
 def update_decryption_key(decryption_configs):
+    """
+    Sets the key, and the passphrase for AWS Secrets Manager, of decryption_configs from the key storage. Each key is
+    fetched once per run and reused, or fetched again once `key_cache_ttl` seconds have passed when that is set.
+    """
     storage_type = decryption_configs.get(
         'key_storage_type', 'AWS_Secrets_Manager')
-    LOGGER.info(f'Using key storage type "{storage_type}"')
+    key_name = decryption_configs.get('key_name')
+    ttl = decryption_configs.get('key_cache_ttl')
+    with DECRYPTION_KEYS_LOCK:
+        cached = DECRYPTION_KEYS.get((storage_type, key_name))
+        if cached is None or (ttl is not None and time.monotonic() - cached[0] >= ttl):
+            LOGGER.info(f'Using key storage type "{storage_type}"')
+            cached = (time.monotonic(), fetch_decryption_key(storage_type, key_name))
+            DECRYPTION_KEYS[(storage_type, key_name)] = cached
+    decryption_configs.update(cached[1])
+
+
+def fetch_decryption_key(storage_type, key_name):
     if storage_type == "AWS_SSM":
-        decryption_configs['key'] = AWS_SSM.get_parameter_value(
-            decryption_configs.get('key_name'))
+        return {'key': AWS_SSM.get_parameter_value(key_name)}
 
     elif storage_type == "AWS_Secrets_Manager":
         secret_manager = AWSSecretsManager(os.environ.get('AWS_REGION'))
-        secret = secret_manager.get_secret(decryption_configs.get('key_name'))
+        secret = secret_manager.get_secret(key_name)
         secret_json = json.loads(secret)
-        decryption_configs['key'] = base64.b64decode(
-            secret_json['privateKeyEncoded'])
-        decryption_configs['passphrase'] = secret_json['passphrase']
+        return {'key': base64.b64decode(secret_json['privateKeyEncoded']),
+                'passphrase': secret_json['passphrase']}
+    return {}
 
 
 def get_inner_file_extension_for_pgp_file(file_path):
@@ -39,19 +64,20 @@ def get_inner_file_extension_for_pgp_file(file_path):
     return file_extension
 
 
-def sample_file(src_file_object, src_file_name, out_dir, max_records):
+def sample_file(src_file_object, src_file_name, out_dir, max_records, transfer_progress=None):
+    if isinstance(src_file_object, SFTPFile):
+        # fetch the remote file in large pipelined blocks rather than one request per line
+        range_file = RemoteRangeFile(src_file_object, src_file_object.stat().st_size,
+                                     transfer_progress=transfer_progress)
+        src_file_object = io.BufferedReader(range_file, range_file.block_size)
     compressed_iterables = compression.infer(src_file_object, src_file_name)
     generated_files = []
     for compressed_name, compressed_iterators in compressed_iterables:
-        local_path = f'{out_dir}/{src_file_name if (isinstance(compressed_iterators, SFTPFile) or not compressed_name) else compressed_name}'
+        local_path = f'{out_dir}/{src_file_name if (compressed_iterators is src_file_object or not compressed_name) else compressed_name}'
+        sample = read_leading_records(compressed_iterators, max_records)
         with open(local_path, "wb") as out_file:
-            record_number = 0
-            for line in compressed_iterators:
-                out_file.write(line)
-                record_number += 1
-                if record_number > max_records:
-                    break
-            generated_files.append(local_path)
+            out_file.write(sample)
+        generated_files.append(local_path)
 
     if len(generated_files) == 1:
         return generated_files[0]
@@ -63,6 +89,31 @@ def sample_file(src_file_object, src_file_name, out_dir, max_records):
     return final_file
 
 
+def read_leading_records(src, max_records):
+    """
+    Returns the first `max_records` + 1 lines of src. File objects are read in blocks whose line breaks are counted,
+    and nothing more is read once enough lines are found; other iterables are consumed line by line.
+    """
+    if not hasattr(src, 'read'):
+        return b''.join(itertools.islice(src, max_records + 1))
+
+    blocks = []
+    line_count = 0
+    while line_count <= max_records:
+        block = src.read(defaults.SAMPLE_BLOCK_SIZE)
+        if not block:
+            break
+        blocks.append(block)
+        line_count += block.count(b'\n')
+    sample = b''.join(blocks)
+    if line_count > max_records:
+        end = -1
+        for _ in range(max_records + 1):
+            end = sample.index(b'\n', end + 1)
+        sample = sample[:end + 1]
+    return sample
+
+
 def get_custom_metadata(mdata, attribute_name, default_value=''):
     return mdata.get((), {}).get(attribute_name, default_value)
 
@@ -0,0 +1,98 @@
+import collections
+import json
+import os
+import tempfile
+import threading
+from typing import Dict, Optional, Tuple
+import singer  # type: ignore
+
+LOGGER = singer.get_logger()
+
+STORES: Dict[Tuple[type, Optional[str]], 'JsonStore'] = {}
+STORES_LOCK = threading.Lock()
+
+
+def open_store(store_class, path, *args):
+    """
+    Returns the run's shared store_class instance for path, loading it from disk on first use, so every connection
+    of a run reads and updates the same entries.
+    """
+    with STORES_LOCK:
+        if (store_class, path) not in STORES:
+            STORES[(store_class, path)] = store_class(path, *args)
+        return STORES[(store_class, path)]
+
+
+class JsonStore():
+    """
+    Entries kept in least recently used order, at most `max_entries` of them. With a `path` the entries are loaded
+    from a JSON file, and `save` writes them back atomically through a temporary file when they changed. Subclasses
+    name the `section` of the file holding the entries and the `description` of the store used in logs.
+    """
+
+    section = 'entries'
+    description = 'store'
+
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.dirty = False
+        self.lock = threading.Lock()
+        if path:
+            self.load()
+
+    def load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as store_file:
+                data = json.load(store_file)
+        except FileNotFoundError:
+            return
+        except ValueError:
+            LOGGER.warning('Ignoring unreadable %s "%s"', self.description, self.path)
+            return
+        # entries are stored least recently used first
+        self.entries = collections.OrderedDict(data.get(self.section, []))
+
+    def lookup(self, key, is_valid=None):
+        """ Returns the entry of key, counted as a hit, or None when there is none or `is_valid(entry)` is false. """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or (is_valid is not None and not is_valid(entry)):
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def store(self, key, entry):
+        """ Adds or replaces the entry of key, evicting the least recently used entries beyond `max_entries`. """
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            self.dirty = True
+
+    def save(self):
+        if not self.path:
+            return
+        with self.lock:
+            if not self.dirty:
+                return
+            data = json.dumps({self.section: list(self.entries.items())})
+            self.dirty = False
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f'.{os.path.basename(self.path)}.')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as tmp_file:
+                tmp_file.write(data)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        LOGGER.info('Saved %s "%s": %s %s, %s hits, %s misses',
+                    self.description, self.path, len(self.entries), self.section, self.hits, self.misses)
@@ -0,0 +1,46 @@
+import threading
+
+
+class ListingCache():
+    """
+    Run-scoped cache of prefix walks, keyed by (prefix, search_subdirectories). The search patterns of every table are
+    registered up front with `expect_tables`, so the first get_files under a prefix walks it once, sorting each file
+    into the patterns it matches, and the other tables under that prefix are served from the same walk. Only the
+    matching files of a walk are kept.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.expected = {}
+        self.walks = {}
+        self.hits = 0
+        self.misses = 0
+
+    def expect_tables(self, tables, search_subdirectories):
+        with self.lock:
+            for table_spec in tables or []:
+                key = (table_spec.get('search_prefix'), search_subdirectories)
+                self.expected.setdefault(key, {})[table_spec.get('search_pattern')] = None
+
+    def expected_patterns(self, prefix, search_subdirectories):
+        """ The search patterns of the tables under a prefix, in config order. """
+        with self.lock:
+            return list(self.expected.get((prefix, search_subdirectories), {}))
+
+    def lookup(self, prefix, search_subdirectories, search_pattern):
+        """ Returns (files walked, files matching search_pattern) from an earlier walk, or None on a miss. """
+        with self.lock:
+            walk = self.walks.get((prefix, search_subdirectories))
+            if walk is None or search_pattern not in walk['files']:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return walk['file_count'], list(walk['files'][search_pattern])
+
+    def store(self, prefix, search_subdirectories, file_count, files_by_pattern):
+        with self.lock:
+            self.walks[(prefix, search_subdirectories)] = {'file_count': file_count, 'files': files_by_pattern}
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses}
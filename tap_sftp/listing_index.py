@@ -0,0 +1,109 @@
+import argparse
+import time
+import singer  # type: ignore
+from paramiko.sftp_attr import SFTPAttributes  # type: ignore
+from tap_sftp import defaults
+from tap_sftp.json_store import JsonStore, open_store
+
+LOGGER = singer.get_logger()
+
+
+def open_index(path, max_directories=None):
+    """ Returns the run's shared ListingIndex for path, loading it from disk on first use. """
+    return open_store(ListingIndex, path, max_directories)
+
+
+def index_key(host, port, directory):
+    return f'{host}:{port}:{directory}'
+
+
+def under(path, directory):
+    return not directory or path == directory or path.startswith(directory + '/')
+
+
+class ListingIndex(JsonStore):
+    """
+    On-disk index of directory listings keyed by host, port and path. Each entry keeps the directory's mtime and its
+    entries, and is only served while the directory's current mtime still matches. A directory's mtime changes when
+    entries are added, removed or renamed, but not when a file is rewritten in place.
+
+    A change made within the same second as a listing may leave the mtime as it was, so a listing is only served once
+    it was taken at least `LISTING_INDEX_RACY_SECONDS` after the index first saw the directory at that mtime. Both
+    times are read from the local clock: the server's clock was at or past the mtime when it was first seen, so their
+    difference bounds how long after the mtime the listing was taken without depending on the skew between the
+    clocks. A directory that changed is therefore listed twice, in two runs, before it is served from the index.
+
+    The index holds at most `max_directories` directories, evicting the least recently used. Serving a directory
+    only reorders it in memory, the order is written with the next change to the index.
+    """
+
+    section = 'directories'
+    description = 'listing index'
+
+    def __init__(self, path, max_directories=None):
+        super().__init__(path, max_directories or defaults.LISTING_INDEX_MAX_DIRECTORIES)
+
+    def get(self, key, mtime):
+        entry = self.lookup(key, lambda entry: entry['mtime'] == mtime and
+                            entry['listed_at'] - entry.get('seen_at', entry['listed_at']) >=
+                            defaults.LISTING_INDEX_RACY_SECONDS)
+        if entry is None:
+            return None
+        return [self.to_attributes(values) for values in entry['entries']]
+
+    def put(self, key, mtime, listing, listed_at=None):
+        """ Stores the listing of a directory at mtime, taken at local time `listed_at`, by default now. """
+        if mtime is None:
+            return
+        listed_at = time.time() if listed_at is None else listed_at
+        with self.lock:
+            previous = self.entries.get(key)
+        seen_at = previous.get('seen_at', previous['listed_at']) \
+            if previous is not None and previous['mtime'] == mtime else listed_at
+        self.store(key, {
+            'mtime': mtime,
+            'seen_at': seen_at,
+            'listed_at': listed_at,
+            'entries': [[attr.filename, attr.st_mode, attr.st_size, attr.st_mtime] for attr in listing]
+        })
+
+    def invalidate(self, host=None, port=22, directory=''):
+        """
+        Drops the directories of host and port that are directory or under it, every directory of the host if no
+        directory is given, or the whole index if no host is given.
+        """
+        key_prefix = index_key(host, port, '')
+        directory = directory.rstrip('/')
+        with self.lock:
+            keys = [key for key in self.entries if host is None or (
+                key.startswith(key_prefix) and under(key[len(key_prefix):], directory))]
+            for key in keys:
+                del self.entries[key]
+            self.dirty = True
+        return len(keys)
+
+    @staticmethod
+    def to_attributes(values):
+        attr = SFTPAttributes()
+        attr.filename, attr.st_mode, attr.st_size, attr.st_mtime = values
+        return attr
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Invalidate the tap-sftp listing index.')
+    parser.add_argument('path', help='path of the listing index file')
+    parser.add_argument('--host', help='only invalidate directories of this host')
+    parser.add_argument('--port', type=int, default=22, help='port of the host, default 22')
+    parser.add_argument('--prefix', default='', help='only invalidate directories under this path')
+    args = parser.parse_args()
+    if args.prefix and not args.host:
+        parser.error('--prefix requires --host')
+
+    index = ListingIndex(args.path)
+    removed = index.invalidate(args.host, args.port, args.prefix)
+    index.save()
+    LOGGER.info('Invalidated %s directories in listing index "%s"', removed, args.path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+import functools
+import re
+import singer  # type: ignore
+from tap_sftp import defaults
+
+LOGGER = singer.get_logger()
+
+REGEX_METACHARACTERS = set('.^$*+?{}[]|()')
+# backreferences, named groups and conditionals refer to the groups of their own pattern, so such patterns are not
+# joined into an alternation with others
+UNCOMBINABLE = re.compile(r'\\[1-9]|\(\?P[<=]|\(\?\(')
+
+
+@functools.lru_cache(maxsize=None)
+def compile_pattern(pattern, flags=0):
+    """ re.compile without the eviction of re's own small cache, for runs matching thousands of table patterns. """
+    return re.compile(pattern, flags)
+
+
+def literal_of(pattern):
+    """
+    Returns the only string a pattern matches when it is a literal, such as a filename escaped with re.escape, and
+    None when the pattern uses any regex syntax.
+    """
+    literal = []
+    escaped = False
+    for char in pattern:
+        if escaped:
+            # an escaped ascii letter or digit is a class or a reference like \d or \1, anything else is itself
+            if char.isascii() and char.isalnum():
+                return None
+            literal.append(char)
+            escaped = False
+        elif char == '\\':
+            escaped = True
+        elif char in REGEX_METACHARACTERS:
+            return None
+        else:
+            literal.append(char)
+    return None if escaped else ''.join(literal)
+
+
+def dynamic_table_name(table_config):
+    table_name = table_config.get('table_name')
+    # if table_name starts with *, then add dot to the start of the table_name as it was removed in the config to avoid
+    # having output file with dot at the start
+    if table_name.startswith('*'):
+        LOGGER.info(f'Table name {table_name} starts with "*", adding dot to the start of the table name.')
+        table_name = '.' + table_name
+    return table_name
+
+
+class PatternSet():
+    """
+    Regex patterns searched together. A text is searched in alternations of up to `defaults.TABLE_MATCHER_CHUNK`
+    patterns, and the patterns are only tested one by one within an alternation that found it. The patterns are
+    compiled on first use.
+    """
+
+    def __init__(self, patterns, flags=0):
+        self.patterns = list(patterns)
+        self.flags = flags
+        self._chunks = None
+
+    @property
+    def chunks(self):
+        """ The patterns as (alternation, [(index, compiled pattern)]) chunks. """
+        if self._chunks is None:
+            combinable = []
+            separate = []
+            for index, pattern in enumerate(self.patterns):
+                compiled = compile_pattern(pattern, self.flags)
+                (separate if UNCOMBINABLE.search(pattern) else combinable).append((index, compiled))
+            chunk_size = defaults.TABLE_MATCHER_CHUNK
+            self._chunks = []
+            for start in range(0, len(combinable), chunk_size):
+                chunk = combinable[start:start + chunk_size]
+                try:
+                    combined = re.compile('|'.join(f'(?:{compiled.pattern})' for _, compiled in chunk), self.flags)
+                except re.error:
+                    combined = None
+                self._chunks.append((combined, chunk))
+            if separate:
+                self._chunks.append((None, separate))
+        return self._chunks
+
+    def search(self, text):
+        """ Returns the indexes of the patterns found in text. """
+        found = []
+        for combined, chunk in self.chunks:
+            if combined is not None and combined.search(text) is None:
+                continue
+            found.extend(index for index, compiled in chunk if compiled.search(text) is not None)
+        return found
+
+
+class FilenameMatcher():
+    """
+    The search patterns of several tables, for sorting the files of one walk into the tables whose pattern matches
+    the whole file name. Escaped filenames are looked up by name, the other patterns searched as a PatternSet.
+    """
+
+    def __init__(self, search_patterns):
+        self.names = {}
+        self.regex_patterns = []
+        for search_pattern in dict.fromkeys(search_patterns):
+            literal = literal_of(search_pattern)
+            if literal is not None:
+                self.names.setdefault(literal, []).append(search_pattern)
+            else:
+                self.regex_patterns.append(search_pattern)
+        self.pattern_set = PatternSet([f'^{search_pattern}$' for search_pattern in self.regex_patterns])
+
+    def match(self, filename):
+        """ Returns the search patterns matching filename. """
+        return self.names.get(filename, []) + [self.regex_patterns[index]
+                                               for index in self.pattern_set.search(filename)]
+
+
+class TableMatcher():
+    """
+    Finds the table configurations a stream's `file_source` belongs to, indexed once per run instead of compiling
+    every table's pattern for every stream group.
+
+    A table matches when `<escaped search_prefix>/<search_pattern>` is found in the key. Patterns that are escaped
+    filenames are looked up by their last path component and confirmed with a substring test, the others are searched
+    as a PatternSet. In dynamic mode the file name is predetermined, `<search_prefix>/<table_name>`, and is looked
+    up exactly, ignoring case; only a key that is no table's exact path compiles the tables' patterns to search them.
+    """
+
+    def __init__(self, tables, dynamic=None):
+        self.tables = list(tables or [])
+        self.dynamic = dynamic is not None
+        self.exact = {}
+        self.literals = {}
+        self.pattern_indexes = []
+        patterns = []
+        for index, table_config in enumerate(self.tables):
+            prefix = table_config.get('search_prefix')
+            if self.dynamic:
+                table_name = dynamic_table_name(table_config)
+                self.exact.setdefault(f'{prefix}/{table_name}'.lower(), []).append(index)
+                pattern = f'{re.escape(prefix)}/{table_name}'
+            else:
+                pattern = f"{re.escape(prefix)}/{table_config.get('search_pattern')}"
+                literal = literal_of(pattern)
+                if literal is not None:
+                    self.literals.setdefault(literal.rsplit('/', 1)[-1], []).append((index, literal))
+                    continue
+            self.pattern_indexes.append(index)
+            patterns.append(pattern)
+        # only compiled once a key needs them, which in dynamic mode is a key that is no table's exact path
+        self.pattern_set = PatternSet(patterns, re.IGNORECASE if self.dynamic else 0)
+
+        # a found literal's last component starts some component of the key, so only those lengths are looked up
+        self.literal_lengths = sorted({len(name) for name in self.literals})
+
+    def match(self, key):
+        """ Returns the table configurations matching key, in config order. """
+        if self.dynamic:
+            exact = self.exact.get(key.lower())
+            if exact:
+                return [self.tables[index] for index in exact]
+
+        found = set()
+        if self.literals:
+            for component in key.split('/'):
+                for length in self.literal_lengths:
+                    if length > len(component):
+                        break
+                    for index, literal in self.literals.get(component[:length], ()):
+                        if literal in key:
+                            found.add(index)
+        found.update(self.pattern_indexes[index] for index in self.pattern_set.search(key))
+        return [self.tables[index] for index in sorted(found)]
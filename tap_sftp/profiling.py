@@ -0,0 +1,97 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+import singer  # type: ignore
+from singer import metrics  # type: ignore
+
+LOGGER = singer.get_logger()
+
+# Phases shown per file in the Extraction Summary, in this order
+FILE_PHASES = ['download', 'decrypt', 'encoding', 'parse']
+
+
+class RunProfile():
+    """
+    Run-wide totals of the time spent in each phase (connect, list, download, decrypt, encoding, sample, parse) and of
+    the bytes transferred, overall and per file. Phases of different files can run at once on prefetch threads, and a
+    sample includes detecting its encoding, so phase seconds can add up to more than the run took.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.phases = {}
+            self.files = {}
+
+    def add(self, phase, seconds, file_path=None, transferred=None):
+        with self.lock:
+            totals = self.phases.setdefault(phase, {'seconds': 0, 'count': 0})
+            totals['seconds'] += seconds
+            totals['count'] += 1
+            if file_path is None:
+                return
+            file_profile = self.files.setdefault(file_path, {'bytes': 0, 'transfer_seconds': 0, 'phases': {}})
+            file_profile['phases'][phase] = file_profile['phases'].get(phase, 0) + seconds
+            if transferred is not None:
+                file_profile['bytes'] += transferred
+                file_profile['transfer_seconds'] += seconds
+
+    def file_summary(self, file_path):
+        """ Returns bytes, MB/s and seconds per phase of a file, for the Extraction Summary. """
+        with self.lock:
+            file_profile = self.files.get(file_path, {'bytes': 0, 'transfer_seconds': 0, 'phases': {}})
+            transfer_seconds = file_profile['transfer_seconds']
+            mb_per_second = file_profile['bytes'] / 1024 / 1024 / transfer_seconds if transfer_seconds else None
+            return file_profile['bytes'], mb_per_second, [file_profile['phases'].get(phase) for phase in FILE_PHASES]
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                'started_at': self.started,
+                'seconds': time.time() - self.started,
+                'bytes': sum(file_profile['bytes'] for file_profile in self.files.values()),
+                'phases': {phase: dict(totals) for phase, totals in self.phases.items()},
+                'files': {path: dict(file_profile, phases=dict(file_profile['phases']))
+                          for path, file_profile in self.files.items()}
+            }
+
+    def write(self, path):
+        with open(path, 'w', encoding='utf-8') as profile_file:
+            json.dump(self.to_dict(), profile_file, indent=2)
+        LOGGER.info('Wrote run profile to "%s"', path)
+
+
+PROFILE = RunProfile()
+
+
+@contextmanager
+def timer(phase, file_path=None, transferred=None):
+    """
+    Times the block as `phase`, adds it to the run profile and emits it as a Singer `sftp_phase_duration` timer. With
+    `transferred`, the block moved that many bytes of the file, which is also emitted as a `sftp_bytes_transferred`
+    counter once the block succeeds. The block can correct the byte count through the yielded dict's 'transferred'.
+    """
+    tags = {'phase': phase}
+    if file_path is not None:
+        tags['file'] = file_path
+    measurement = {'transferred': transferred}
+    start = time.monotonic()
+    try:
+        yield measurement
+    except BaseException:
+        tags[metrics.Tag.status] = metrics.Status.failed
+        raise
+    else:
+        tags[metrics.Tag.status] = metrics.Status.succeeded
+    finally:
+        seconds = time.monotonic() - start
+        moved = measurement['transferred'] if tags[metrics.Tag.status] == metrics.Status.succeeded else None
+        PROFILE.add(phase, seconds, file_path, moved)
+        metrics.log(LOGGER, metrics.Point('timer', 'sftp_phase_duration', seconds, tags))
+        if moved:
+            metrics.log(LOGGER, metrics.Point('counter', 'sftp_bytes_transferred', moved, {'file': file_path}))
@@ -0,0 +1,150 @@
+import collections
+import io
+import os
+import queue
+import threading
+import singer  # type: ignore
+from tap_sftp import defaults
+
+LOGGER = singer.get_logger()
+
+# Formats that need random access or a full pass before parsing are always staged on local disk
+STAGED_EXTENSIONS = ['.zip', '.gz', '.gzip', '.bz2', '.xz', '.tar', '.tgz', '.7z', '.gpg', '.pgp', '.xlsx', '.xls']
+
+
+def is_streamable(file_path, file_type, decryption_configs):
+    extension = os.path.splitext(file_path)[1].lower()
+    return file_type in ["csv", "text", "fwf"] and not decryption_configs and extension not in STAGED_EXTENSIONS
+
+
+class ReadAheadReader(io.RawIOBase):
+    """
+    Reads a remote file sequentially in a background thread, keeping at most `max_blocks` blocks of `block_size`
+    bytes buffered ahead of the consumer, so network reads overlap parsing without staging the file.
+    """
+
+    def __init__(self, remote_file, block_size=None, max_blocks=None):
+        super().__init__()
+        self.remote_file = remote_file
+        self.block_size = block_size or defaults.STREAM_BLOCK_SIZE
+        self.blocks = queue.Queue(maxsize=max_blocks or defaults.STREAM_BUFFER_BLOCKS)
+        self.buffer = b''
+        self.eof = False
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.fill, daemon=True)
+        self.thread.start()
+
+    def fill(self):
+        try:
+            while not self.stopped.is_set():
+                block = self.remote_file.read(self.block_size)
+                self.put(block)
+                if not block:
+                    return
+        except Exception as ex:
+            self.put(ex)
+
+    def put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.blocks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def next_block(self):
+        if self.eof:
+            return b''
+        block = self.blocks.get()
+        if isinstance(block, Exception):
+            raise block
+        if not block:
+            self.eof = True
+        return block
+
+    def peek(self, size):
+        """ Returns up to `size` leading bytes without consuming them. """
+        while len(self.buffer) < size and not self.eof:
+            self.buffer += self.next_block()
+        return self.buffer[:size]
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if not self.buffer:
+            self.buffer = self.next_block()
+        size = min(len(b), len(self.buffer))
+        b[:size] = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return size
+
+    def close(self):
+        if not self.closed:
+            self.stopped.set()
+            self.thread.join()
+            self.remote_file.close()
+        super().close()
+
+
+class TextStream(io.TextIOBase):
+    """
+    Text handle over a ReadAheadReader for the csv/text/fwf parsers. The last `skip_footer_row` lines are held back in
+    a small tail buffer and never returned, as the end of the stream is only known once it is reached.
+    """
+
+    def __init__(self, reader, encoding, name, skip_footer_row=0, on_close=None):
+        super().__init__()
+        self.reader = reader
+        self.name = name
+        self.text = io.TextIOWrapper(io.BufferedReader(reader, reader.block_size), encoding=encoding, newline="",
+                                     errors="replace")
+        self.skip_footer_row = skip_footer_row
+        self.tail = collections.deque()
+        self.pending = ''
+        self.on_close = on_close
+
+    @property
+    def encoding(self):
+        return self.text.encoding
+
+    def readable(self):
+        return True
+
+    def next_line(self):
+        while len(self.tail) <= self.skip_footer_row:
+            line = self.text.readline()
+            if not line:
+                # whatever is left in the tail buffer is the footer
+                return ''
+            self.tail.append(line)
+        return self.tail.popleft()
+
+    def readline(self, size=-1):
+        line = self.pending or self.next_line()
+        self.pending = ''
+        if size is not None and 0 <= size < len(line):
+            line, self.pending = line[:size], line[size:]
+        return line
+
+    def read(self, size=-1):
+        unbounded = size is None or size < 0
+        chunks = []
+        remaining = size
+        while unbounded or remaining > 0:
+            line = self.readline(-1 if unbounded else remaining)
+            if not line:
+                break
+            chunks.append(line)
+            if not unbounded:
+                remaining -= len(line)
+        return ''.join(chunks)
+
+    def close(self):
+        if not self.closed:
+            try:
+                self.text.close()
+            finally:
+                if self.on_close:
+                    self.on_close()
+        super().close()
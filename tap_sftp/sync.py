@@ -1,15 +1,19 @@
 import singer  # type: ignore
 from singer import utils, metadata
-import itertools
+import collections
+import contextlib
+from tap_sftp import bookmarks
 from tap_sftp import client
 from tap_sftp import defaults
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor
 from tap_sftp import helper
+from tap_sftp import matching
+from tap_sftp import profiling
+from tap_sftp import streaming
 from file_processors.clients.csv_client import CSVClient  # type: ignore
 from file_processors.clients.excel_client import ExcelClient  # type: ignore
 from file_processors.clients.fwf_client import FWFClient  # type: ignore
 from file_processors.utils.symon_exception import SymonException  # type: ignore
-import re
 
 LOGGER = singer.get_logger()
 
@@ -18,81 +22,252 @@ def stream_is_selected(mdata):
     return mdata.get((), {}).get('selected', False)
 
 
-def sync_stream(config, catalog, state, collect_sync_stats=False):
-    sftp_client = client.connection(config)
-    stream_groups = itertools.groupby(catalog.streams, key=lambda stream: helper.get_custom_metadata(
-        singer.metadata.to_map(stream.metadata), 'file_source'))
-    for key, group in stream_groups:
-        streams = list(group)
-
-        ''' Skipping file read if no stream is selected'''
-        streams_to_read = next((
-            stream for stream in streams if stream_is_selected(metadata.to_map(stream.metadata))), None)
-        if not streams_to_read:
+class SyncTarget():
+    """ A table to sync: its table spec, the catalog streams read from its files and the key of its bookmark. """
+
+    def __init__(self, key, table_spec, streams, bookmark_key):
+        self.key = key
+        self.table_spec = table_spec
+        self.streams = streams
+        self.bookmark_key = bookmark_key
+        self.file_count = 0
+
+
+class PlannedFile():
+    """
+    A remote file to fetch once and parse for each of its targets. A file read by more than one target is staged on
+    disk and rewound between them, so it is never streamed.
+    """
+
+    def __init__(self, file, targets=None, stream=False):
+        self.file = file
+        self.targets = targets if targets is not None else []
+        self.stream = stream
+
+    @property
+    def table_spec(self):
+        """ The table spec the file is fetched with; targets sharing a fetch agree on file type and encoding. """
+        return self.targets[0].table_spec
+
+
+class SyncPlan():
+    """
+    What a sync run does, resolved before any file is fetched: the table each selected stream reads, and the remote
+    files in the order they are synced, each with the tables it is parsed for.
+    """
+
+    def __init__(self):
+        self.targets = []
+        self.files = []
+        self.skipped = []
+
+    def __str__(self):
+        lines = [f'Sync plan: {len(self.files)} files for {len(self.targets)} tables']
+        for target in self.targets:
+            streams = ', '.join(stream.tap_stream_id for stream in target.streams)
+            lines.append(f'  table "{target.bookmark_key}" from "{target.key}": {target.file_count} files, '
+                         f'streams {streams}')
+        for key, reason in self.skipped:
+            lines.append(f'  skipped "{key}": {reason}')
+        for index, planned_file in enumerate(self.files, 1):
+            f = planned_file.file
+            tables = ', '.join(f'"{target.bookmark_key}"' for target in planned_file.targets)
+            streamed = ' (streamed)' if planned_file.stream else ''
+            lines.append(f'  {index}. {f["filepath"]} ({f.get("file_size")} bytes, modified {f["last_modified"]}) '
+                         f'-> {tables}{streamed}')
+        return '\n'.join(lines)
+
+
+def build_sync_plan(config, catalog, state, pool):
+    """
+    Resolves the selected catalog streams to their table specs, then lists each table's new or changed files once.
+    Streams are grouped by the file they were discovered from wherever they appear in the catalog, a file matched by
+    several tables is fetched once for all of them, and files are ordered oldest first.
+    """
+    plan = SyncPlan()
+    stream_groups = {}
+    for stream in catalog.streams:
+        key = helper.get_custom_metadata(singer.metadata.to_map(stream.metadata), 'file_source')
+        stream_groups.setdefault(key, []).append(stream)
+
+    dynamic = config.get('dynamic')
+    table_matcher = matching.TableMatcher(config.get('tables'), dynamic)
+    modified_since = utils.strptime_to_utc(config.get('start_date'))
+    search_subdir = config.get("search_subdirectories", True)
+    decryption_configs = config.get('decryption_configs')
+    targets = {}
+    planned_files = {}
+    for key, streams in stream_groups.items():
+        # skipping file read if no stream is selected
+        if not any(stream_is_selected(metadata.to_map(stream.metadata)) for stream in streams):
             for stream in streams:
                 LOGGER.info(f"{stream.tap_stream_id}: Skipping - not selected")
-                continue
-            return 0
+            plan.skipped.append((key, 'not selected'))
+            continue
 
-        dynamic = config.get('dynamic')
+        if dynamic is not None:
+            # file name is predetermined for dynamic import - we only check here to see if file still exists
+            LOGGER.info('Checking if file "%s" exists.', key)
         # regex match instead of direct equality as search_pattern could get escaped regex chars
-        table_specs = [table_config for table_config in config.get('tables') if
-                       matches_key(table_config, key, dynamic)]
+        table_specs = table_matcher.match(key)
         if len(table_specs) == 0:
             LOGGER.info(
                 "No table configuration found for '%s', skipping stream", key)
-            return 0
+            plan.skipped.append((key, 'no table configuration'))
+            continue
         if len(table_specs) > 1:
             LOGGER.info(
                 "Multiple table configurations found for '%s', skipping stream", key)
-            return 0
+            plan.skipped.append((key, 'multiple table configurations'))
+            continue
         table_spec = table_specs[0]
-        modified_since = utils.strptime_to_utc(config.get('start_date'))
-        search_subdir = config.get("search_subdirectories", True)
 
-        files = sftp_client.get_files(
-            table_spec.get("search_prefix"),
-            table_spec.get("search_pattern"),
-            modified_since,
-            search_subdir
-        )
+        # streams discovered from different files of one table are synced together from a single listing
+        target = targets.get(id(table_spec))
+        if target is not None:
+            target.streams.extend(streams)
+            continue
+        targets[id(table_spec)] = SyncTarget(key, table_spec, streams, table_spec.get('table_name') or key)
 
+    pool.listing_cache.expect_tables([target.table_spec for target in targets.values()], search_subdir)
+    for target in targets.values():
+        table_spec = target.table_spec
+        with pool.checkout() as sftp_client:
+            files = sftp_client.get_files(
+                table_spec.get("search_prefix"),
+                table_spec.get("search_pattern"),
+                modified_since,
+                search_subdir,
+                bookmarks.get_bookmark(state, target.bookmark_key)
+            )
+
+        # nothing new since the bookmark is the usual case of an incremental run, the next table still syncs
         if not files:
-            sftp_client.close()
-            return 0
+            LOGGER.info("No new or changed files for '%s'", target.key)
+            plan.skipped.append((target.key, 'no new or changed files'))
+            continue
 
-        helper.validate_file_size(
-            config, config.get('decryption_configs'), table_spec, files)
+        helper.validate_file_size(config, decryption_configs, table_spec, files)
 
-        has_header = table_spec.get('has_header')
+        plan.targets.append(target)
+        target.file_count = len(files)
+        fetch = (table_spec.get('file_type').lower(), table_spec.get('encoding'))
         for file in files:
-            sync_file(config, file, streams, table_spec, state,
-                      modified_since, collect_sync_stats, has_header)
-
-
-def matches_key(table_config, key, dynamic):
-    if dynamic is None:
-        search_pattern = f"{re.escape(table_config.get('search_prefix'))}/{table_config.get('search_pattern')}"
-        matcher = re.compile(search_pattern)
-        result = matcher.search(key) != None
-    else:
-        table_name = table_config.get('table_name')
-        # if table_name starts with *, then add dot to the start of the table_name as it was removed in the config to avoid having output file with dot at the start
-        if table_name.startswith('*'):
-            LOGGER.info(f'Table name {table_name} starts with "*", adding dot to the start of the table name.')
-            table_name= '.' + table_name
-        # file name is predetermined for dynamic import - we only check here to see if file still exist at this point
-        search_pattern = f"{re.escape(table_config.get('search_prefix'))}/{table_name}"
-        LOGGER.info('Checking if file "%s" exists for table "%s".', key, table_name)
-        matcher = re.compile(search_pattern, re.IGNORECASE)
-        result = matcher.search(key) != None
-    return result
-
-
-def sync_file(config, file, streams, table_spec, state, modified_since, collect_sync_stats, has_header):
+            planned_files.setdefault((file['filepath'], fetch), PlannedFile(file)).targets.append(target)
+
+    # oldest first, so a run that fails part way leaves bookmarks that skip only what was synced
+    plan.files = sorted(planned_files.values(), key=lambda planned_file: planned_file.file['last_modified'])
+    for planned_file in plan.files:
+        planned_file.stream = len(planned_file.targets) == 1 and use_stream(
+            config, planned_file.file, planned_file.table_spec, decryption_configs)
+    return plan
+
+
+def sync_stream(config, catalog, state, collect_sync_stats=False):
+    with client.SFTPConnectionPool(config) as pool:
+        plan = build_sync_plan(config, catalog, state, pool)
+        if config.get('print_sync_plan'):
+            LOGGER.info('%s', plan)
+
+        modified_since = utils.strptime_to_utc(config.get('start_date'))
+        for planned_file, staged_file_handle in prefetch_file_handles(config, plan.files, pool):
+            file = planned_file.file
+            if len(planned_file.targets) == 1:
+                target = planned_file.targets[0]
+                sync_file(config, file, target.streams, target.table_spec, state, modified_since,
+                          collect_sync_stats, target.table_spec.get('has_header'), pool, staged_file_handle,
+                          planned_file.stream)
+                state = bookmarks.write_file_bookmark(state, target.bookmark_key, file)
+                continue
+
+            # the file is fetched once and rewound for each table reading it
+            if staged_file_handle is None:
+                decryption_configs = config.get('decryption_configs')
+                if decryption_configs:
+                    helper.update_decryption_key(decryption_configs)
+                staged_file_handle = open_file_handle(pool, file, planned_file.table_spec, decryption_configs)
+            with staged_file_handle as file_handle:
+                for target in planned_file.targets:
+                    file_handle.seek(0)
+                    sync_file(config, file, target.streams, target.table_spec, state, modified_since,
+                              collect_sync_stats, target.table_spec.get('has_header'), pool,
+                              contextlib.nullcontext(file_handle), False)
+                    state = bookmarks.write_file_bookmark(state, target.bookmark_key, file)
+
+
+def prefetch_file_handles(config, files, pool):
+    """
+    Takes the planned files of a sync plan and yields (planned file, staged file handle) pairs in file order while the
+    next `prefetch_files` files are downloaded in the background, so the network is busy while the current file is
+    parsed. A file is only staged ahead while the staged files stay within `prefetch_max_bytes`. Each handle must be
+    closed by the caller before asking for the next one. With prefetching disabled the handle is None and sync_file
+    downloads the file itself.
+    """
+    prefetch_files = int(config.get('prefetch_files', defaults.PREFETCH_FILES))
+    if prefetch_files < 1:
+        for planned_file in files:
+            yield planned_file, None
+        return
+
+    prefetch_max_bytes = config.get('prefetch_max_bytes', defaults.PREFETCH_MAX_BYTES)
+    decryption_configs = config.get('decryption_configs')
+    if decryption_configs and files:
+        helper.update_decryption_key(decryption_configs)
+
+    pending = collections.deque()
+    staged_bytes = 0
+    next_index = 0
+    with ThreadPoolExecutor(max_workers=prefetch_files) as executor:
+        try:
+            while next_index < len(files) or pending:
+                # the file parsed next is always fetched; files after it only while within the byte budget
+                while next_index < len(files) and len(pending) <= prefetch_files:
+                    planned_file = files[next_index]
+                    file_size = planned_file.file.get('file_size') or 0
+                    if pending and staged_bytes + file_size > prefetch_max_bytes:
+                        break
+                    pending.append((planned_file, file_size, executor.submit(
+                        open_file_handle, pool, planned_file.file, planned_file.table_spec, decryption_configs,
+                        planned_file.stream)))
+                    staged_bytes += file_size
+                    next_index += 1
+
+                planned_file, file_size, future = pending.popleft()
+                yield planned_file, future.result()
+                staged_bytes -= file_size
+        finally:
+            for _, _, future in pending:
+                future.cancel()
+                if not future.cancelled() and future.exception() is None:
+                    future.result().close()
+
+
+def open_file_handle(pool, file, table_spec, decryption_configs, stream=False):
+    if stream:
+        # the stream reads from its connection until it is closed, so the connection stays checked out until then
+        sftp_client = pool.acquire()
+        try:
+            return sftp_client.open_stream(file, table_spec.get('encoding'), table_spec.get('skip_footer_row', 0),
+                                           on_close=lambda: pool.release(sftp_client))
+        except BaseException:
+            pool.release(sftp_client)
+            raise
+
+    with pool.checkout() as sftp_client:
+        return sftp_client.get_file_handle(file, table_spec.get('file_type').lower(), table_spec.get('encoding'),
+                                           decryption_configs)
+
+
+def use_stream(config, file, table_spec, decryption_configs):
+    """ Streaming sync applies to plain csv/text/fwf files; anything needing random access is staged on disk. """
+    return config.get('stream_sync', False) and streaming.is_streamable(
+        file["filepath"], table_spec.get('file_type').lower(), decryption_configs)
+
+
+def sync_file(config, file, streams, table_spec, state, modified_since, collect_sync_stats, has_header, pool,
+              staged_file_handle=None, stream=None):
     file_path = file["filepath"]
     LOGGER.info('Syncing file "%s".', file_path)
-    sftp_client = client.connection(config)
     decryption_configs = config.get('decryption_configs')
     file_type = table_spec.get('file_type').lower()
     log_sync_update = config.get('log_sync_update')
@@ -100,13 +275,21 @@ def sync_file(config, file, streams, table_spec, state, modified_since, collect_
     columns_to_update = config.get('columns_to_update')
     columns_to_rename = config.get('columns_to_rename')
 
-    if decryption_configs:
-        helper.update_decryption_key(decryption_configs)
+    # a streamed file has its footer rows held back by the stream itself
+    if stream is None:
+        stream = use_stream(config, file, table_spec, decryption_configs)
+    skip_footer_row = 0 if stream else table_spec.get('skip_footer_row', 0)
+
+    if staged_file_handle is None:
+        if decryption_configs:
+            helper.update_decryption_key(decryption_configs)
+        staged_file_handle = open_file_handle(pool, file, table_spec, decryption_configs, stream)
 
-    with sftp_client.get_file_handle(file, file_type, table_spec.get('encoding'), decryption_configs) as file_handle:
+    # a streamed file is read from the server while it is parsed
+    with staged_file_handle as file_handle, \
+            profiling.timer('parse', file_path, file.get('file_size') if stream else None):
         if file_type in ["csv", "text"]:
             skip_header_row = table_spec.get('skip_header_row', 0)
-            skip_footer_row = table_spec.get('skip_footer_row', 0)
             csv_client = CSVClient(file_path, table_spec.get('table_name'), table_spec.get('key_properties', []),
                                    has_header, collect_stats=collect_sync_stats, log_sync_update=log_sync_update,
                                    log_sync_update_interval=log_sync_update_interval, skip_header_row=skip_header_row, skip_footer_row=skip_footer_row)
@@ -124,7 +307,6 @@ def sync_file(config, file, streams, table_spec, state, modified_since, collect_
                               for stream in streams], state, modified_since)
         elif file_type in ["fwf"]:
             skip_header_row = table_spec.get('skip_header_row', 0)
-            skip_footer_row = table_spec.get('skip_footer_row', 0)
             column_specs = table_spec.get('column_specs')
             # we require column specs in config since discovery in sftp connector is mandatory
             if column_specs is None or len(column_specs) == 0:
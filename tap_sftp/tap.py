@@ -8,6 +8,7 @@ from file_processors.utils.stat_collector import FILE_SYNC_STATS  # type: ignore
 from file_processors.utils.np_encoder import NpEncoder  # type: ignore
 from file_processors.utils.symon_exception import SymonException # type: ignore
 from tap_sftp import discover
+from tap_sftp import profiling
 from tap_sftp import sync
 
 REQUIRED_CONFIG_KEYS = ["username", "port", "host", "tables", "start_date"]
@@ -24,7 +25,11 @@ ERROR_END_MARKER = '[tap_error_end]'
 
 def do_discover(config):
     LOGGER.info("Starting discover")
-    streams = discover.discover_streams(config)
+    profiling.PROFILE.reset()
+    try:
+        streams = discover.discover_streams(config)
+    finally:
+        write_profile(config)
     if not streams:
         raise SymonException('File is empty.', 'EmptyFile')
     catalog = {"streams": streams}
@@ -32,28 +37,52 @@ def do_discover(config):
     LOGGER.info("Finished discover")
 
 
+def write_profile(config):
+    """ Writes the run's phase timings to `profile_path`, if configured. A failure to write it is only logged. """
+    profile_path = config.get('profile_path')
+    if profile_path:
+        try:
+            profiling.PROFILE.write(profile_path)
+        except OSError as ex:
+            LOGGER.warning('Failed to write run profile to "%s": %s', profile_path, ex)
+
+
+def format_seconds(seconds):
+    return f'{seconds:.2f}' if seconds is not None else ''
+
+
 def stream_is_selected(mdata):
     return mdata.get((), {}).get('selected', False)
 
 
 def do_sync(config, catalog, state):
     collect_sync_stats = config.get("show_stats", False)
-    sync.sync_stream(config, catalog, state, collect_sync_stats)
+    profiling.PROFILE.reset()
+    try:
+        sync.sync_stream(config, catalog, state, collect_sync_stats)
+    finally:
+        write_profile(config)
 
     if collect_sync_stats:
         headers = [['table_name',
                     'file path',
                     'row count',
-                    'last_modified']]
+                    'last_modified',
+                    'bytes',
+                    'MB/s'] + [f'{phase} s' for phase in profiling.FILE_PHASES]]
 
         rows = []
 
         for table_name, table_data in FILE_SYNC_STATS.items():
             for filepath, file_data in table_data['files'].items():
+                transferred, mb_per_second, phase_seconds = profiling.PROFILE.file_summary(filepath)
                 rows.append([table_name,
                              filepath,
                              file_data['row_count'],
-                             file_data['last_modified']])
+                             file_data['last_modified'],
+                             transferred,
+                             f'{mb_per_second:.1f}' if mb_per_second is not None else ''] +
+                            [format_seconds(seconds) for seconds in phase_seconds])
 
         data = headers + rows
         table = AsciiTable(data, title='Extraction Summary')
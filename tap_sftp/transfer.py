@@ -0,0 +1,536 @@
+import collections
+import io
+import os
+import socket
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import singer  # type: ignore
+from paramiko.ssh_exception import SSHException  # type: ignore
+from tap_sftp import defaults
+
+LOGGER = singer.get_logger()
+
+# Errors of a dropped connection, after which a download is resumed over a new one
+RESUMABLE_ERRORS = (EOFError, SSHException, ConnectionError, socket.timeout)
+
+
+class FileChangedError(IOError):
+    """ Raised when a remote file's size changed while it was downloaded, so the local copy mixes two versions. """
+
+
+class SegmentedDownloader():
+    """
+    Downloads a single remote file as byte ranges fetched concurrently over several SFTP sessions. Each range is read
+    with pipelined positioned reads and written straight into a preallocated local file at its offset. Once every
+    range has started, a range running much longer than the ranges already finished is re-requested on another
+    session, and whichever copy finishes first wins. A file found to extend past the last range once they are all
+    written raises FileChangedError rather than leaving a truncated copy.
+    """
+
+    def __init__(self, sessions, concurrency, segment_size, chunk_size=None, hedge_after_factor=None,
+                 max_prefetch_requests=None, transfer_progress=None):
+        self.sessions = sessions
+        self.concurrency = concurrency
+        self.segment_size = segment_size
+        self.chunk_size = chunk_size or defaults.DOWNLOAD_CHUNK_SIZE
+        self.hedge_after_factor = hedge_after_factor or defaults.DOWNLOAD_HEDGE_AFTER_FACTOR
+        self.max_prefetch_requests = max_prefetch_requests or defaults.DOWNLOAD_MAX_PREFETCH_REQUESTS
+        self.hedged_segments = 0
+        # bytes of each segment written so far, counted from the segment's start
+        self.progress = {}
+        self.progress_lock = threading.Lock()
+        self.transfer_progress = transfer_progress
+
+    def split(self, file_size):
+        return [(offset, min(self.segment_size, file_size - offset))
+                for offset in range(0, file_size, self.segment_size)]
+
+    def download(self, remote_path, local_path, file_size, resume=False):
+        """
+        Downloads the file into local_path. With `resume` the local file is kept and only the bytes not written by
+        an earlier, interrupted call are fetched, possibly over new sessions.
+        """
+        if resume:
+            segments = [segment for segment in self.split(file_size) if self.progress.get(segment, 0) < segment[1]]
+            LOGGER.info('Resuming download of "%s": %s of %s bytes left in %s segments', remote_path,
+                        file_size - sum(self.progress.values()), file_size, len(segments))
+        else:
+            segments = self.split(file_size)
+            self.progress = {}
+            LOGGER.info('Downloading "%s" (%s bytes) as %s segments over up to %s sessions',
+                        remote_path, file_size, len(segments), self.concurrency)
+            with open(local_path, 'wb') as local_file:
+                local_file.truncate(file_size)
+
+        fd = os.open(local_path, os.O_WRONLY)
+        try:
+            self.fetch_segments(remote_path, fd, segments)
+        finally:
+            os.close(fd)
+        self.check_end(remote_path, file_size)
+
+    def check_end(self, remote_path, file_size):
+        """ Raises FileChangedError when the remote file has bytes past file_size, which no segment covered. """
+        with self.sessions.checkout() as session, session.open(remote_path, 'rb') as remote_file:
+            remote_file.seek(file_size)
+            if remote_file.read(1):
+                raise FileChangedError(
+                    f'size mismatch in segmented download of {remote_path}: the file grew past {file_size} bytes')
+
+    def fetch_segments(self, remote_path, fd, segments):
+        done = {segment: threading.Event() for segment in segments}
+        started = {}
+        durations = []
+        hedged = set()
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            running = {executor.submit(self.fetch_segment, remote_path, fd, segment, done[segment], started): segment
+                       for segment in segments}
+            try:
+                while not all(event.is_set() for event in done.values()):
+                    finished, _ = wait(running, timeout=defaults.DOWNLOAD_POLL_INTERVAL,
+                                       return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        segment = running.pop(future)
+                        try:
+                            duration = future.result()
+                        except Exception:
+                            # the hedged copy of this segment may still complete it
+                            if done[segment].is_set() or any(s == segment for s in running.values()):
+                                continue
+                            raise
+                        if duration is not None:
+                            durations.append(duration)
+
+                    for segment in self.segments_to_hedge(running, started, durations, hedged, done):
+                        LOGGER.info('Segment at offset %s of "%s" is slow, re-requesting it', segment[0], remote_path)
+                        hedged.add(segment)
+                        self.hedged_segments += 1
+                        running[executor.submit(self.fetch_segment, remote_path, fd, segment, done[segment],
+                                                {})] = segment
+            finally:
+                # stop any hedged copies still running, and every other segment when one failed
+                for future in running:
+                    future.cancel()
+                for event in done.values():
+                    event.set()
+
+    def segments_to_hedge(self, running, started, durations, hedged, done):
+        # hedge only in the tail, when every segment has started and some sessions are idle
+        in_flight = [segment for segment in running.values() if not done[segment].is_set()]
+        if not durations or len(in_flight) >= self.concurrency or len(started) < len(done):
+            return []
+        threshold = statistics.median(durations) * self.hedge_after_factor
+        now = time.monotonic()
+        slow = [segment for segment in in_flight
+                if segment not in hedged and now - started.get(segment, now) > threshold]
+        return slow[:self.concurrency - len(in_flight)]
+
+    def fetch_segment(self, remote_path, fd, segment, done, started):
+        """
+        Fetches the part of one segment not written yet into the local file, returning how long it took or None if
+        another copy won.
+        """
+        offset, length = segment
+        with self.sessions.checkout() as session:
+            if done.is_set():
+                return None
+            start = time.monotonic()
+            started.setdefault(segment, start)
+            with self.progress_lock:
+                first = offset + self.progress.get(segment, 0)
+            chunks = [(position, min(self.chunk_size, offset + length - position))
+                      for position in range(first, offset + length, self.chunk_size)]
+            received = first
+            with session.open(remote_path, 'rb') as remote_file:
+                for (position, _), data in zip(chunks, remote_file.readv(chunks, self.max_prefetch_requests)):
+                    if done.is_set():
+                        return None
+                    if position != received:
+                        # a short chunk leaves a gap
+                        break
+                    os.pwrite(fd, data, position)
+                    received += len(data)
+                    with self.progress_lock:
+                        self.progress[segment] = max(self.progress.get(segment, 0), received - offset)
+                        written = sum(self.progress.values())
+                    if self.transfer_progress:
+                        self.transfer_progress.update(written)
+            if received != offset + length:
+                raise IOError(
+                    f'size mismatch in segmented download of {remote_path}: {received - offset} != {length} bytes '
+                    f'at offset {offset}')
+            done.set()
+            return time.monotonic() - start
+
+
+class SequentialDownloader():
+    """
+    Downloads a remote file front to back into a local file with paramiko's prefetch. The bytes written so far are
+    kept in `offset`, so a download interrupted by a dropped connection continues from there with `download` over a
+    new connection. `callback(offset, file_size)` is called after every chunk written.
+    """
+
+    def __init__(self, chunk_size=None, callback=None, transfer_progress=None):
+        self.chunk_size = chunk_size or defaults.DOWNLOAD_CHUNK_SIZE
+        self.callback = callback
+        self.transfer_progress = transfer_progress
+        self.offset = 0
+
+    def download(self, sftp, remote_path, local_path, file_size, resume=False):
+        if not resume:
+            self.offset = 0
+        with sftp.open(remote_path, 'rb') as remote_file, \
+                open(local_path, 'r+b' if resume else 'wb') as local_file:
+            # anything past the offset was not confirmed written
+            local_file.truncate(self.offset)
+            local_file.seek(self.offset)
+            remote_file.seek(self.offset)
+            remote_file.prefetch(file_size)
+            while True:
+                data = remote_file.read(self.chunk_size)
+                if not data:
+                    break
+                local_file.write(data)
+                self.offset += len(data)
+                if self.transfer_progress:
+                    self.transfer_progress.update(self.offset)
+                if self.callback:
+                    # the callback may hand the written bytes to a reader of the local file
+                    local_file.flush()
+                    self.callback(self.offset, file_size)
+        if self.offset != file_size:
+            raise FileChangedError(f'size mismatch in download of {remote_path}: {self.offset} != {file_size} bytes')
+
+
+class RemoteRangeFile(io.RawIOBase):
+    """
+    Seekable, read-only view of a remote file for zipfile and the decompressors. Reads are served from `block_size`
+    blocks fetched with a single pipelined `readv`, so sampling the start of a file or reading a zip central directory
+    costs a few round trips rather than one per small read. `bytes_read` counts the bytes transferred.
+    """
+
+    def __init__(self, remote_file, size, block_size=None, transfer_progress=None):
+        super().__init__()
+        self.remote_file = remote_file
+        self.size = size
+        self.block_size = block_size or defaults.RANGE_READ_BLOCK_SIZE
+        self.transfer_progress = transfer_progress
+        self.position = 0
+        self.block_offset = 0
+        self.block = b''
+        self.bytes_read = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.position = max(offset, 0)
+        return self.position
+
+    def readinto(self, b):
+        if self.position >= self.size:
+            return 0
+        if not self.block_offset <= self.position < self.block_offset + len(self.block):
+            self.fetch(self.position, max(len(b), self.block_size))
+        start = self.position - self.block_offset
+        data = self.block[start:start + len(b)]
+        b[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+    def fetch(self, offset, length):
+        # reads near the end take the whole last block, which usually holds the entire central directory
+        offset = max(0, min(offset, self.size - length))
+        length = min(length, self.size - offset)
+        self.block = b''.join(self.remote_file.readv([(offset, length)]))
+        self.block_offset = offset
+        self.bytes_read += len(self.block)
+        if self.transfer_progress:
+            self.transfer_progress.add(len(self.block))
+
+
+class PipelinedReader(io.RawIOBase):
+    """
+    Reads a remote file front to back for a slow consumer such as gpg. Up to `max_blocks` blocks of `block_size`
+    bytes are fetched ahead over `concurrency` sessions while the consumer works through earlier ones, so network
+    reads and decryption overlap in a bounded amount of memory. `wait_seconds` is the time the consumer spent waiting
+    for the network and `ready_blocks` counts the blocks that had already arrived when it asked for them. `error` is
+    the read error raised to the consumer, kept for its caller as gpg may end without surfacing it.
+    """
+
+    def __init__(self, sessions, remote_path, size, block_size=None, concurrency=None, max_blocks=None,
+                 transfer_progress=None):
+        super().__init__()
+        self.sessions = sessions
+        self.transfer_progress = transfer_progress
+        self.remote_path = remote_path
+        self.size = size
+        self.block_size = block_size or defaults.DECRYPT_BLOCK_SIZE
+        self.offsets = iter(range(0, size, self.block_size))
+        self.pending = collections.deque()
+        self.buffer = b''
+        self.bytes_read = 0
+        self.blocks = 0
+        self.ready_blocks = 0
+        self.wait_seconds = 0
+        self.error = None
+        self.started = time.monotonic()
+        self.executor = ThreadPoolExecutor(max_workers=concurrency or defaults.DECRYPT_READ_CONCURRENCY)
+        for _ in range(max_blocks or defaults.DECRYPT_MAX_BLOCKS):
+            self.fetch_next()
+
+    def fetch_next(self):
+        offset = next(self.offsets, None)
+        if offset is not None:
+            self.pending.append(self.executor.submit(self.fetch_block, offset,
+                                                     min(self.block_size, self.size - offset)))
+
+    def fetch_block(self, offset, length):
+        chunks = [(position, min(defaults.DOWNLOAD_CHUNK_SIZE, offset + length - position))
+                  for position in range(offset, offset + length, defaults.DOWNLOAD_CHUNK_SIZE)]
+        with self.sessions.checkout() as session, session.open(self.remote_path, 'rb') as remote_file:
+            block = b''.join(remote_file.readv(chunks, defaults.DOWNLOAD_MAX_PREFETCH_REQUESTS))
+        if len(block) != length:
+            raise IOError(
+                f'size mismatch in pipelined read of {self.remote_path}: {len(block)} != {length} bytes at offset {offset}')
+        if self.transfer_progress:
+            self.transfer_progress.add(length)
+        return block
+
+    def next_block(self):
+        if not self.pending:
+            return b''
+        future = self.pending.popleft()
+        if future.done():
+            self.ready_blocks += 1
+        else:
+            start = time.monotonic()
+            wait([future])
+            self.wait_seconds += time.monotonic() - start
+        try:
+            block = future.result()
+        except Exception as ex:
+            self.error = ex
+            raise
+        self.blocks += 1
+        self.bytes_read += len(block)
+        self.fetch_next()
+        return block
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if not self.buffer:
+            self.buffer = self.next_block()
+        size = min(len(b), len(self.buffer))
+        b[:size] = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return size
+
+    def report(self):
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        LOGGER.info('Read "%s" for decryption: %s bytes at %.1f MB/s, waited %.2fs of %.2fs for the network, '
+                    '%s of %s blocks ready before they were needed',
+                    self.remote_path, self.bytes_read, self.bytes_read / elapsed / 1024 / 1024, self.wait_seconds,
+                    elapsed, self.ready_blocks, self.blocks)
+
+    def close(self):
+        if not self.closed:
+            for future in self.pending:
+                future.cancel()
+            self.executor.shutdown(wait=True)
+            self.report()
+        super().close()
+
+
+class TransferCancelledError(IOError):
+    """ Raised in a download whose local file is no longer read, to end it early. """
+
+
+class FollowingFileReader(io.RawIOBase):
+    """
+    Reads a local file while it is still being downloaded, never past the bytes downloaded so far, so a consumer
+    such as gpg can start as soon as the first bytes arrive instead of after the whole download. The download
+    reports its progress through `progress` and its end through `finish`. Once the reader is closed, `progress`
+    raises TransferCancelledError to stop a download nobody reads any more. `wait_seconds` is the time the consumer
+    spent waiting for the download.
+    """
+
+    def __init__(self, local_path):
+        super().__init__()
+        self.local_path = local_path
+        self.local_file = open(local_path, 'rb')
+        self.condition = threading.Condition()
+        self.available = 0
+        self.finished = False
+        self.cancelled = False
+        self.error = None
+        self.bytes_read = 0
+        self.wait_seconds = 0
+        self.started = time.monotonic()
+
+    def progress(self, transferred, total=None):
+        with self.condition:
+            if self.cancelled:
+                raise TransferCancelledError(f'{self.local_path} is no longer read, stopping its download')
+            self.available = transferred
+            self.condition.notify_all()
+
+    def finish(self, error=None):
+        with self.condition:
+            self.finished = True
+            self.error = error
+            self.condition.notify_all()
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        with self.condition:
+            if self.bytes_read >= self.available and not self.finished:
+                start = time.monotonic()
+                while self.bytes_read >= self.available and not self.finished:
+                    self.condition.wait()
+                self.wait_seconds += time.monotonic() - start
+            if self.error:
+                raise self.error
+            size = min(len(b), self.available - self.bytes_read)
+        if size <= 0:
+            return 0
+        size = self.local_file.readinto(memoryview(b)[:size])
+        self.bytes_read += size
+        return size
+
+    def report(self):
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        LOGGER.info('Read "%s" for decryption while downloading: %s bytes at %.1f MB/s, waited %.2fs of %.2fs for '
+                    'the download', self.local_path, self.bytes_read, self.bytes_read / elapsed / 1024 / 1024,
+                    self.wait_seconds, elapsed)
+
+    def close(self):
+        if not self.closed:
+            with self.condition:
+                self.cancelled = not self.finished
+            self.local_file.close()
+            self.report()
+        super().close()
+
+
+class TransferStalledError(IOError):
+    """ Raised for a transfer aborted by its watchdog because no bytes arrived for too long. """
+
+
+class TransferProgress():
+    """
+    Reports the progress of one transfer. Used as a context manager, it runs a watchdog thread that logs the bytes
+    transferred so far, the current and average MB/s and the ETA every `interval` seconds, also while no bytes
+    arrive, so a slow link can be told apart from a hung transfer. When nothing arrives for `stall_timeout` seconds
+    the transfer is flagged as stalled, and with `abort_on_stall` the `abort` callback is called to break the
+    blocked reads, and the error they fail with leaves the context as a TransferStalledError.
+
+    The transfer reports bytes with `update(transferred)` for a running total or `add(size)` for increments.
+    """
+
+    def __init__(self, label, total=None, interval=None, stall_timeout=None, abort_on_stall=False, abort=None):
+        self.label = label
+        self.total = total
+        self.interval = interval or defaults.PROGRESS_INTERVAL
+        self.stall_timeout = stall_timeout
+        self.abort_on_stall = abort_on_stall
+        self.abort = abort
+        self.transferred = 0
+        self.stalled = False
+        self.aborted = False
+        self.reported = False
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.started = self.last_progress = time.monotonic()
+        self.last_report = (self.started, 0)
+
+    def __enter__(self):
+        self.started = self.last_progress = time.monotonic()
+        self.last_report = (self.started, 0)
+        self.thread = threading.Thread(target=self.watch, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stopped.set()
+        self.thread.join()
+        if self.aborted and exc_value is not None:
+            raise TransferStalledError(f'transfer of {self.label} aborted after no bytes arrived for '
+                                       f'{self.stall_timeout}s') from exc_value
+        # short transfers finish before their first report and stay quiet
+        if self.reported:
+            elapsed = max(time.monotonic() - self.started, 1e-9)
+            LOGGER.info('Transferred %s bytes of "%s" in %.1fs at %.1f MB/s', self.transferred, self.label, elapsed,
+                        self.transferred / elapsed / 1024 / 1024)
+
+    def update(self, transferred):
+        with self.lock:
+            if transferred != self.transferred:
+                self.transferred = transferred
+                self.last_progress = time.monotonic()
+
+    def add(self, size):
+        with self.lock:
+            self.transferred += size
+            self.last_progress = time.monotonic()
+
+    def watch(self):
+        tick = min(1, self.interval, self.stall_timeout or self.interval)
+        while not self.stopped.wait(tick):
+            now = time.monotonic()
+            if now - self.last_report[0] >= self.interval:
+                self.report(now)
+            self.check_stall(now)
+
+    def report(self, now):
+        with self.lock:
+            transferred = self.transferred
+        last_time, last_transferred = self.last_report
+        current = max(transferred - last_transferred, 0) / max(now - last_time, 1e-9) / 1024 / 1024
+        average = transferred / max(now - self.started, 1e-9) / 1024 / 1024
+        if self.total and average > 0:
+            eta = f'{(self.total - transferred) / 1024 / 1024 / average:.0f}s'
+        else:
+            eta = 'unknown'
+        LOGGER.info('Transferring "%s": %s of %s bytes, %.1f MB/s now, %.1f MB/s average, ETA %s', self.label,
+                    transferred, self.total if self.total is not None else 'unknown', current, average, eta)
+        self.last_report = (now, transferred)
+        self.reported = True
+
+    def check_stall(self, now):
+        with self.lock:
+            idle = now - self.last_progress
+        if not self.stall_timeout or idle < self.stall_timeout:
+            if self.stalled:
+                LOGGER.info('Transfer of "%s" is making progress again', self.label)
+                self.stalled = False
+            return
+        if self.stalled:
+            return
+        self.stalled = True
+        if self.abort_on_stall and self.abort is not None:
+            LOGGER.warning('Transfer of "%s" stalled: no bytes for %.0fs at %s bytes, aborting it', self.label,
+                           idle, self.transferred)
+            self.aborted = True
+            self.abort()
+        else:
+            LOGGER.warning('Transfer of "%s" stalled: no bytes for %.0fs at %s bytes', self.label, idle,
+                           self.transferred)
@@ -0,0 +1,58 @@
+import json
+import os
+import platform
+import time
+import pytest
+
+THRESHOLDS_PATH = os.path.join(os.path.dirname(__file__), 'thresholds.json')
+
+
+class BenchmarkResults():
+    """
+    Collects the timings of a benchmark run and writes them to `path` as JSON, next to the threshold of each
+    benchmark from thresholds.json. Thresholds are upper bounds in seconds, multiplied by `factor` so slower
+    machines can scale them instead of editing the file.
+    """
+
+    def __init__(self, path, thresholds_path=THRESHOLDS_PATH, factor=1.0):
+        self.path = path
+        self.factor = factor
+        with open(thresholds_path, 'r', encoding='utf-8') as thresholds_file:
+            self.thresholds = json.load(thresholds_file)
+        self.results = []
+
+    def record(self, name, seconds, **details):
+        """ Records a timing and returns whether it is within the benchmark's threshold. """
+        threshold = self.thresholds.get(name)
+        max_seconds = threshold * self.factor if threshold is not None else None
+        passed = max_seconds is None or seconds <= max_seconds
+        self.results.append(dict({'name': name, 'seconds': round(seconds, 4), 'max_seconds': max_seconds,
+                                  'passed': passed}, **details))
+        print(f'\n{name}: {seconds:.3f}s (max {max_seconds}s) {details}')
+        return passed
+
+    def write(self):
+        data = {
+            'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'threshold_factor': self.factor,
+            'results': self.results
+        }
+        with open(self.path, 'w', encoding='utf-8') as results_file:
+            json.dump(data, results_file, indent=2)
+
+
+@pytest.fixture(scope='session')
+def benchmark_results():
+    results = BenchmarkResults(os.environ.get('TAP_SFTP_BENCHMARK_RESULTS', 'benchmark-results.json'),
+                               factor=float(os.environ.get('TAP_SFTP_BENCHMARK_THRESHOLD_FACTOR', 1)))
+    yield results
+    if results.results:
+        results.write()
+
+
+def timed(function, *args, **kwargs):
+    start = time.monotonic()
+    result = function(*args, **kwargs)
+    return result, time.monotonic() - start
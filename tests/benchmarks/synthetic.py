@@ -0,0 +1,123 @@
+import gzip
+import os
+import shutil
+import subprocess
+import zipfile
+from xml.sax.saxutils import escape
+
+CITIES = ['Montréal', 'Zürich', 'São Paulo', 'Kraków', 'Reykjavík', 'Toronto', 'Lyon', 'Malmö']
+HEADER = ['id', 'customer', 'city', 'amount', 'created_at']
+FWF_WIDTHS = [10, 16, 12, 12, 12]
+GPG_PASSPHRASE = 'benchmark'
+
+MAIN_NS = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+REL_NS = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+PACKAGE_REL_NS = 'http://schemas.openxmlformats.org/package/2006/relationships'
+CONTENT_TYPES = ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                 '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+                 '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+                 '<Default Extension="xml" ContentType="application/xml"/>'
+                 '<Override PartName="/xl/workbook.xml" '
+                 'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+                 '<Override PartName="/xl/worksheets/sheet1.xml" '
+                 'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+                 '</Types>')
+
+
+def rows(count):
+    """ Yields `count` deterministic order rows, with non-ascii text so encoding detection has work to do. """
+    for i in range(count):
+        yield [str(i), f'customer_{i % 1000}', CITIES[i % len(CITIES)], f'{i % 500}.{i % 100:02d}',
+               f'2024-{i % 12 + 1:02d}-{i % 28 + 1:02d}']
+
+
+def csv_bytes(count):
+    lines = [','.join(HEADER)] + [','.join(row) for row in rows(count)]
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+def fwf_bytes(count):
+    lines = [''.join(value.ljust(width) for value, width in zip(row, FWF_WIDTHS))
+             for row in [HEADER] + list(rows(count))]
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+def write_csv(path, count):
+    with open(path, 'wb') as f:
+        f.write(csv_bytes(count))
+
+
+def write_fwf(path, count):
+    with open(path, 'wb') as f:
+        f.write(fwf_bytes(count))
+
+
+def write_gzip(path, data):
+    with gzip.open(path, 'wb', compresslevel=6) as f:
+        f.write(data)
+
+
+def write_zip(path, name, data):
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr(name, data)
+
+
+def write_xlsx(path, count):
+    """ Writes a single-worksheet xlsx of `count` rows plus a header, with inline strings and numeric amounts. """
+    def cell(ref, value, numeric=False):
+        if numeric:
+            return f'<c r="{ref}"><v>{value}</v></c>'
+        return f'<c r="{ref}" t="inlineStr"><is><t>{escape(value)}</t></is></c>'
+
+    def row(r, values):
+        cells = ''.join(cell(f'{"ABCDE"[i]}{r}', value, r > 1 and i == 3) for i, value in enumerate(values))
+        return f'<row r="{r}">{cells}</row>'
+
+    sheet_rows = [row(1, HEADER)] + [row(r, values) for r, values in enumerate(rows(count), 2)]
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as workbook:
+        workbook.writestr('[Content_Types].xml', CONTENT_TYPES)
+        workbook.writestr('_rels/.rels', f'<Relationships xmlns="{PACKAGE_REL_NS}"><Relationship Id="rId1" '
+                          f'Type="{REL_NS}/officeDocument" Target="xl/workbook.xml"/></Relationships>')
+        workbook.writestr('xl/workbook.xml', f'<workbook xmlns="{MAIN_NS}" xmlns:r="{REL_NS}"><sheets>'
+                          f'<sheet name="orders" sheetId="1" r:id="rId1"/></sheets></workbook>')
+        workbook.writestr('xl/_rels/workbook.xml.rels', f'<Relationships xmlns="{PACKAGE_REL_NS}">'
+                          f'<Relationship Id="rId1" Type="{REL_NS}/worksheet" Target="worksheets/sheet1.xml"/>'
+                          f'</Relationships>')
+        workbook.writestr('xl/worksheets/sheet1.xml', f'<worksheet xmlns="{MAIN_NS}"><dimension ref="A1:E{count + 1}"/>'
+                          f'<sheetData>{"".join(sheet_rows)}</sheetData></worksheet>')
+
+
+def has_gpg():
+    return shutil.which('gpg') is not None
+
+
+def gpg(gnupghome, *args, data=None):
+    return subprocess.run(['gpg', '--homedir', str(gnupghome), '--batch', '--yes', '--pinentry-mode', 'loopback',
+                           '--passphrase', GPG_PASSPHRASE, *args], input=data, check=True, capture_output=True).stdout
+
+
+def generate_gpg_key(gnupghome):
+    """ Generates a key pair in gnupghome and returns its armored private key, protected by GPG_PASSPHRASE. """
+    os.makedirs(gnupghome, mode=0o700, exist_ok=True)
+    gpg(gnupghome, '--quick-gen-key', 'tap-sftp-benchmark@example.com', 'rsa2048', 'encrypt', 'never')
+    return gpg(gnupghome, '--armor', '--export-secret-keys', 'tap-sftp-benchmark@example.com').decode('ascii')
+
+
+def write_gpg(path, data, gnupghome):
+    with open(path, 'wb') as f:
+        f.write(gpg(gnupghome, '--trust-model', 'always', '--encrypt', '--recipient',
+                    'tap-sftp-benchmark@example.com', data=data))
+
+
+def build_tree(root, directories, subdirectories, files_per_directory):
+    """ Builds directories/subdirectories of small csv files under root, for listing benchmarks. """
+    count = 0
+    for d in range(directories):
+        for s in range(subdirectories):
+            directory = os.path.join(root, f'dir_{d:03d}', f'sub_{s:03d}')
+            os.makedirs(directory)
+            for i in range(files_per_directory):
+                with open(os.path.join(directory, f'file_{i:04d}.csv'), 'wb') as f:
+                    f.write(b'id,value\n1,a\n')
+                count += 1
+    return count
@@ -0,0 +1,47 @@
+import filecmp
+import os
+import time
+import pytest
+from tap_sftp.client import connection
+from tests.configuration.sftp_server import LocalSFTPServerRunner
+
+pytestmark = pytest.mark.skipif(not os.environ.get('TAP_SFTP_BENCHMARK'),
+                                reason='set TAP_SFTP_BENCHMARK=1 to run benchmarks against a local SFTP server')
+
+FILE_SIZE = 64 * 1024 * 1024
+LATENCY = 0.002
+
+
+@pytest.fixture(scope='module')
+def remote_root(tmp_path_factory):
+    root = tmp_path_factory.mktemp('remote')
+    with open(root / 'large.bin', 'wb') as f:
+        f.write(os.urandom(FILE_SIZE))
+    return root
+
+
+def timed_download(config, f, local_path):
+    conn = connection(config)
+    try:
+        start = time.monotonic()
+        conn.download(f, local_path)
+        return time.monotonic() - start
+    finally:
+        conn.close()
+
+
+def test_segmented_download_against_sftp_get(remote_root, tmp_path):
+    """Benchmark -
+            Downloads a 64 MB file from a local SFTP server adding latency to every request, once with a single
+            `sftp.get` and once split into concurrent segments, and checks both copies are byte-identical."""
+    f = {'filepath': '/large.bin', 'file_size': FILE_SIZE}
+    with LocalSFTPServerRunner(str(remote_root), latency=LATENCY) as server:
+        single_seconds = timed_download(server.config(download_concurrency=1), f, str(tmp_path / 'single.bin'))
+        segmented_seconds = timed_download(server.config(download_concurrency=4, download_segment_size=8 * 1024 * 1024),
+                                           f, str(tmp_path / 'segmented.bin'))
+
+    print(f'\nsftp.get: {single_seconds:.2f}s, segmented: {segmented_seconds:.2f}s '
+          f'({FILE_SIZE / 1024 / 1024 / segmented_seconds:.1f} MB/s)')
+    assert filecmp.cmp(remote_root / 'large.bin', tmp_path / 'single.bin', shallow=False)
+    assert filecmp.cmp(remote_root / 'large.bin', tmp_path / 'segmented.bin', shallow=False)
+    assert segmented_seconds < single_seconds
@@ -0,0 +1,33 @@
+import os
+import time
+import pytest
+from tap_sftp import encoding_detection
+
+pytestmark = pytest.mark.skipif(not os.environ.get('TAP_SFTP_BENCHMARK'),
+                                reason='set TAP_SFTP_BENCHMARK=1 to run benchmarks against a local SFTP server')
+
+FILE_SIZES = [8 * 1024 * 1024, 64 * 1024 * 1024, 256 * 1024 * 1024]
+ROW = 'id,name,city\n1,Zoë,Montréal\n'.encode('utf-8')
+
+
+def timed_detection(path):
+    start = time.monotonic()
+    encoding = encoding_detection.detect_encoding(encoding_detection.leading_bytes_of(path))
+    return encoding, time.monotonic() - start
+
+
+def test_encoding_detection_time_is_flat(tmp_path):
+    """Benchmark -
+            Detects the encoding of utf-8 csv files of growing size and checks the detection time stays flat, as
+            only a bounded leading window of each file is read."""
+    seconds = []
+    for file_size in FILE_SIZES:
+        path = tmp_path / f'{file_size}.csv'
+        with open(path, 'wb') as f:
+            f.write(ROW * (file_size // len(ROW)))
+        encoding, elapsed = timed_detection(str(path))
+        os.remove(path)
+        seconds.append(elapsed)
+        print(f'\n{file_size // 1024 // 1024} MB: {encoding} in {elapsed:.3f}s')
+
+    assert seconds[-1] < 3 * seconds[0] + 0.1
@@ -0,0 +1,164 @@
+import os
+import re
+import pytest
+import singer  # type: ignore
+from singer.catalog import Catalog  # type: ignore
+from tap_sftp import discover, sync
+from tap_sftp.client import connection
+from tests.benchmarks import synthetic
+from tests.benchmarks.results import benchmark_results, timed
+from tests.configuration.sftp_server import LocalSFTPServerRunner
+
+pytestmark = pytest.mark.skipif(not os.environ.get('TAP_SFTP_BENCHMARK'),
+                                reason='set TAP_SFTP_BENCHMARK=1 to run benchmarks against a local SFTP server')
+
+# Network emulated by the local server: seconds added to every request, bytes served per second, channels per
+# connection
+LATENCY = float(os.environ.get('TAP_SFTP_BENCHMARK_LATENCY', 0.002))
+BANDWIDTH = int(os.environ.get('TAP_SFTP_BENCHMARK_BANDWIDTH', 100 * 1024 * 1024))
+MAX_SESSIONS = int(os.environ.get('TAP_SFTP_BENCHMARK_MAX_SESSIONS', 4))
+
+ROWS = 200000
+XLSX_ROWS = 20000
+TREE = (10, 10, 20)
+
+FILES = [
+    ('orders.csv', 'csv'),
+    ('orders.fwf', 'fwf'),
+    ('orders.xlsx', 'excel'),
+    ('orders.csv.gz', 'csv'),
+    ('orders.csv.zip', 'csv'),
+    ('orders.csv.gpg', 'csv'),
+]
+
+
+@pytest.fixture(scope='module')
+def remote_root(tmp_path_factory):
+    root = tmp_path_factory.mktemp('remote')
+    synthetic.build_tree(str(root / 'tree'), *TREE)
+    data = root / 'data'
+    data.mkdir()
+    csv_data = synthetic.csv_bytes(ROWS)
+    with open(data / 'orders.csv', 'wb') as f:
+        f.write(csv_data)
+    synthetic.write_fwf(data / 'orders.fwf', ROWS)
+    synthetic.write_xlsx(data / 'orders.xlsx', XLSX_ROWS)
+    synthetic.write_gzip(data / 'orders.csv.gz', csv_data)
+    synthetic.write_zip(data / 'orders.csv.zip', 'orders.csv', csv_data)
+    return root
+
+
+@pytest.fixture(scope='module')
+def decryption_configs(remote_root, tmp_path_factory):
+    if not synthetic.has_gpg():
+        return None
+    sender_gnupghome = tmp_path_factory.mktemp('sender_gnupg')
+    key = synthetic.generate_gpg_key(sender_gnupghome)
+    synthetic.write_gpg(remote_root / 'data' / 'orders.csv.gpg', synthetic.csv_bytes(ROWS), sender_gnupghome)
+    return {'key': key, 'passphrase': synthetic.GPG_PASSPHRASE,
+            'gnupghome': str(tmp_path_factory.mktemp('gnupg'))}
+
+
+@pytest.fixture(scope='module')
+def server(remote_root):
+    with LocalSFTPServerRunner(str(remote_root), latency=LATENCY, bandwidth=BANDWIDTH,
+                               max_sessions=MAX_SESSIONS) as runner:
+        yield runner
+
+
+@pytest.fixture
+def conn(server):
+    sftp_conn = connection(server.config())
+    yield sftp_conn
+    sftp_conn.close()
+
+
+def file_dict(remote_root, name):
+    local_path = remote_root / 'data' / name
+    stat = os.stat(local_path)
+    return {'filepath': f'/data/{name}', 'file_size': stat.st_size,
+            'last_modified': singer.utils.strptime_to_utc('2024-01-01T00:00:00Z')}
+
+
+def file_configs(name, decryption_configs):
+    if name.endswith('.gpg'):
+        if decryption_configs is None:
+            pytest.skip('gpg is not installed')
+        return decryption_configs
+    return None
+
+
+def drain(handle):
+    with handle:
+        if 'b' in getattr(handle, 'mode', 'b'):
+            while handle.read(1024 * 1024):
+                pass
+        else:
+            for _ in handle:
+                pass
+
+
+def test_get_files_by_prefix(conn, benchmark_results):
+    """Benchmark -
+            Lists a tree of 2000 files in 100 subdirectories over the emulated network."""
+    files, seconds = timed(conn.get_files_by_prefix, '/tree')
+    assert len(files) == TREE[0] * TREE[1] * TREE[2]
+    assert benchmark_results.record('get_files_by_prefix', seconds, files=len(files))
+
+
+@pytest.mark.parametrize('name, file_type', FILES)
+def test_get_file_handle(conn, remote_root, decryption_configs, benchmark_results, name, file_type):
+    """Benchmark -
+            Downloads, decompresses or decrypts each synthetic file with get_file_handle and reads it to the end."""
+    configs = file_configs(name, decryption_configs)
+    f = file_dict(remote_root, name)
+    handle, seconds = timed(conn.get_file_handle, f, file_type, None, configs)
+    _, read_seconds = timed(drain, handle)
+    assert benchmark_results.record(f'get_file_handle[{name}]', seconds + read_seconds, bytes=f['file_size'],
+                                    mb_per_second=round(f['file_size'] / 1024 / 1024 / (seconds + read_seconds), 2))
+
+
+@pytest.mark.parametrize('name, file_type', [(name, file_type) for name, file_type in FILES if file_type != 'excel'])
+def test_get_file_handle_for_sample(conn, remote_root, decryption_configs, benchmark_results, name, file_type):
+    """Benchmark -
+            Samples the leading records of each synthetic file with get_file_handle_for_sample, which should not read
+            much more of the file than the sample."""
+    configs = file_configs(name, decryption_configs)
+    f = file_dict(remote_root, name)
+    handle, seconds = timed(conn.get_file_handle_for_sample, f, file_type, None, configs, 1001)
+    drain(handle)
+    assert benchmark_results.record(f'get_file_handle_for_sample[{name}]', seconds, bytes=f['file_size'])
+
+
+def tables_config(server, decryption=False):
+    tables = [{'table_name': re.sub(r'\W', '_', name), 'search_prefix': '/data', 'search_pattern': re.escape(name),
+               'file_type': file_type, 'has_header': True, 'key_properties': [], 'delimiter': ','}
+              for name, file_type in FILES if not name.endswith('.gpg') or decryption]
+    return server.config(tables=tables, start_date='2000-01-01T00:00:00Z', search_subdirectories=False)
+
+
+def test_discover_streams(server, benchmark_results):
+    """Benchmark -
+            Discovers a table for each unencrypted synthetic file, sampling each one over the emulated network."""
+    config = tables_config(server)
+    streams, seconds = timed(discover.discover_streams, config)
+    assert len(streams) == len(config['tables'])
+    assert benchmark_results.record('discover_streams', seconds, streams=len(streams))
+
+
+def test_sync_stream(server, benchmark_results, capsys):
+    """Benchmark -
+            Syncs every discovered stream end to end and checks each table emitted all of its rows."""
+    config = tables_config(server)
+    streams = discover.discover_streams(config)
+    for stream in streams:
+        for entry in stream['metadata']:
+            if not entry['breadcrumb']:
+                entry['metadata']['selected'] = True
+    catalog = Catalog.from_dict({'streams': streams})
+    capsys.readouterr()
+
+    _, seconds = timed(sync.sync_stream, config, catalog, {})
+    records = [line for line in capsys.readouterr().out.splitlines() if line.startswith('{"type": "RECORD"')]
+    assert len(records) == 4 * ROWS + XLSX_ROWS
+    assert benchmark_results.record('sync_stream', seconds, records=len(records))
@@ -0,0 +1,74 @@
+import os
+import re
+import pytest
+from tap_sftp.matching import TableMatcher
+from tests.benchmarks.results import benchmark_results, timed
+
+pytestmark = pytest.mark.skipif(not os.environ.get('TAP_SFTP_BENCHMARK'),
+                                reason='set TAP_SFTP_BENCHMARK=1 to run benchmarks against a local SFTP server')
+
+TABLES = 10000
+# one table in REGEX_EVERY has a real pattern, the others escaped filenames as written by Symon imports
+REGEX_EVERY = 10
+# keys matched one table at a time for the baseline, which compiles every pattern again and takes seconds per key
+BASELINE_KEYS = 5
+
+
+def table_configs():
+    tables = []
+    for i in range(TABLES):
+        prefix = f'/imports/customer_{i % 50:02d}'
+        if i % REGEX_EVERY == 0:
+            pattern = f'export_{i:05d}_\\d{{8}}\\.csv'
+        else:
+            pattern = re.escape(f'orders {i:05d} (final).csv')
+        tables.append({'table_name': f'table_{i:05d}', 'search_prefix': prefix, 'search_pattern': pattern})
+    return tables
+
+
+def keys():
+    for i in range(TABLES):
+        name = f'export_{i:05d}_20240101.csv' if i % REGEX_EVERY == 0 else f'orders {i:05d} (final).csv'
+        yield f'/imports/customer_{i % 50:02d}/{name}'
+
+
+def search_each(tables, key, flags=0):
+    return [table for table in tables
+            if re.search(f"{re.escape(table['search_prefix'])}/{table['search_pattern']}", key, flags)]
+
+
+def match_all(matcher, all_keys):
+    return [matcher.match(key) for key in all_keys]
+
+
+def test_table_matcher(benchmark_results):
+    """Benchmark -
+            Matches the file_source of a stream of each of 10k tables with an index built once, against searching
+            every table's pattern for a sample of the keys."""
+    tables = table_configs()
+    all_keys = list(keys())
+    matcher, build_seconds = timed(TableMatcher, tables)
+    matches, seconds = timed(match_all, matcher, all_keys)
+    assert [len(tables_found) for tables_found in matches] == [1] * TABLES
+
+    sample = all_keys[::TABLES // BASELINE_KEYS]
+    baseline, baseline_seconds = timed(lambda: [search_each(tables, key) for key in sample])
+    assert baseline == [matcher.match(key) for key in sample]
+
+    assert benchmark_results.record(f'table_matcher[{TABLES} tables]', build_seconds + seconds, keys=len(all_keys),
+                                    build_seconds=round(build_seconds, 4))
+    assert benchmark_results.record(f'search_each_table[{TABLES} tables]', baseline_seconds, keys=len(sample),
+                                    seconds_per_key=round(baseline_seconds / len(sample), 6))
+
+
+def test_table_matcher_dynamic(benchmark_results):
+    """Benchmark -
+            Matches the file_source of a stream of each of 10k dynamic tables, looked up by their file names."""
+    tables = [{'table_name': f'orders {i:05d} (final).csv', 'search_prefix': f'/imports/customer_{i % 50:02d}'}
+              for i in range(TABLES)]
+    all_keys = [f"{table['search_prefix']}/{table['table_name']}" for table in tables]
+    matcher, build_seconds = timed(TableMatcher, tables, True)
+    matches, seconds = timed(match_all, matcher, all_keys)
+    assert matches == [[table] for table in tables]
+    assert benchmark_results.record(f'table_matcher_dynamic[{TABLES} tables]', build_seconds + seconds,
+                                    keys=len(all_keys))
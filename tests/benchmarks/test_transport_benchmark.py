@@ -0,0 +1,52 @@
+import gzip
+import os
+import time
+import paramiko  # type: ignore
+import pytest
+from tap_sftp.client import connection
+from tests.configuration.sftp_server import LocalSFTPServerRunner
+
+pytestmark = pytest.mark.skipif(not os.environ.get('TAP_SFTP_BENCHMARK'),
+                                reason='set TAP_SFTP_BENCHMARK=1 to run benchmarks against a local SFTP server')
+
+FILE_SIZE = 32 * 1024 * 1024
+CIPHERS = ['aes128-ctr', 'aes256-ctr', 'aes128-gcm@openssh.com', 'aes256-gcm@openssh.com']
+
+
+@pytest.fixture(scope='module')
+def remote_root(tmp_path_factory):
+    root = tmp_path_factory.mktemp('remote')
+    rows = b''.join(b'%d,customer_%d,2024-01-01,%d.99\n' % (i, i % 1000, i % 500) for i in range(FILE_SIZE // 32))
+    with open(root / 'orders.csv', 'wb') as f:
+        f.write(rows[:FILE_SIZE])
+    with open(root / 'orders.csv.gz', 'wb') as f:
+        f.write(gzip.compress(rows[:FILE_SIZE], compresslevel=6))
+    return root
+
+
+def test_cipher_and_compression_throughput(remote_root, tmp_path):
+    """Benchmark -
+            Downloads a compressible csv and an already gzipped copy of it from a local SFTP server with each cipher,
+            with and without transport compression, and reports the throughput of each combination."""
+    results = []
+    with LocalSFTPServerRunner(str(remote_root)) as server:
+        for cipher in [c for c in CIPHERS if c in paramiko.Transport._preferred_ciphers]:
+            for compression in [True, False]:
+                for name in ['orders.csv', 'orders.csv.gz']:
+                    size = os.path.getsize(remote_root / name)
+                    conn = connection(server.config(compression=compression, preferred_ciphers=[cipher],
+                                                    download_concurrency=1))
+                    try:
+                        conn.sftp
+                        start = time.monotonic()
+                        conn.sftp.get(f'/{name}', str(tmp_path / name))
+                        seconds = time.monotonic() - start
+                        assert conn.transport.remote_cipher == cipher
+                    finally:
+                        conn.close()
+                    results.append((cipher, compression, name, size / 1024 / 1024 / seconds))
+
+    print('\ncipher                  compression  file            MB/s')
+    for cipher, compression, name, throughput in results:
+        print(f'{cipher:<24}{str(compression):<13}{name:<16}{throughput:.1f}')
+    assert len(results) >= 8
@@ -8,7 +8,7 @@ from tap_sftp.client import connection
 @fixture
 def sftp_client(monkeypatch):
     # overwrite the client so we never actually try to connect to an sftp
-    with patch('paramiko.SFTPClient.from_transport'), patch('paramiko.Transport'):
+    with patch('paramiko.SFTPClient.from_transport'), patch('paramiko.Transport'), patch('socket.create_connection'):
         yield connection({'host': '', 'username': ''})
 
 
@@ -0,0 +1,206 @@
+import os
+import socket
+import threading
+import time
+import paramiko  # type: ignore
+from paramiko import SFTPAttributes, SFTPHandle, SFTPServer, SFTPServerInterface, ServerInterface  # type: ignore
+from paramiko.sftp import SFTP_FAILURE, SFTP_NO_SUCH_FILE, SFTP_PERMISSION_DENIED  # type: ignore
+
+USERNAME = 'tap-sftp'
+PASSWORD = 'tap-sftp'
+HOST_KEY = None
+
+
+def host_key():
+    global HOST_KEY
+    if HOST_KEY is None:
+        HOST_KEY = paramiko.RSAKey.generate(2048)
+    return HOST_KEY
+
+
+def to_sftp_error(ex):
+    if isinstance(ex, FileNotFoundError):
+        return SFTP_NO_SUCH_FILE
+    return SFTPServer.convert_errno(ex.errno) if getattr(ex, 'errno', None) else SFTP_PERMISSION_DENIED
+
+
+class Throttle():
+    """ Caps the bytes sent through it at `rate` bytes per second, shared by every caller. """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.next_free = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, size):
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_free)
+            self.next_free = start + size / self.rate
+        time.sleep(max(self.next_free - now, 0))
+
+
+class LocalServer(ServerInterface):
+    def __init__(self, transport=None, max_sessions=None):
+        self.transport = transport
+        self.max_sessions = max_sessions
+
+    def check_auth_password(self, username, password):
+        if (username, password) == (USERNAME, PASSWORD):
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session' and not self.max_sessions:
+            return paramiko.OPEN_SUCCEEDED
+        if kind == 'session':
+            # like OpenSSH's MaxSessions, refuse channels beyond the limit on one connection
+            open_channels = [channel for channel in self.transport._channels.values() if not channel.closed]
+            if len(open_channels) < self.max_sessions:
+                return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+
+class LocalSFTPHandle(SFTPHandle):
+    def __init__(self, readfile, latency, runner=None, transport=None):
+        super().__init__()
+        self.readfile = readfile
+        self.latency = latency
+        self.runner = runner
+        self.transport = transport
+
+    def read(self, offset, length):
+        time.sleep(self.latency)
+        if self.runner and self.runner.should_drop(self.transport, offset, length):
+            self.runner.drop_connection(self.transport)
+            return SFTP_FAILURE
+        data = super().read(offset, length)
+        if self.runner and self.runner.throttle and isinstance(data, bytes):
+            self.runner.throttle.consume(len(data))
+        return data
+
+    def stat(self):
+        return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+
+class LocalSFTPServer(SFTPServerInterface):
+    """ Read-only SFTP server over a local directory that adds `latency` seconds to every request. """
+
+    def __init__(self, server, root, latency=0, runner=None, *args, **kwargs):
+        super().__init__(server, *args, **kwargs)
+        self.transport = server.transport
+        self.root = root
+        self.latency = latency
+        self.runner = runner
+
+    def local_path(self, path):
+        return os.path.join(self.root, self.canonicalize(path).lstrip('/'))
+
+    def list_folder(self, path):
+        time.sleep(self.latency)
+        try:
+            local_path = self.local_path(path)
+            result = []
+            for name in sorted(os.listdir(local_path)):
+                attr = SFTPAttributes.from_stat(os.stat(os.path.join(local_path, name)))
+                attr.filename = name
+                result.append(attr)
+            return result
+        except OSError as ex:
+            return to_sftp_error(ex)
+
+    def stat(self, path):
+        time.sleep(self.latency)
+        try:
+            return SFTPAttributes.from_stat(os.stat(self.local_path(path)))
+        except OSError as ex:
+            return to_sftp_error(ex)
+
+    lstat = stat
+
+    def open(self, path, flags, attr):
+        time.sleep(self.latency)
+        try:
+            return LocalSFTPHandle(open(self.local_path(path), 'rb'), self.latency, self.runner, self.transport)
+        except OSError as ex:
+            return to_sftp_error(ex)
+
+    def canonicalize(self, path):
+        return os.path.normpath('/' + path).replace('\\', '/')
+
+
+class LocalSFTPServerRunner():
+    """
+    Runs LocalSFTPServer on a loopback port in background threads until closed. The first read of a file covering
+    any of the `drop_at` byte offsets drops the connection it came over, as a network failure would. Reads still
+    queued on a dropped connection do not drop again.
+
+    `bandwidth` caps the file bytes served per second across all connections, and `max_sessions` limits the
+    channels open at once on one connection, as the MaxSessions setting of an OpenSSH server does.
+    """
+
+    def __init__(self, root, latency=0, drop_at=(), bandwidth=None, max_sessions=None):
+        self.root = root
+        self.latency = latency
+        self.drop_at = set(drop_at)
+        self.throttle = Throttle(bandwidth) if bandwidth else None
+        self.max_sessions = max_sessions
+        self.dropped = []
+        self.dropped_transports = []
+        self.lock = threading.Lock()
+        self.transports = []
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(('127.0.0.1', 0))
+        self.socket.listen(16)
+        self.port = self.socket.getsockname()[1]
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def config(self, **kwargs):
+        return dict({'host': '127.0.0.1', 'port': self.port, 'username': USERNAME, 'password': PASSWORD}, **kwargs)
+
+    def serve(self):
+        while True:
+            try:
+                client_socket, _ = self.socket.accept()
+            except OSError:
+                return
+            transport = paramiko.Transport(client_socket)
+            transport.add_server_key(host_key())
+            # offer zlib so clients that ask for compression get it
+            transport.use_compression(True)
+            transport.set_subsystem_handler('sftp', SFTPServer, LocalSFTPServer, root=self.root, latency=self.latency,
+                                            runner=self)
+            transport.start_server(server=LocalServer(transport, self.max_sessions))
+            self.transports.append(transport)
+
+    def should_drop(self, transport, offset, length):
+        with self.lock:
+            offsets = [drop for drop in self.drop_at if offset <= drop < offset + length]
+            if not offsets or transport in self.dropped_transports:
+                return False
+            self.drop_at.difference_update(offsets)
+            self.dropped += offsets
+            self.dropped_transports.append(transport)
+            return True
+
+    def drop_connection(self, transport):
+        try:
+            transport.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def close(self):
+        self.socket.close()
+        for transport in self.transports:
+            transport.close()
@@ -1,10 +1,19 @@
 import os.path
+import re
 from datetime import datetime
+import threading
 import time
-from unittest.mock import patch, mock_open
+import tracemalloc
+from unittest.mock import ANY, patch, mock_open, Mock
 import pytest
 import stat
+import pytz
+from tap_sftp import bookmarks, defaults
+from concurrent.futures import ThreadPoolExecutor
+from paramiko.ssh_exception import ChannelException, SSHException
+from tap_sftp.client import SFTPConnectionPool, SFTPSessionMultiplexer, connection, prefer_algorithms
 from paramiko.sftp_attr import SFTPAttributes
+from tests.configuration.sftp_server import LocalSFTPServerRunner
 from tests.configuration.fixtures import get_sample_file_path, sftp_client, get_full_file_path, file_handle_unscoped, \
     file_handle_second_unscoped, file_handle
 
@@ -28,45 +37,73 @@ files = [
      "file_size": 25874}]
 
 
-@patch('tap_sftp.client.SFTPConnection.get_files_by_prefix')
-def test_get_files(mock_get_files_by_prefix, sftp_client):
+def iter_matching_files(prefix, search_subdirectories, filename_filter):
+    return (f for f in files if filename_filter(os.path.basename(f["filepath"])))
+
+
+@patch('tap_sftp.client.SFTPConnection.iter_files_by_prefix')
+def test_get_files(mock_iter_files_by_prefix, sftp_client):
     """Testing scenario -
             Testing get_files function to verify getting files by prefix and search pattern and SUT should
             return the correct files."""
     prefix = "/test_tmp/bin"
     search_pattern = "test2.csv"
-    mock_get_files_by_prefix.return_value = files
+    mock_iter_files_by_prefix.side_effect = iter_matching_files
     matched_files = sftp_client.get_files(prefix, search_pattern, date_modified_since_old)
     assert len(matched_files) == 1
     assert len([file for file in matched_files if file["id"] in [5]]) == 1
 
 
-@patch('tap_sftp.client.SFTPConnection.get_files_by_prefix')
-def test_get_files_with_wildcard_in_search_pattern(mock_get_files_by_prefix, sftp_client):
+@patch('tap_sftp.client.SFTPConnection.iter_files_by_prefix')
+def test_get_files_with_wildcard_in_search_pattern(mock_iter_files_by_prefix, sftp_client):
     """Testing scenario -
             Testing get_files function to verify getting files by prefix and wildcard in search pattern and SUT should
             return the correct files."""
     prefix = "/test_tmp/bin"
     search_pattern = "test2(.*)"
-    mock_get_files_by_prefix.return_value = files
+    mock_iter_files_by_prefix.side_effect = iter_matching_files
     matched_files = sftp_client.get_files(prefix, search_pattern, date_modified_since_oldest)
     assert len(matched_files) == 4
     assert len([file for file in matched_files if file["id"] in [3, 4, 5, 6]]) == 4
 
 
-@patch('tap_sftp.client.SFTPConnection.get_files_by_prefix')
-def test_get_files_without_modified_date_provided(mock_get_files_by_prefix, sftp_client):
+@patch('tap_sftp.client.SFTPConnection.iter_files_by_prefix')
+def test_get_files_without_modified_date_provided(mock_iter_files_by_prefix, sftp_client):
     """Testing scenario -
             Testing get_files function to verify getting files by prefix and search pattern but no modified date
             and SUT should return the correct files."""
     prefix = "/test_tmp/bin"
     search_pattern = "(test2.*)"
-    mock_get_files_by_prefix.return_value = files
+    mock_iter_files_by_prefix.side_effect = iter_matching_files
     matched_files = sftp_client.get_files(prefix, search_pattern, None)
     assert len(matched_files) == 5
     assert len([file for file in matched_files if file["id"] in [2, 3, 4, 5, 6]]) == 5
 
 
+@patch('tap_sftp.bookmarks.singer.write_state')
+def test_get_files_skips_files_synced_up_to_bookmark(mock_write_state, sftp_client):
+    """Testing scenario -
+            Testing get_files function on a folder of 2000 files that were all synced and SUT should
+             - return no file at all on the next run
+             - return only the added file and the file rewritten with the same mtime once they change."""
+    prefix = "/Data"
+    listing = [build_sftp_attributes(f"orders_{i:04d}.csv") for i in range(2000)]
+    sftp_client.sftp.listdir_attr.side_effect = lambda p: listing
+
+    state = {}
+    for f in sorted(sftp_client.get_files(prefix, "orders_.*\\.csv", None), key=lambda f: f["last_modified"]):
+        state = bookmarks.write_file_bookmark(state, "orders", f)
+    assert mock_write_state.call_count == 2000
+    bookmark = bookmarks.get_bookmark(state, "orders")
+    assert sftp_client.get_files(prefix, "orders_.*\\.csv", None, True, bookmark) == []
+
+    listing[5].st_size = 2048
+    listing.append(build_sftp_attributes("orders_2000.csv"))
+    listing[-1].st_mtime += 60
+    matched_files = sftp_client.get_files(prefix, "orders_.*\\.csv", None, True, bookmark)
+    assert [f["filepath"] for f in matched_files] == [f"{prefix}/orders_0005.csv", f"{prefix}/orders_2000.csv"]
+
+
 def test_get_files_by_prefix(sftp_client):
     """Testing scenario -
             Testing get_files_by_prefix function to verify getting files by prefix and SUT should return the
@@ -108,16 +145,178 @@ def test_get_files_by_prefix(sftp_client):
                 file['file_size'] == 0 or file['filepath'] == f'{prefix}/{file_result4.filename}']) == 1
 
 
+def build_sftp_attributes(filename, st_mode=stat.S_IFREG, st_size=1024):
+    file_attr: SFTPAttributes = SFTPAttributes()
+    file_attr.filename = filename
+    file_attr.st_size = st_size
+    file_attr.st_mode = st_mode
+    file_attr.st_mtime = time.mktime(date_modified_since_old.timetuple())
+    return file_attr
+
+
+@pytest.mark.parametrize("list_concurrency", [1, 3])
+def test_get_files_by_prefix_concurrent_walk_is_deterministic(list_concurrency, sftp_client):
+    """Testing scenario -
+            Testing get_files_by_prefix function with nested subdirectories and SUT should walk them breadth-first
+            and return the same files in the same order whatever the list concurrency."""
+    prefix = "/Data"
+    tree = {
+        prefix: [build_sftp_attributes("2024", stat.S_IFDIR), build_sftp_attributes("root.csv"),
+                 build_sftp_attributes("2023", stat.S_IFDIR)],
+        f"{prefix}/2024": [build_sftp_attributes("01", stat.S_IFDIR), build_sftp_attributes("a.csv")],
+        f"{prefix}/2023": [build_sftp_attributes("b.csv"), build_sftp_attributes("c.csv")],
+        f"{prefix}/2024/01": [build_sftp_attributes("d.csv")]
+    }
+    sftp_client.list_concurrency = list_concurrency
+    sftp_client.sftp.listdir_attr.side_effect = lambda p: tree[p]
+    matched_files = sftp_client.get_files_by_prefix(prefix)
+    assert [file['filepath'] for file in matched_files] == [f"{prefix}/root.csv", f"{prefix}/2024/a.csv",
+                                                              f"{prefix}/2023/b.csv", f"{prefix}/2023/c.csv",
+                                                              f"{prefix}/2024/01/d.csv"]
+    assert all(file['file_size'] == 1024 for file in matched_files)
+
+
+def test_get_files_by_prefix_missing_subdirectory(sftp_client):
+    """Testing scenario -
+            Testing get_files_by_prefix function when a directory disappears during the walk and SUT should raise
+            an exception naming the directory."""
+    prefix = "/Data"
+    sftp_client.list_concurrency = 2
+
+    def listdir_attr(p):
+        if p == prefix:
+            return [build_sftp_attributes("gone", stat.S_IFDIR), build_sftp_attributes("here", stat.S_IFDIR)]
+        if p == f"{prefix}/gone":
+            raise FileNotFoundError()
+        return []
+
+    sftp_client.sftp.listdir_attr.side_effect = listdir_attr
+    with pytest.raises(Exception, match=f"Directory '{prefix}/gone' does not exist"):
+        sftp_client.get_files_by_prefix(prefix)
+
+
+def test_get_files_streams_synthetic_tree_of_a_million_entries(sftp_client):
+    """Testing scenario -
+            Testing get_files function against a synthetic tree of 1000 directories holding 1000 files each and SUT
+            should
+             - yield the first file after a single directory listing
+             - only keep the matching file
+             - keep peak memory well below the size of the materialised tree."""
+    prefix = "/Data"
+    directory_count = 1000
+    files_per_directory = 1000
+
+    # directories share one listing so the test measures the walker rather than building a million mocks
+    listing = [build_sftp_attributes(f"orders_{i}.csv") for i in range(files_per_directory)]
+    target_listing = [build_sftp_attributes("target.csv")] + listing[1:]
+    directories = [build_sftp_attributes(f"{i:04d}", stat.S_IFDIR) for i in range(directory_count)]
+
+    def build_listing(p):
+        if p == prefix:
+            return directories
+        return target_listing if p == f"{prefix}/0500" else listing
+
+    sftp_client.list_concurrency = 4
+    sftp_client.sftp.listdir_attr.side_effect = build_listing
+    # the target is not directly under the prefix, so stat'ing the escaped name falls back to the walk
+    sftp_client.sftp.stat.side_effect = FileNotFoundError
+
+    walker = sftp_client.iter_files_by_prefix(prefix)
+    first_file = next(walker)
+    walker.close()
+    assert first_file["filepath"] == f"{prefix}/0000/orders_0.csv"
+    assert sftp_client.sftp.listdir_attr.call_count <= 1 + sftp_client.list_concurrency * defaults.LIST_BATCH_FACTOR
+
+    sftp_client.sftp.listdir_attr.reset_mock()
+    tracemalloc.start()
+    try:
+        matched_files = sftp_client.get_files(prefix, "target\\.csv",
+                                              date_modified_since_oldest.replace(tzinfo=pytz.UTC))
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert [f["filepath"] for f in matched_files] == [f"{prefix}/0500/target.csv"]
+    assert sftp_client.sftp.listdir_attr.call_count == directory_count + 1
+    # a materialised list of a million file dicts alone needs several hundred MB
+    assert peak < 64 * 1024 * 1024
+
+
+def test_get_files_stats_an_escaped_filename_instead_of_listing(tmp_path):
+    """Testing scenario -
+            Testing get_files function with an escaped filename as search pattern against a local SFTP server and SUT
+            should
+             - find the file with a single stat, without listing the folder
+             - fall back to listing the folder and its subdirectories when the file is not directly in the prefix
+             - list the folder when stat_literal_patterns is off."""
+    folder = tmp_path / 'imports'
+    (folder / 'sub').mkdir(parents=True)
+    for i in range(50):
+        (folder / f'other_{i}.csv').write_bytes(b'id\n1\n')
+    (folder / 'orders (1).csv').write_bytes(b'id\n1\n2\n')
+    (folder / 'sub' / 'nested [2].csv').write_bytes(b'id\n1\n')
+
+    with LocalSFTPServerRunner(str(tmp_path)) as server:
+        for config, pattern, listed in [({}, 'orders (1).csv', False),
+                                        ({}, 'nested [2].csv', True),
+                                        ({'stat_literal_patterns': False}, 'orders (1).csv', True)]:
+            conn = connection(server.config(**config))
+            try:
+                with patch.object(conn, 'listdir_attr', wraps=conn.listdir_attr) as mock_listdir_attr:
+                    matched_files = conn.get_files('/imports', re.escape(pattern))
+                assert [os.path.basename(f['filepath']) for f in matched_files] == [pattern]
+                assert mock_listdir_attr.called == listed
+            finally:
+                conn.close()
+
+    assert matched_files[0]['filepath'] == '/imports/orders (1).csv'
+    assert matched_files[0]['file_size'] == 7
+
+
+def test_get_files_shares_one_walk_between_tables_under_a_prefix(tmp_path):
+    """Testing scenario -
+            Testing get_files function for several tables under the same prefix on connections of one pool and SUT
+            should
+             - walk the prefix once, sorting its files into every table's pattern
+             - serve the other tables from that walk and count one miss and the hits
+             - still stat a table's escaped filename instead of taking it from the walk."""
+    (tmp_path / 'data' / 'sub').mkdir(parents=True)
+    for name in ['orders_1.csv', 'orders_2.csv', 'customers_1.csv', 'summary.csv', 'sub/orders_3.csv']:
+        (tmp_path / 'data' / name).write_bytes(b'id\n1\n')
+    tables = [{"table_name": "orders", "search_prefix": "/data", "search_pattern": "orders_\\d\\.csv"},
+              {"table_name": "customers", "search_prefix": "/data", "search_pattern": "customers_.*"},
+              {"table_name": "everything", "search_prefix": "/data", "search_pattern": ".*\\.csv"},
+              {"table_name": "summary", "search_prefix": "/data", "search_pattern": "summary\\.csv"}]
+
+    with LocalSFTPServerRunner(str(tmp_path)) as server, SFTPConnectionPool(server.config()) as pool:
+        pool.listing_cache.expect_tables(tables, True)
+        matched = {}
+        with patch('tap_sftp.client.SFTPConnection.listdir_attr', autospec=True,
+                   side_effect=lambda conn, session, directory: session.listdir_attr(directory)) as mock_listdir_attr:
+            for table in tables:
+                with pool.checkout() as conn:
+                    matched[table["table_name"]] = sorted(
+                        f["filepath"] for f in conn.get_files(table["search_prefix"], table["search_pattern"]))
+
+    assert matched == {
+        "orders": ["/data/orders_1.csv", "/data/orders_2.csv", "/data/sub/orders_3.csv"],
+        "customers": ["/data/customers_1.csv"],
+        "everything": ["/data/customers_1.csv", "/data/orders_1.csv", "/data/orders_2.csv", "/data/sub/orders_3.csv",
+                       "/data/summary.csv"],
+        "summary": ["/data/summary.csv"]}
+    # /data and /data/sub, listed once for all the tables
+    assert mock_listdir_attr.call_count == 2
+    assert pool.listing_cache.stats() == {'hits': 2, 'misses': 1}
+
+
 @patch('tap_sftp.helper.load_file_decrypted')
-@patch('paramiko.sftp_file.SFTPFile')
+@patch('tap_sftp.transfer.PipelinedReader')
 @patch('tempfile.TemporaryDirectory.__enter__')
-def test_get_file_handle_for_encrypted_file_with_remote_decryption_config(mock_tempfile, mock_sftp_file,
+def test_get_file_handle_for_encrypted_file_with_remote_decryption_config(mock_tempfile, mock_pipelined_reader,
                                                                           mock_load_file_decrypted, sftp_client):
     """Testing scenario -
             Testing get_file_handle function to verify getting file handle with decryption config with remote decryption
              for the sftp file and SUT should
-             - download the decrypted file locally
-             - call paramiko prefetch
+             - decrypt the file from blocks read ahead over the connection's sessions
              - return decrypted file handle."""
 
     prefix = "/sftp_path"
@@ -133,67 +332,74 @@ def test_get_file_handle_for_encrypted_file_with_remote_decryption_config(mock_t
         "sign_key": "sign_key",
         "gnupghome": "home",
         "passphrase": "passphrase",
-        "decrypt_remote": True
+        "decrypt_remote": True,
+        "read_block_size": 4096
     }
-    sftp_client.sftp.open.return_value.__enter__.return_value = mock_sftp_file
+    mock_reader = mock_pipelined_reader.return_value.__enter__.return_value
+    mock_reader.error = None
     mock_load_file_decrypted.return_value = decrypt_path
+    sftp_client.sftp.stat.return_value = build_sftp_attributes(file_name, st_size=12404)
     with sftp_client.get_file_handle(file, "csv", None, decryption_config) as file_handle:
-        mock_load_file_decrypted.assert_called_with(mock_sftp_file, decryption_config.get("key"),
+        mock_load_file_decrypted.assert_called_with(mock_reader, decryption_config.get("key"),
                                                     decryption_config.get("gnupghome"),
                                                     decryption_config.get("passphrase"),
                                                     decrypt_path,
                                                     None,
                                                     decryption_config.get("sign_key"))
         assert file_handle.name == decrypt_path
-        mock_sftp_file.prefetch.assert_called_with()
+        mock_pipelined_reader.assert_called_with(sftp_client.sessions, sftp_path, 12404, 4096, None, None, ANY)
+
+
+def build_remote_file(data, chunk_size=1000):
+    remote_file = Mock()
+    remote_file.read.side_effect = [data[offset:offset + chunk_size] for offset in range(0, len(data), chunk_size)] + [b'']
+    return remote_file
 
 
-@pytest.mark.parametrize("file_handle", ["../data/fake_file.txt"], indirect=True)
-@patch('paramiko.sftp_file.SFTPFile')
 @patch('tempfile.TemporaryDirectory.__enter__')
-def test_get_file_handle_for_unencrypted_file(mock_tempfile, mock_sftp_file, file_handle, sftp_client):
+def test_get_file_handle_for_unencrypted_file(mock_tempfile, tmp_path, sftp_client):
     """Testing scenario -
             Testing get_file_handle function to verify getting file handle for unencrypted sftp file and SUT should
              - download the file locally
-             - call paramiko get method
+             - read the remote file front to back with paramiko prefetch
              - return file handle for the downloaded file."""
 
     prefix = "/sftp_path"
-    tmp_dir_name = get_full_file_path("../data")
     file_name = "fake_file.txt"
     sftp_path = f'{prefix}/{file_name}'
-    local_path = f'{tmp_dir_name}/{file_name}'
-    mock_tempfile.return_value = tmp_dir_name
-    file = {"id": 1, "filepath": sftp_path, "last_modified": date_modified_since_oldest, "file_size": 12404}
+    local_path = f'{tmp_path}/{file_name}'
+    mock_tempfile.return_value = str(tmp_path)
+    data = b'Col1,Col2\n' * 1240
+    file = {"id": 1, "filepath": sftp_path, "last_modified": date_modified_since_oldest, "file_size": len(data)}
     decryption_config = None
+    mock_sftp_file = build_remote_file(data)
     sftp_client.sftp.open.return_value.__enter__.return_value = mock_sftp_file
-    mock_open().return_value = file_handle
-    result_file_handle = sftp_client.get_file_handle(file, "", None, decryption_config)
-    sftp_client.sftp.get.assert_called_with(sftp_path, local_path)
-    assert result_file_handle.name == local_path
+    sftp_client.sftp.stat.return_value = build_sftp_attributes(file_name, st_size=len(data))
+    with sftp_client.get_file_handle(file, "", None, decryption_config) as result_file_handle:
+        assert result_file_handle.name == local_path
+        assert result_file_handle.read() == data
+    sftp_client.sftp.open.assert_called_with(sftp_path, 'rb')
+    mock_sftp_file.prefetch.assert_called_with(len(data))
 
 
-@pytest.mark.parametrize("file_handle_second_unscoped", ["../data/fake_file.txt"], indirect=True)
-@pytest.mark.parametrize("file_handle_unscoped", ["../data/fake_file.txt.pgp"], indirect=True)
-@patch('builtins.open')
 @patch('file_processors.utils.decrypt.gpg_decrypt_to_file')
 @patch('tempfile.TemporaryDirectory.__enter__')
-def test_get_file_handle_for_encrypted_file_with_local_decryption_config(mock_tempfile, mock_decrypt_to_file, mock_file_open,
-                                                      file_handle_unscoped, file_handle_second_unscoped, sftp_client):
+def test_get_file_handle_for_encrypted_file_with_local_decryption_config(mock_tempfile, mock_decrypt_to_file, tmp_path,
+                                                                         sftp_client):
     """Testing scenario -
             Testing get_file_handle function to verify getting file handle with decryption config with local decryption
              for the sftp file and SUT should
-             - download the encrypted file and decrypt locally
+             - download the encrypted file locally while decrypting what has arrived so far
              - return decrypted file handle."""
     prefix = "/sftp_path"
-    tmp_dir_name = get_full_file_path("../data")
     file_name = "fake_file.txt.pgp"
     original_file_name = os.path.splitext(file_name)[0]
     sftp_path = f'{prefix}/{file_name}'
-    encrypt_path = f'{tmp_dir_name}/{file_name}'
-    local_path = f'{tmp_dir_name}/{original_file_name}'
-    mock_tempfile.return_value = tmp_dir_name
-    file = {"id": 1, "filepath": sftp_path, "last_modified": date_modified_since_oldest, "file_size": 12404}
+    encrypt_path = f'{tmp_path}/{file_name}'
+    local_path = f'{tmp_path}/{original_file_name}'
+    mock_tempfile.return_value = str(tmp_path)
+    encrypted = b'encrypted' * 1000
+    file = {"id": 1, "filepath": sftp_path, "last_modified": date_modified_since_oldest, "file_size": len(encrypted)}
     decryption_config = {
         "key": "key",
         "sign_key": "sign_key",
@@ -202,16 +408,24 @@ def test_get_file_handle_for_encrypted_file_with_local_decryption_config(mock_te
         "decrypt_remote": False
     }
 
-    mock_decrypt_to_file.return_value = local_path
-    mock_file_open.side_effect = lambda p, b, encoding=None: file_handle_unscoped if p == encrypt_path else file_handle_second_unscoped
-    returned_file_handle = sftp_client.get_file_handle(file, "xlsx", None, decryption_config)
-    mock_decrypt_to_file.assert_called_with(file_handle_unscoped, decryption_config.get("key"),
-                                            decryption_config.get("gnupghome"),
-                                            decryption_config.get("passphrase"),
-                                            local_path,
-                                            None,
-                                            decryption_config.get("sign_key"))
-    assert returned_file_handle.name == local_path
+    def gpg_decrypt_to_file(src, key, gnupghome, passphrase, path, capturer, sign_key):
+        assert src.read() == encrypted
+        with open(path, 'wb') as decrypted:
+            decrypted.write(b'decrypted')
+        return path
+
+    sftp_client.sftp.open.return_value.__enter__.return_value = build_remote_file(encrypted)
+    sftp_client.sftp.stat.return_value = build_sftp_attributes(file_name, st_size=len(encrypted))
+    mock_decrypt_to_file.side_effect = gpg_decrypt_to_file
+    with sftp_client.get_file_handle(file, "xlsx", None, decryption_config) as returned_file_handle:
+        assert returned_file_handle.name == local_path
+        assert returned_file_handle.read() == b'decrypted'
+    args = mock_decrypt_to_file.call_args.args
+    assert args[1:] == (decryption_config.get("key"), decryption_config.get("gnupghome"),
+                        decryption_config.get("passphrase"), local_path, None, decryption_config.get("sign_key"))
+    sftp_client.sftp.open.assert_called_once_with(sftp_path, 'rb')
+    with open(encrypt_path, 'rb') as encrypted_file:
+        assert encrypted_file.read() == encrypted
 
 
 @patch('tempfile.TemporaryDirectory.__enter__')
@@ -302,7 +516,7 @@ def test_get_sampled_file_handle_for_unencrypted_file(mock_tempfile, mock_sftp_f
     mock_sample_file.return_value = local_path
     mock_file_open.return_value = file_handle
     returned_file_handle = sftp_client.get_file_handle_for_sample(file, "text", None, decryption_config, max_records)
-    mock_sample_file.assert_called_with(mock_sftp_file, file_name, tmp_dir_name, max_records)
+    mock_sample_file.assert_called_with(mock_sftp_file, file_name, tmp_dir_name, max_records, ANY)
     assert returned_file_handle.name == local_path
 
 
@@ -343,6 +557,214 @@ def test_get_files_matching_pattern(sftp_client):
 
 
 
+@patch('tap_sftp.client.connection')
+def test_connection_pool_reuses_healthy_connection(mock_connection):
+    """Testing scenario -
+            Testing SFTPConnectionPool to verify a released healthy connection is handed out again and SUT should
+             - open a single connection
+             - set a keepalive when the connection is released
+             - close it when the pool is closed."""
+    config = {'host': 'host', 'username': 'user'}
+    conn = Mock()
+    conn.transport.is_active.return_value = True
+    mock_connection.return_value = conn
+    with SFTPConnectionPool(config) as pool:
+        for _ in range(3):
+            with pool.checkout() as checked_out:
+                assert checked_out is conn
+        assert pool.stats() == {'opened': 1, 'reused': 2}
+        conn.transport.set_keepalive.assert_called_with(defaults.KEEPALIVE_INTERVAL)
+    mock_connection.assert_called_once_with(config)
+    conn.close.assert_called_once_with()
+
+
+@patch('tap_sftp.client.connection')
+def test_connection_pool_discards_unhealthy_connection(mock_connection):
+    """Testing scenario -
+            Testing SFTPConnectionPool when a pooled connection has dropped and SUT should close it and open a new
+            connection instead of reusing it."""
+    config = {'host': 'host', 'username': 'user'}
+    dropped_conn = Mock()
+    dropped_conn.transport.is_active.return_value = True
+    fresh_conn = Mock()
+    mock_connection.side_effect = [dropped_conn, fresh_conn]
+    with SFTPConnectionPool(config) as pool:
+        with pool.checkout():
+            pass
+        dropped_conn.sftp.normalize.side_effect = EOFError()
+        with pool.checkout() as checked_out:
+            assert checked_out is fresh_conn
+        dropped_conn.close.assert_called_once_with()
+        assert pool.stats() == {'opened': 2, 'reused': 0}
+    fresh_conn.close.assert_called_once_with()
+
+
+@patch('tap_sftp.client.connection')
+def test_connection_pool_opens_one_connection_per_concurrent_checkout(mock_connection):
+    """Testing scenario -
+            Testing SFTPConnectionPool with nested checkouts and SUT should open a connection for each checkout that
+            is outstanding at the same time, and close all of them."""
+    config = {'host': 'host', 'username': 'user'}
+    connections = [Mock(), Mock()]
+    mock_connection.side_effect = connections
+    with SFTPConnectionPool(config) as pool:
+        with pool.checkout() as first, pool.checkout() as second:
+            assert first is not second
+    for conn in connections:
+        conn.close.assert_called_once_with()
+
+
+
+@patch('paramiko.SFTPClient.from_transport')
+def test_session_multiplexer_opens_sessions_on_one_transport(mock_from_transport):
+    """Testing scenario -
+            Testing SFTPSessionMultiplexer with concurrent checkouts and SUT should
+             - hand out the primary session first
+             - open extra sessions on the same transport up to max_sessions
+             - close only the extra sessions."""
+    transport = Mock()
+    primary = Mock()
+    extra_sessions = [Mock(), Mock()]
+    mock_from_transport.side_effect = extra_sessions
+    multiplexer = SFTPSessionMultiplexer(transport, primary, 3)
+    with multiplexer.checkout() as first, multiplexer.checkout() as second, multiplexer.checkout() as third:
+        assert [first, second, third] == [primary] + extra_sessions
+    mock_from_transport.assert_called_with(transport)
+    multiplexer.close()
+    primary.close.assert_not_called()
+    for session in extra_sessions:
+        session.close.assert_called_once_with()
+
+
+@patch('paramiko.SFTPClient.from_transport')
+def test_session_multiplexer_falls_back_when_server_caps_sessions(mock_from_transport):
+    """Testing scenario -
+            Testing SFTPSessionMultiplexer when the server refuses a second session and SUT should stop opening
+            sessions and make the waiting caller reuse the released one."""
+    primary = Mock()
+    mock_from_transport.side_effect = ChannelException(1, 'Administratively prohibited')
+    multiplexer = SFTPSessionMultiplexer(Mock(), primary, 4)
+    first = multiplexer.acquire()
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        waiting = executor.submit(multiplexer.acquire)
+        deadline = time.time() + 5
+        while multiplexer.max_sessions != 1 and time.time() < deadline:
+            time.sleep(0.01)
+        assert multiplexer.max_sessions == 1
+        multiplexer.release(first)
+        assert waiting.result(timeout=5) is primary
+    assert multiplexer.size() == 1
+    assert mock_from_transport.call_count == 1
+
+
+@patch('paramiko.SFTPClient.from_transport')
+def test_session_multiplexer_opens_sessions_outside_its_lock(mock_from_transport):
+    """Testing scenario -
+            Testing SFTPSessionMultiplexer while a new session takes long to open and SUT should let other callers
+            release and check out the sessions already open in the meantime."""
+    primary = Mock()
+    opening = threading.Event()
+    opened = threading.Event()
+
+    def slow_open(transport):
+        opening.set()
+        opened.wait(5)
+        return Mock()
+
+    mock_from_transport.side_effect = slow_open
+    multiplexer = SFTPSessionMultiplexer(Mock(), primary, 2)
+    first = multiplexer.acquire()
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        second = executor.submit(multiplexer.acquire)
+        assert opening.wait(5)
+        started = time.monotonic()
+        multiplexer.release(first)
+        assert multiplexer.acquire() is primary
+        assert time.monotonic() - started < 1
+        opened.set()
+        assert second.result(timeout=5) is not primary
+    assert multiplexer.size() == 2
+
+
+@patch('paramiko.SFTPClient.from_transport')
+def test_session_multiplexer_keeps_its_cap_when_transport_dropped(mock_from_transport):
+    """Testing scenario -
+            Testing SFTPSessionMultiplexer when a session cannot be opened because the connection dropped and SUT
+            should raise the error without lowering max_sessions to the sessions open so far."""
+    transport = Mock()
+    transport.is_active.return_value = False
+    mock_from_transport.side_effect = SSHException('SSH session not active')
+    multiplexer = SFTPSessionMultiplexer(transport, Mock(), 4)
+    multiplexer.acquire()
+    with pytest.raises(SSHException):
+        multiplexer.acquire()
+    assert multiplexer.max_sessions == 4
+
+
+def test_session_multiplexer_stops_at_server_max_sessions(tmp_path):
+    """Testing scenario -
+            Testing SFTPSessionMultiplexer against a local SFTP server limited to 2 sessions per connection and SUT
+            should keep working with the 2 sessions the server allows."""
+    (tmp_path / 'a.csv').write_bytes(b'id\n1\n')
+    with LocalSFTPServerRunner(str(tmp_path), max_sessions=2) as server:
+        conn = connection(server.config(max_sessions=4))
+        try:
+            sessions = [conn.sessions.acquire(), conn.sessions.acquire()]
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                waiting = executor.submit(conn.sessions.acquire)
+                deadline = time.time() + 5
+                while conn.sessions.max_sessions != 2 and time.time() < deadline:
+                    time.sleep(0.01)
+                assert conn.sessions.max_sessions == 2
+                conn.sessions.release(sessions[1])
+                assert waiting.result(timeout=5).stat('/a.csv').st_size == 5
+        finally:
+            conn.close()
+
+
+
+def test_prefer_algorithms_puts_supported_preferences_first():
+    available = ('aes128-ctr', 'aes256-ctr', 'aes128-gcm@openssh.com')
+    ordered = prefer_algorithms(['aes128-gcm@openssh.com', 'chacha20-poly1305@openssh.com'], available, 'ciphers')
+    assert ordered == ('aes128-gcm@openssh.com', 'aes128-ctr', 'aes256-ctr')
+
+
+def test_connect_applies_compression_and_preferred_algorithms():
+    """Testing scenario -
+            Testing the connection setup with compression disabled and preferred ciphers and MACs and SUT should
+            disable transport compression and offer the preferred algorithms first."""
+    with patch('paramiko.SFTPClient.from_transport'), patch('paramiko.Transport') as mock_transport, \
+            patch('socket.create_connection'):
+        options = mock_transport.return_value.get_security_options.return_value
+        options.ciphers = ('aes128-ctr', 'aes256-gcm@openssh.com')
+        options.digests = ('hmac-sha2-256', 'hmac-sha2-512-etm@openssh.com')
+        conn = connection({'host': '', 'username': '', 'compression': False,
+                           'preferred_ciphers': ['aes256-gcm@openssh.com'],
+                           'preferred_macs': ['hmac-sha2-512-etm@openssh.com']})
+        conn.sftp
+        mock_transport.return_value.use_compression.assert_called_with(False)
+        assert options.ciphers == ('aes256-gcm@openssh.com', 'aes128-ctr')
+        assert options.digests == ('hmac-sha2-512-etm@openssh.com', 'hmac-sha2-256')
+
+
+@pytest.mark.parametrize("filepath, file_size, compression, uses_main_connection", [
+    ("/sftp_path/test.csv", defaults.UNCOMPRESSED_TRANSFER_MIN_BYTES, 'auto', True),
+    ("/sftp_path/test.csv.gz", defaults.UNCOMPRESSED_TRANSFER_MIN_BYTES - 1, 'auto', True),
+    ("/sftp_path/test.csv.gz", defaults.UNCOMPRESSED_TRANSFER_MIN_BYTES, True, True),
+    ("/sftp_path/test.csv.gz", defaults.UNCOMPRESSED_TRANSFER_MIN_BYTES, 'auto', False),
+    ("/sftp_path/test.xlsx.gpg", defaults.UNCOMPRESSED_TRANSFER_MIN_BYTES, 'auto', False),
+])
+def test_transfer_connection_skips_compression_for_compressed_payloads(filepath, file_size, compression,
+                                                                       uses_main_connection, sftp_client):
+    sftp_client.compression = compression
+    conn = sftp_client.transfer_connection({"filepath": filepath, "file_size": file_size})
+    assert (conn is sftp_client) == uses_main_connection
+    if not uses_main_connection:
+        assert conn.compression is False
+        assert sftp_client.transfer_connection({"filepath": filepath, "file_size": file_size}) is conn
+
+
+
 
 
 # TODO
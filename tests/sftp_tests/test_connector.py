@@ -0,0 +1,153 @@
+import socket
+import time
+from unittest.mock import Mock, patch
+import pytest
+from paramiko.ssh_exception import AuthenticationException, SSHException  # type: ignore
+from file_processors.utils.symon_exception import SymonException  # type: ignore
+from tap_sftp import connector
+from tap_sftp.client import connection
+from tap_sftp.connector import CircuitBreaker, Connector
+from tests.configuration.sftp_server import LocalSFTPServerRunner
+
+
+@pytest.fixture
+def clock():
+    """ Replaces the connector's clock with one that only moves when it sleeps. """
+    now = [1000.0]
+
+    def sleep(seconds):
+        now[0] += seconds
+
+    with patch('tap_sftp.connector.time.monotonic', side_effect=lambda: now[0]), \
+            patch('tap_sftp.connector.time.sleep', side_effect=sleep) as mock_sleep:
+        yield mock_sleep
+
+
+def build_connector(**kwargs):
+    kwargs.setdefault('breaker', CircuitBreaker(threshold=10))
+    conn = Connector('host', 22, **kwargs)
+    conn.open_socket = Mock()
+    return conn
+
+
+def test_connect_retries_transient_failures(clock):
+    establish = Mock(side_effect=[EOFError(), SSHException('Error reading SSH protocol banner'), 'transport'])
+    with patch('tap_sftp.connector.singer.metrics.log') as mock_log:
+        assert build_connector().connect(establish) == 'transport'
+    assert establish.call_count == 3
+    points = [call.args[1] for call in mock_log.call_args_list]
+    assert [(point.metric, point.tags['attempt'], point.tags['status']) for point in points] == \
+        [('sftp_connect', 1, 'failed'), ('sftp_connect', 2, 'failed'), ('sftp_connect', 3, 'succeeded')]
+    assert points[0].tags['error'] == 'EOFError'
+
+
+def test_connect_does_not_retry_authentication_errors(clock):
+    establish = Mock(side_effect=AuthenticationException('Authentication failed.'))
+    with pytest.raises(SymonException, match='Authentication failed'):
+        build_connector().connect(establish)
+    establish.assert_called_once()
+
+
+def test_connect_gives_up_at_the_deadline(clock):
+    """Testing scenario -
+            Testing connect against a host that keeps failing and SUT should stop retrying once the next jittered
+            wait would run past the overall deadline, well before running out of attempts."""
+    establish = Mock(side_effect=ConnectionRefusedError())
+    with patch('tap_sftp.connector.random.uniform', side_effect=lambda low, high: high):
+        with pytest.raises(SymonException, match='Failed to connect'):
+            build_connector(deadline=10, max_attempts=20).connect(establish)
+    # waits of 1, 2 and 4 seconds fit in the deadline, the next one of 8 does not
+    assert [call.args[0] for call in clock.call_args_list] == [1, 2, 4]
+    assert establish.call_count == 4
+
+
+def test_circuit_breaker_fails_fast_once_open(clock):
+    breaker = CircuitBreaker(threshold=2, reset_after=60)
+    establish = Mock(side_effect=socket.timeout())
+    with pytest.raises(SymonException):
+        build_connector(breaker=breaker, max_attempts=5).connect(establish)
+    assert establish.call_count == 2
+
+    # a second worker does not try the host at all while the circuit is open
+    with pytest.raises(SymonException):
+        build_connector(breaker=breaker).connect(establish)
+    assert establish.call_count == 2
+
+
+def test_circuit_breaker_lets_one_probe_through_after_reset():
+    breaker = CircuitBreaker(threshold=1, reset_after=60)
+    breaker.record_failure(EOFError())
+    assert not breaker.allow()
+
+    breaker.opened_at = time.monotonic() - 61
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.record_failure(EOFError())
+    assert not breaker.allow()
+
+    breaker.opened_at = time.monotonic() - 61
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.allow()
+    assert breaker.allow()
+
+
+def test_circuit_breaker_reopens_after_probe_fails_unexpectedly(clock):
+    """Testing scenario -
+            Testing a probe of an open circuit that fails with an error outside the handled ones and SUT should open
+            the circuit again, so another probe is let through once it resets instead of failing fast for good."""
+    breaker = CircuitBreaker(threshold=1, reset_after=60)
+    breaker.record_failure(EOFError())
+    breaker.opened_at -= 61
+    with pytest.raises(ValueError):
+        build_connector(breaker=breaker).connect(Mock(side_effect=ValueError('unexpected')))
+    assert not breaker.probing
+    assert not breaker.allow()
+
+    breaker.opened_at -= 61
+    assert build_connector(breaker=breaker).connect(Mock(return_value='transport')) == 'transport'
+
+
+def test_breaker_for_is_shared_per_host():
+    assert connector.breaker_for('shared-host', 22) is connector.breaker_for('shared-host', 22)
+    assert connector.breaker_for('shared-host', 22) is not connector.breaker_for('shared-host', 2222)
+
+
+def test_connection_times_out_waiting_for_the_banner():
+    """Testing scenario -
+            Testing a connection to a server that accepts the TCP connection but never sends its SSH banner and SUT
+            should give up after the banner timeout instead of waiting forever."""
+    with socket.socket() as server:
+        server.bind(('127.0.0.1', 0))
+        server.listen(4)
+        started = time.monotonic()
+        conn = connection({'host': '127.0.0.1', 'port': server.getsockname()[1], 'username': 'user',
+                           'password': 'password', 'banner_timeout': 0.5, 'connect_retries': 1,
+                           'circuit_breaker_threshold': 10})
+        with pytest.raises(SymonException, match='Failed to connect'):
+            conn.sftp
+    assert time.monotonic() - started < 10
+
+
+def test_connection_rejects_wrong_password_without_retrying(tmp_path):
+    with LocalSFTPServerRunner(str(tmp_path)) as server:
+        conn = connection(server.config(password='wrong'))
+        with patch('tap_sftp.connector.Connector.open_socket', autospec=True,
+                   side_effect=Connector.open_socket) as open_socket:
+            with pytest.raises(SymonException, match='Authentication failed'):
+                conn.sftp
+    open_socket.assert_called_once()
+
+
+@pytest.mark.parametrize("connect_retries, attempts", [(None, 3), (1, 2)])
+@patch('tap_sftp.defaults.CONNECT_ATTEMPTS', 3)
+def test_connection_attempts_default_unless_retries_configured(connect_retries, attempts, clock):
+    with socket.socket() as server:
+        server.bind(('127.0.0.1', 0))
+        port = server.getsockname()[1]
+    conn = connection({'host': '127.0.0.1', 'port': port, 'username': 'user', 'password': 'password',
+                       'connect_retries': connect_retries, 'circuit_breaker_threshold': 10})
+    with patch('tap_sftp.connector.Connector.open_socket', side_effect=ConnectionRefusedError) as open_socket:
+        with pytest.raises(SymonException, match='Failed to connect'):
+            conn.sftp
+    assert open_socket.call_count == attempts
@@ -1,7 +1,7 @@
 from datetime import datetime
 from unittest.mock import patch, mock_open
 from tap_sftp import defaults
-from tap_sftp.discover import discover_streams
+from tap_sftp.discover import discover_streams, select_sample_files
 import pytest
 from tests.configuration.fixtures import sftp_client, file_handle
 
@@ -177,3 +177,116 @@ def test_discover_streams_with_large_file(mock_connection, mock_sftp_client):
     mock_sftp_client.get_files.return_value = files
     with pytest.raises(BaseException):
         discover_streams(config)
+
+
+@patch('tap_sftp.client.SFTPConnection')
+@patch('tap_sftp.client.connection')
+@patch('file_processors.clients.csv_client.CSVClient.build_streams')
+def test_discover_streams_samples_newest_files_and_merges_schemas(mock_build_streams, mock_connection,
+                                                                  mock_sftp_client):
+    """Testing scenario -
+            Testing discover_streams with three matching files and discovery_sample_files set to 2 and SUT should
+            sample only the two newest files and merge their schemas into a single stream."""
+    table_specs = [{
+        "table_name": "test1",
+        "file_type": "csv",
+        "search_prefix": "/test_tmp/bin",
+        "search_pattern": "test.*.csv",
+        "key_properties": []
+    }]
+    config = {
+        "host": "host",
+        "port": 22,
+        "username": "user",
+        "password": "password",
+        "search_subdirectories": True,
+        "start_date": "1800-01-01",
+        "tables": table_specs,
+        "discovery_sample_files": 2
+    }
+    files = [{"id": 1, "filepath": "/test_tmp/bin/test_old.csv", "last_modified": date_modified_since_oldest,
+              "file_size": 100},
+             {"id": 2, "filepath": "/test_tmp/bin/test_new.csv", "last_modified": date_modified_since_recent,
+              "file_size": 100},
+             {"id": 3, "filepath": "/test_tmp/bin/test_mid.csv", "last_modified": date_modified_since_old,
+              "file_size": 100}]
+    newest_stream = {'tap_stream_id': 'test1',
+                     'schema': {'type': 'object', 'properties': {'id': {'type': ['null', 'integer']},
+                                                                 'date': {'type': ['null', 'string'],
+                                                                          'format': 'date-time'}}},
+                     'metadata': [{'breadcrumb': [], 'metadata': {}},
+                                  {'breadcrumb': ['properties', 'id'], 'metadata': {'inclusion': 'available'}}]}
+    older_stream = {'tap_stream_id': 'test1',
+                    'schema': {'type': 'object', 'properties': {'id': {'type': ['null', 'string']},
+                                                                'date': {'type': ['null', 'string']},
+                                                                'name': {'type': ['null', 'string']}}},
+                    'metadata': [{'breadcrumb': [], 'metadata': {}},
+                                 {'breadcrumb': ['properties', 'name'], 'metadata': {'inclusion': 'available'}}]}
+    mock_connection.return_value = mock_sftp_client
+    mock_sftp_client.get_files.return_value = files
+    mock_build_streams.side_effect = [[newest_stream], [older_stream]]
+    result_streams = discover_streams(config)
+
+    sampled_files = [call.args[0] for call in mock_sftp_client.get_file_handle_for_sample.call_args_list]
+    assert [f['id'] for f in sampled_files] == [2, 3]
+    assert result_streams == [{
+        'tap_stream_id': 'test1',
+        'schema': {'type': 'object', 'properties': {'id': {'type': ['null', 'integer', 'string']},
+                                                    'date': {'type': ['null', 'string']},
+                                                    'name': {'type': ['null', 'string']}}},
+        'metadata': [{'breadcrumb': [], 'metadata': {}},
+                     {'breadcrumb': ['properties', 'id'], 'metadata': {'inclusion': 'available'}},
+                     {'breadcrumb': ['properties', 'name'], 'metadata': {'inclusion': 'available'}}]}]
+
+
+@pytest.mark.parametrize("sample_files, sample_bytes, expected_ids", [
+    (1, None, [1]),
+    (3, None, [1, 2, 3]),
+    (3, 250, [1, 2]),
+    (3, 10, [1]),
+    (0, None, [1]),
+])
+def test_select_sample_files(sample_files, sample_bytes, expected_ids):
+    sorted_files = [{"id": i, "file_size": 100} for i in [1, 2, 3]]
+    config = {"discovery_sample_files": sample_files, "discovery_sample_bytes": sample_bytes}
+    assert [f['id'] for f in select_sample_files(config, sorted_files)] == expected_ids
+
+
+@patch('tap_sftp.client.SFTPConnection')
+@patch('tap_sftp.client.connection')
+@patch('file_processors.clients.excel_client.ExcelClient.build_streams')
+def test_discover_streams_samples_xlsx_without_download(mock_build_streams, mock_connection, mock_sftp_client):
+    """Testing scenario -
+            Testing discover_streams with an unencrypted xlsx file and SUT should build the streams from a partial
+            copy of the workbook instead of downloading the whole file."""
+    worksheets = ["sheet1"]
+    table_specs = [{
+        "table_name": "test1",
+        "file_type": "excel",
+        "search_prefix": "/test_tmp/bin",
+        "search_pattern": "test1.xlsx",
+        "key_properties": [],
+        "worksheets": worksheets
+    }]
+    config = {
+        "host": "host",
+        "port": 22,
+        "username": "user",
+        "password": "password",
+        "search_subdirectories": True,
+        "start_date": "1800-01-01",
+        "tables": table_specs
+    }
+    streams = [{'tap_stream_id': 'test1', 'schema': {"type": "object", "properties": {}}}]
+    files = [{"id": 1, "filepath": "/test_tmp/bin/test1.xlsx", "last_modified": date_modified_since_oldest,
+              "file_size": 12404}]
+    mock_connection.return_value = mock_sftp_client
+    mock_sftp_client.get_files.return_value = files
+    mock_sftp_client.get_workbook_handle_for_sample.return_value.__enter__.return_value = mock_open
+    mock_build_streams.return_value = streams
+    result_streams = discover_streams(config)
+    mock_sftp_client.get_workbook_handle_for_sample.assert_called_once_with(files[0], worksheets,
+                                                                            defaults.SAMPLE_SIZE)
+    mock_sftp_client.get_file_handle.assert_not_called()
+    mock_build_streams.assert_called_with(mock_open, defaults.SAMPLE_SIZE, worksheets=worksheets)
+    assert result_streams == streams
@@ -0,0 +1,108 @@
+import json
+from datetime import datetime
+from unittest.mock import patch, Mock
+import pytest
+import pytz  # type: ignore
+from tap_sftp import defaults, encoding_detection
+from tap_sftp.encoding_detection import EncodingCache
+from tests.configuration.fixtures import sftp_client
+
+remote_file = {"filepath": "/sftp_path/test.csv", "file_size": 100,
+               "last_modified": datetime(2024, 1, 1, tzinfo=pytz.UTC)}
+
+
+class FakeContent():
+    """ Stands in for a file's content, recording the size of every leading window read. """
+
+    def __init__(self, data):
+        self.data = data
+        self.reads = []
+
+    def __call__(self, size):
+        self.reads.append(size)
+        return self.data[:size]
+
+
+@patch('file_processors.utils.find_encoding.find_encoding_v2')
+def test_detect_encoding_reads_only_leading_window(mock_find_encoding):
+    """Testing scenario -
+            Testing detect_encoding on content much larger than the window and SUT should detect the encoding from
+            the leading window only, cut after its last complete line."""
+    samples = []
+
+    def find_encoding_v2(path):
+        with open(path, 'rb') as sample_file:
+            samples.append(sample_file.read())
+        return 'utf-8'
+
+    mock_find_encoding.side_effect = find_encoding_v2
+    content = FakeContent('id,name\n1,café\n'.encode('utf-8') * 1000000)
+    assert encoding_detection.detect_encoding(content) == 'utf-8'
+    assert content.reads == [defaults.ENCODING_SAMPLE_BYTES]
+    assert len(samples[0]) <= defaults.ENCODING_SAMPLE_BYTES
+    assert samples[0].endswith(b'\n')
+
+
+@pytest.mark.parametrize("data", [b'id,name,city\n1,Smith,Boston\n' * 200000,
+                                  'id,name,city\n1,Müller,Zürich\n'.encode('latin-1') * 200000],
+                         ids=['ascii', 'latin-1'])
+@patch('file_processors.utils.find_encoding.find_encoding_v2')
+def test_detect_encoding_stops_at_first_window_when_confident(mock_find_encoding, data):
+    """Testing scenario -
+            Testing detect_encoding on ASCII and latin-1 content of several MB and SUT should be confident enough
+            after the first window to neither read nor detect from a larger one."""
+    mock_find_encoding.return_value = 'ISO-8859-1'
+    content = FakeContent(data)
+    assert encoding_detection.detect_encoding(content) == 'ISO-8859-1'
+    assert content.reads == [defaults.ENCODING_SAMPLE_BYTES]
+
+
+@patch('file_processors.utils.find_encoding.find_encoding_v2')
+def test_detect_encoding_reads_small_content_once(mock_find_encoding):
+    mock_find_encoding.return_value = 'utf-8'
+    content = FakeContent(b'id,name\n1,a')
+    assert encoding_detection.detect_encoding(content) == 'utf-8'
+    assert content.reads == [defaults.ENCODING_SAMPLE_BYTES]
+
+
+def test_encoding_cache_persists_across_runs(tmp_path):
+    path = str(tmp_path / 'encodings.json')
+    key = encoding_detection.cache_key('host', 22, remote_file)
+    cache = EncodingCache(path)
+    assert cache.get(key) is None
+    cache.put(key, 'utf-16')
+    cache.save()
+
+    reloaded = EncodingCache(path)
+    assert reloaded.get(key) == 'utf-16'
+    assert (reloaded.hits, reloaded.misses) == (1, 0)
+    with open(path, encoding='utf-8') as cache_file:
+        assert json.load(cache_file) == {'files': [[key, 'utf-16']]}
+
+
+def test_encoding_cache_key_changes_with_file():
+    rewritten_file = dict(remote_file, file_size=200)
+    assert encoding_detection.cache_key('host', 22, remote_file) != \
+        encoding_detection.cache_key('host', 22, rewritten_file)
+
+
+def test_encoding_cache_evicts_least_recently_used():
+    cache = EncodingCache(max_entries=2)
+    cache.put('a', 'utf-8')
+    cache.put('b', 'utf-8')
+    cache.get('a')
+    cache.put('c', 'utf-8')
+    assert list(cache.entries) == ['a', 'c']
+
+
+@patch('tap_sftp.encoding_detection.detect_encoding')
+def test_detect_encoding_once_per_file(mock_detect_encoding, sftp_client):
+    """Testing scenario -
+            Testing SFTPConnection.detect_encoding twice for the same file and SUT should detect it once and serve
+            the second call from the encoding cache."""
+    sftp_client.encoding_cache = EncodingCache()
+    mock_detect_encoding.return_value = 'utf-8'
+    read_leading_bytes = Mock()
+    assert sftp_client.detect_encoding(remote_file, read_leading_bytes) == 'utf-8'
+    assert sftp_client.detect_encoding(remote_file, read_leading_bytes) == 'utf-8'
+    mock_detect_encoding.assert_called_once_with(read_leading_bytes)
@@ -0,0 +1,114 @@
+import io
+import random
+import string
+import zipfile
+from unittest.mock import Mock
+from tap_sftp import excel_sample
+from tap_sftp.transfer import RemoteRangeFile
+
+MAIN_NS = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+REL_NS = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+PACKAGE_REL_NS = 'http://schemas.openxmlformats.org/package/2006/relationships'
+
+
+def build_worksheet(row_count):
+    rows = ''.join(
+        f'<row r="{r}"><c r="A{r}" t="inlineStr"><is><t>'
+        f'{"".join(random.choices(string.ascii_letters, k=40))}</t></is></c></row>' for r in range(1, row_count + 1))
+    return (f'<worksheet xmlns="{MAIN_NS}"><dimension ref="A1:A{row_count}"/><sheetData>{rows}</sheetData>'
+            f'<mergeCells count="0"/></worksheet>')
+
+
+def build_workbook(sheets):
+    """ Builds a minimal xlsx holding one worksheet part per (name, row_count). """
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as workbook:
+        workbook.writestr('[Content_Types].xml', '<Types/>')
+        workbook.writestr('_rels/.rels', f'<Relationships xmlns="{PACKAGE_REL_NS}"><Relationship Id="rId1" '
+                          f'Type="{excel_sample.OFFICE_DOCUMENT_REL}" Target="xl/workbook.xml"/></Relationships>')
+        workbook.writestr('xl/workbook.xml', f'<workbook xmlns="{MAIN_NS}" xmlns:r="{REL_NS}"><sheets>' + ''.join(
+            f'<sheet name="{name}" sheetId="{i}" r:id="rId{i}"/>' for i, (name, _) in enumerate(sheets, 1))
+            + '</sheets></workbook>')
+        workbook.writestr('xl/_rels/workbook.xml.rels', f'<Relationships xmlns="{PACKAGE_REL_NS}">' + ''.join(
+            f'<Relationship Id="rId{i}" Type="{REL_NS}/worksheet" Target="worksheets/sheet{i}.xml"/>'
+            for i in range(1, len(sheets) + 1))
+            + f'<Relationship Id="rIdStrings" Type="{REL_NS}/sharedStrings" Target="sharedStrings.xml"/>'
+            + '</Relationships>')
+        workbook.writestr('xl/sharedStrings.xml', f'<sst xmlns="{MAIN_NS}"/>')
+        for i, (_, row_count) in enumerate(sheets, 1):
+            workbook.writestr(f'xl/worksheets/sheet{i}.xml', build_worksheet(row_count))
+    return buffer.getvalue()
+
+
+def build_remote_file(data):
+    remote_file = Mock()
+    remote_file.readv.side_effect = lambda chunks: [data[offset:offset + length] for offset, length in chunks]
+    return remote_file
+
+
+def test_sample_workbook_reads_leading_rows_only(tmp_path):
+    """Testing scenario -
+            Testing sample_workbook against a large remote workbook with two worksheets, one of them requested, and SUT
+            should copy the workbook parts, cut the requested worksheet after the sampled rows, leave the other one
+            empty and only transfer a small fraction of the remote file."""
+    data = build_workbook([('Sheet1', 20000), ('Sheet2', 20000)])
+    range_file = RemoteRangeFile(build_remote_file(data), len(data), block_size=16 * 1024)
+    out_path = str(tmp_path / 'sample.xlsx')
+    excel_sample.sample_workbook(range_file, out_path, ['Sheet1'], max_records=10)
+
+    with zipfile.ZipFile(out_path) as sample:
+        assert sample.read('xl/workbook.xml').startswith(b'<workbook')
+        assert sample.read('xl/sharedStrings.xml') == f'<sst xmlns="{MAIN_NS}"/>'.encode()
+        sheet1 = sample.read('xl/worksheets/sheet1.xml').decode()
+        sheet2 = sample.read('xl/worksheets/sheet2.xml')
+    assert sheet1.count('</row>') == 11
+    assert '<dimension ref="A1:A11"/>' in sheet1
+    assert sheet1.endswith('</row></sheetData></worksheet>')
+    assert sheet2 == excel_sample.EMPTY_WORKSHEET
+    assert range_file.bytes_read < len(data) / 10
+
+
+def test_sample_workbook_keeps_small_worksheets_whole(tmp_path):
+    data = build_workbook([('Sheet1', 5)])
+    range_file = RemoteRangeFile(build_remote_file(data), len(data))
+    out_path = str(tmp_path / 'sample.xlsx')
+    excel_sample.sample_workbook(range_file, out_path, max_records=10)
+
+    with zipfile.ZipFile(io.BytesIO(data)) as source, zipfile.ZipFile(out_path) as sample:
+        assert sample.read('xl/worksheets/sheet1.xml') == source.read('xl/worksheets/sheet1.xml')
+
+
+def test_sample_workbook_leaves_out_media(tmp_path):
+    """Testing scenario -
+            Testing sample_workbook against a workbook whose worksheet shows a large image and SUT should leave the
+            drawing and the image out of the sample, together with the relationship to them, without reading them."""
+    buffer = io.BytesIO(build_workbook([('Sheet1', 5)]))
+    with zipfile.ZipFile(buffer, 'a', zipfile.ZIP_STORED) as workbook:
+        workbook.writestr('xl/worksheets/_rels/sheet1.xml.rels', f'<Relationships xmlns="{PACKAGE_REL_NS}">'
+                          f'<Relationship Id="rId1" Type="{REL_NS}/drawing" Target="../drawings/drawing1.xml"/>'
+                          f'<Relationship Id="rId2" Type="{REL_NS}/table" Target="../tables/table1.xml"/>'
+                          f'<Relationship Id="rId3" Type="{REL_NS}/hyperlink" Target="https://example.com" '
+                          f'TargetMode="External"/></Relationships>')
+        workbook.writestr('xl/tables/table1.xml', f'<table xmlns="{MAIN_NS}" ref="A1:A5"/>')
+        workbook.writestr('xl/drawings/drawing1.xml', '<wsDr/>')
+        workbook.writestr('xl/media/image1.png', random.randbytes(4 * 1024 * 1024))
+    data = buffer.getvalue()
+    range_file = RemoteRangeFile(build_remote_file(data), len(data), block_size=16 * 1024)
+    out_path = str(tmp_path / 'sample.xlsx')
+    excel_sample.sample_workbook(range_file, out_path, max_records=10)
+
+    with zipfile.ZipFile(out_path) as sample:
+        names = sample.namelist()
+        sheet_rels = sample.read('xl/worksheets/_rels/sheet1.xml.rels').decode()
+    assert 'xl/media/image1.png' not in names
+    assert 'xl/drawings/drawing1.xml' not in names
+    assert 'xl/tables/table1.xml' in names
+    assert 'drawing' not in sheet_rels
+    assert 'Id="rId2"' in sheet_rels and 'Id="rId3"' in sheet_rels
+    assert range_file.bytes_read < 128 * 1024
+
+
+def test_is_sampled():
+    assert excel_sample.is_sampled('/sftp_path/test.XLSX', None)
+    assert not excel_sample.is_sampled('/sftp_path/test.xls', None)
+    assert not excel_sample.is_sampled('/sftp_path/test.xlsx.gpg', {"key_name": "key"})
@@ -1,5 +1,6 @@
+import io
 from unittest.mock import patch, mock_open, Mock
-from tap_sftp import helper
+from tap_sftp import defaults, helper
 import pytest
 from tests.configuration.fixtures import sftp_client, file_handle, file_handle_second
 import singer  # type: ignore
@@ -12,6 +13,13 @@ from paramiko.sftp_file import SFTPFile  # type: ignore
 from file_processors.utils.capturer import GPGDataCapturer  # type: ignore
 
 
+@pytest.fixture(autouse=True)
+def clear_decryption_keys():
+    helper.DECRYPTION_KEYS.clear()
+    yield
+    helper.DECRYPTION_KEYS.clear()
+
+
 @patch('file_processors.utils.aws_ssm.AWS_SSM.get_parameter_value')
 def test_update_decryption_key_for_AWS_SSM(mock_get_parameter_value):
     key = 'PRIVATE_KEY'
@@ -63,7 +71,7 @@ def test_sample_file(mock_compression_infer, mock_open_file, file_handle):
     result_file = helper.sample_file(
         src_file_object, src_file_name, out_dir, max_records)
     assert result_file == file_path
-    assert mock_open_file.return_value.__enter__().write.call_count == 2
+    mock_open_file.return_value.__enter__().write.assert_called_once_with(b'Col1,Col2\ndata1,data2\n')
 
 
 @pytest.mark.parametrize("file_handle_second", ["../data/fake_file.txt"], indirect=True)
@@ -85,10 +93,82 @@ def test_sample_file_for_compressed_file(mock_compression_infer, mock_open_file,
     result_file = helper.sample_file(
         src_file_object, src_file_name, out_dir, max_records)
     assert result_file == file_path
-    assert mock_open_file.return_value.__enter__().write.call_count == 4
+    assert mock_open_file.return_value.__enter__().write.call_count == 2
     assert mock_ZipFile.return_value.__enter__().write.call_count == 2
 
 
+def test_sample_file_reads_remote_file_in_blocks(tmp_path):
+    """Testing scenario -
+            Testing sample_file on an uncompressed remote file and SUT should fetch it in large ranged reads, stop
+            once the sampled lines are found and write them at once."""
+    data = b'id,name\n' + b''.join(f'{i},name {i}\n'.encode() for i in range(200000))
+    src_file_object = Mock(spec=SFTPFile)
+    src_file_object.stat.return_value.st_size = len(data)
+    src_file_object.readv.side_effect = lambda chunks: [data[offset:offset + length] for offset, length in chunks]
+    result_file = helper.sample_file(src_file_object, "test1.csv", str(tmp_path), 1000)
+
+    assert result_file == f'{tmp_path}/test1.csv'
+    with open(result_file, 'rb') as sample:
+        assert sample.read() == b''.join(data.splitlines(keepends=True)[:1001])
+    src_file_object.readv.assert_called_once_with([(0, defaults.RANGE_READ_BLOCK_SIZE)])
+    src_file_object.read.assert_not_called()
+
+
+@pytest.mark.parametrize("max_records, expected", [
+    (0, b'a\n'),
+    (2, b'a\nb\nc\n'),
+    (5, b'a\nb\nc\nd'),
+])
+def test_read_leading_records(max_records, expected):
+    assert helper.read_leading_records(io.BytesIO(b'a\nb\nc\nd'), max_records) == expected
+    assert helper.read_leading_records(iter([b'a\n', b'b\n', b'c\n', b'd']), max_records) == expected
+
+
+@patch('file_processors.utils.aws_ssm.AWS_SSM.get_parameter_value')
+def test_update_decryption_key_fetches_each_key_once(mock_get_parameter_value):
+    mock_get_parameter_value.side_effect = ['KEY1', 'KEY2']
+    for _ in range(3):
+        decryption_configs = {"key_name": "key1", "key_storage_type": "AWS_SSM"}
+        helper.update_decryption_key(decryption_configs)
+        assert decryption_configs['key'] == 'KEY1'
+    helper.update_decryption_key({"key_name": "key2", "key_storage_type": "AWS_SSM"})
+    assert mock_get_parameter_value.call_count == 2
+
+
+@patch('os.environ')
+@patch('boto3.session')
+@patch('file_processors.utils.aws_secrets_manager.AWSSecretsManager.get_secret')
+def test_update_decryption_key_from_secrets_manager_once_per_run(mock_get_secret, mock_boto3, mock_os_environ):
+    """Testing scenario -
+            Testing update_decryption_key for every file of a run while the secret is rotated in Secrets Manager and
+            SUT should fetch the secret once, and not see the rotated secret until the run ends."""
+    secret = {'privateKeyEncoded': base64.b64encode(b'PRIVATE_KEY').decode('ascii'), 'passphrase': 'pass'}
+    mock_boto3.return_value = Mock()
+    mock_os_environ.get.return_value = 'region-1'
+    mock_get_secret.side_effect = [json.dumps(secret), json.dumps(dict(secret, passphrase='new'))]
+    for _ in range(3):
+        decryption_configs = {"key_name": "tap-sftp-key", "key_storage_type": "AWS_Secrets_Manager"}
+        helper.update_decryption_key(decryption_configs)
+        assert decryption_configs['key'] == b'PRIVATE_KEY'
+        assert decryption_configs['passphrase'] == 'pass'
+    mock_get_secret.assert_called_once_with('tap-sftp-key')
+
+
+@patch('time.monotonic')
+@patch('file_processors.utils.aws_ssm.AWS_SSM.get_parameter_value')
+def test_update_decryption_key_refetches_after_ttl(mock_get_parameter_value, mock_monotonic):
+    mock_get_parameter_value.side_effect = ['KEY1', 'ROTATED']
+    decryption_configs = {"key_name": "key1", "key_storage_type": "AWS_SSM", "key_cache_ttl": 60}
+    mock_monotonic.return_value = 1000
+    helper.update_decryption_key(decryption_configs)
+    mock_monotonic.return_value = 1059
+    helper.update_decryption_key(decryption_configs)
+    assert decryption_configs['key'] == 'KEY1'
+    mock_monotonic.return_value = 1060
+    helper.update_decryption_key(decryption_configs)
+    assert decryption_configs['key'] == 'ROTATED'
+
+
 def test_get_inner_file_extension_for_pgp_file():
     file_path = '/test_tmp/bin/test1.csv.pgp'
     extension = helper.get_inner_file_extension_for_pgp_file(file_path)
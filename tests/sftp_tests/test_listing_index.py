@@ -0,0 +1,157 @@
+import json
+import stat
+import sys
+import time
+from unittest.mock import patch
+import pytest
+from paramiko.sftp_attr import SFTPAttributes
+from tap_sftp import defaults, listing_index
+from tap_sftp.listing_index import ListingIndex, index_key
+from tests.configuration.fixtures import sftp_client
+
+directory_mtime = 1700000000
+
+
+def build_listing(*filenames):
+    listing = []
+    for filename in filenames:
+        attr = SFTPAttributes()
+        attr.filename = filename
+        attr.st_mode = stat.S_IFREG
+        attr.st_size = 10
+        attr.st_mtime = directory_mtime
+        listing.append(attr)
+    return listing
+
+
+def put_settled(index, key, mtime, listing, listed_at=1800000000):
+    """ Lists a directory twice at the same mtime, far enough apart for the second listing to be served. """
+    index.put(key, mtime, listing, listed_at)
+    index.put(key, mtime, listing, listed_at + defaults.LISTING_INDEX_RACY_SECONDS)
+
+
+def test_listing_index_serves_unchanged_directory(tmp_path):
+    index = ListingIndex(str(tmp_path / 'index.json'))
+    key = index_key('host', 22, '/Data')
+    put_settled(index, key, directory_mtime, build_listing('a.csv', 'b.csv'))
+    listing = index.get(key, directory_mtime)
+    assert [attr.filename for attr in listing] == ['a.csv', 'b.csv']
+    assert listing[0].st_size == 10
+    assert index.get(key, directory_mtime + 1) is None
+    assert (index.hits, index.misses) == (1, 1)
+
+
+def test_listing_index_ignores_directory_listed_right_after_it_changed(tmp_path):
+    index = ListingIndex(str(tmp_path / 'index.json'))
+    key = index_key('host', 22, '/Data')
+    now = time.time()
+    index.put(key, now, build_listing('a.csv'))
+    assert index.get(key, now) is None
+
+
+def test_listing_index_racy_guard_ignores_clock_skew(tmp_path):
+    """Testing scenario -
+            Testing the listing index against a server whose clock is an hour behind the local one and SUT should
+            still not serve a directory listed right after its mtime was first seen, and serve it once it was listed
+            again later at the same mtime."""
+    index = ListingIndex(str(tmp_path / 'index.json'))
+    key = index_key('host', 22, '/Data')
+    now = time.time()
+    server_mtime = int(now) - 3600
+    index.put(key, server_mtime, build_listing('a.csv'), now)
+    assert index.get(key, server_mtime) is None
+    index.put(key, server_mtime, build_listing('a.csv', 'b.csv'), now + defaults.LISTING_INDEX_RACY_SECONDS)
+    assert [attr.filename for attr in index.get(key, server_mtime)] == ['a.csv', 'b.csv']
+
+
+def test_listing_index_is_not_rewritten_by_hits(tmp_path):
+    path = tmp_path / 'index.json'
+    index = ListingIndex(str(path))
+    key = index_key('host', 22, '/Data')
+    put_settled(index, key, directory_mtime, build_listing('a.csv'))
+    index.save()
+    saved_at = path.stat().st_mtime_ns
+    reloaded = ListingIndex(str(path))
+    assert reloaded.get(key, directory_mtime) is not None
+    assert not reloaded.dirty
+    reloaded.save()
+    assert path.stat().st_mtime_ns == saved_at
+
+
+def test_listing_index_evicts_least_recently_used(tmp_path):
+    index = ListingIndex(str(tmp_path / 'index.json'), max_directories=2)
+    for directory in ['/a', '/b']:
+        put_settled(index, index_key('host', 22, directory), directory_mtime, build_listing('a.csv'))
+    index.get(index_key('host', 22, '/a'), directory_mtime)
+    index.put(index_key('host', 22, '/c'), directory_mtime, build_listing('a.csv'))
+    assert list(index.entries) == [index_key('host', 22, '/a'), index_key('host', 22, '/c')]
+
+
+def test_listing_index_saves_atomically_and_reloads(tmp_path):
+    path = tmp_path / 'index.json'
+    index = ListingIndex(str(path))
+    key = index_key('host', 22, '/Data')
+    put_settled(index, key, directory_mtime, build_listing('a.csv'))
+    index.save()
+    assert [p.name for p in tmp_path.iterdir()] == ['index.json']
+    reloaded = ListingIndex(str(path))
+    assert [attr.filename for attr in reloaded.get(key, directory_mtime)] == ['a.csv']
+
+
+def test_listing_index_ignores_corrupt_file(tmp_path):
+    path = tmp_path / 'index.json'
+    path.write_text('{not json')
+    assert ListingIndex(str(path)).entries == {}
+
+
+def test_invalidate_listing_index_command(tmp_path):
+    path = tmp_path / 'index.json'
+    index = ListingIndex(str(path))
+    index.put(index_key('host', 22, '/Data'), directory_mtime, build_listing('a.csv'))
+    index.put(index_key('other', 22, '/Data'), directory_mtime, build_listing('a.csv'))
+    index.save()
+    with patch.object(sys, 'argv', ['tap-sftp-invalidate-listing-index', str(path), '--host', 'host']):
+        listing_index.main()
+    assert [key for key, _ in json.loads(path.read_text())['directories']] == [index_key('other', 22, '/Data')]
+
+
+def test_invalidate_listing_index_prefix_stops_at_path_separator(tmp_path):
+    path = tmp_path / 'index.json'
+    index = ListingIndex(str(path))
+    for directory in ['/data/in', '/data/in/2024', '/data/inbox']:
+        index.put(index_key('host', 22, directory), directory_mtime, build_listing('a.csv'))
+    index.save()
+    with patch.object(sys, 'argv', ['tap-sftp-invalidate-listing-index', str(path), '--host', 'host',
+                                    '--prefix', '/data/in/']):
+        listing_index.main()
+    assert [key for key, _ in json.loads(path.read_text())['directories']] == [index_key('host', 22, '/data/inbox')]
+
+
+def test_invalidate_listing_index_prefix_requires_host(tmp_path):
+    path = tmp_path / 'index.json'
+    index = ListingIndex(str(path))
+    index.put(index_key('host', 22, '/data'), directory_mtime, build_listing('a.csv'))
+    index.save()
+    with patch.object(sys, 'argv', ['tap-sftp-invalidate-listing-index', str(path), '--prefix', '/data']):
+        with pytest.raises(SystemExit):
+            listing_index.main()
+    assert ListingIndex(str(path)).entries
+
+
+@patch('tap_sftp.defaults.LISTING_INDEX_RACY_SECONDS', 0)
+def test_get_files_by_prefix_uses_listing_index(tmp_path, sftp_client):
+    """Testing scenario -
+            Testing get_files_by_prefix with a listing index and SUT should list the directory on the first walk and
+            only stat it on the next walk while its mtime is unchanged."""
+    prefix = "/Data"
+    directory_attr = SFTPAttributes()
+    directory_attr.st_mtime = directory_mtime
+    sftp_client.listing_index = ListingIndex(str(tmp_path / 'index.json'))
+    sftp_client.sftp.stat.return_value = directory_attr
+    sftp_client.sftp.listdir_attr.return_value = build_listing('a.csv', 'b.csv')
+    first_walk = sftp_client.get_files_by_prefix(prefix)
+    second_walk = sftp_client.get_files_by_prefix(prefix)
+    assert first_walk == second_walk
+    assert sftp_client.sftp.listdir_attr.call_count == 1
+    assert sftp_client.sftp.stat.call_count == 2
+    assert (tmp_path / 'index.json').exists()
@@ -0,0 +1,82 @@
+import re
+import pytest
+from tap_sftp import matching
+from tap_sftp.matching import TableMatcher
+
+
+def search_each(tables, key):
+    """ Matches key against every table's pattern one by one, as stream groups were matched before the index. """
+    return [table for table in tables
+            if re.search(f"{re.escape(table['search_prefix'])}/{table['search_pattern']}", key)]
+
+
+tables = [
+    {"table_name": "orders", "search_prefix": "/test_tmp/bin", "search_pattern": "orders\\.csv"},
+    {"table_name": "orders_copy", "search_prefix": "/test_tmp/bin", "search_pattern": "orders\\.csv"},
+    {"table_name": "nested", "search_prefix": "/test_tmp", "search_pattern": "in/orders\\.csv"},
+    {"table_name": "spaced", "search_prefix": "/test tmp/my files", "search_pattern": "report\\ \\(1\\)\\.csv"},
+    {"table_name": "wildcard", "search_prefix": "/test_tmp/bin", "search_pattern": "test2(.*)"},
+    {"table_name": "unescaped_dot", "search_prefix": "/test_tmp/bin", "search_pattern": "test1.csv"},
+    {"table_name": "anchored", "search_prefix": "/test_tmp/bin", "search_pattern": "test3\\.csv$"},
+    {"table_name": "backreference", "search_prefix": "/data", "search_pattern": "(a+)_\\1\\.csv"},
+]
+
+
+@pytest.mark.parametrize("key", [
+    "/test_tmp/bin/orders.csv",
+    "/test_tmp/bin/orders.csv.zip",
+    "/archive/test_tmp/bin/orders.csv",
+    "/test_tmp/bin/orders_csv",
+    "/test tmp/my files/report (1).csv",
+    "/test_tmp/bin/test2_10.csv",
+    "/test_tmp/bin/test1_csv",
+    "/test_tmp/bin/test3.csv",
+    "/test_tmp/bin/test3.csv.zip",
+    "/data/aa_aa.csv",
+    "/data/aa_a.csv",
+    "/elsewhere/file.csv",
+])
+def test_table_matcher_matches_like_searching_each_pattern(key):
+    """Testing scenario -
+            Testing TableMatcher against literal, regex and uncombinable patterns and SUT should find the same tables
+            in the same order as searching every table's pattern on its own."""
+    assert TableMatcher(tables).match(key) == search_each(tables, key)
+
+
+def test_table_matcher_searches_every_alternation(monkeypatch):
+    monkeypatch.setattr(matching.defaults, 'TABLE_MATCHER_CHUNK', 2)
+    regex_tables = [{"table_name": f"t{i}", "search_prefix": "/data", "search_pattern": f"file_{i}_.*\\.csv"}
+                    for i in range(7)]
+    matcher = TableMatcher(regex_tables)
+    assert len(matcher.pattern_set.chunks) == 4
+    assert matcher.match("/data/file_6_x.csv") == [regex_tables[6]]
+
+
+def test_table_matcher_looks_up_dynamic_tables_by_name():
+    """Testing scenario -
+            Testing TableMatcher in dynamic mode and SUT should
+             - find a table by its predetermined file name, ignoring case
+             - add the dot back to a table name starting with *
+             - fall back to the tables' patterns for any other key."""
+    dynamic_tables = [{"table_name": "Orders.csv", "search_prefix": "/imports"},
+                      {"table_name": "Orders_csv", "search_prefix": "/imports"},
+                      {"table_name": "*hidden.csv", "search_prefix": "/imports"}]
+    matcher = TableMatcher(dynamic_tables, dynamic=True)
+    assert matcher.match("/imports/orders.CSV") == [dynamic_tables[0]]
+    assert matcher.match("/imports/orders_csv") == [dynamic_tables[1]]
+    assert matcher.match("/imports/.*hidden.csv") == [dynamic_tables[2]]
+    assert matcher.match("/old/imports/Orders.csv.zip") == [dynamic_tables[0]]
+    assert matcher.match("/imports/other.csv") == []
+
+
+@pytest.mark.parametrize("pattern, literal", [
+    (re.escape("orders (1).csv"), "orders (1).csv"),
+    (re.escape("naïve-#1 ~.csv"), "naïve-#1 ~.csv"),
+    ("orders\\.csv", "orders.csv"),
+    ("orders.csv", None),
+    ("orders\\d\\.csv", None),
+    ("(orders)\\.csv", None),
+    ("orders\\", None),
+])
+def test_literal_of(pattern, literal):
+    assert matching.literal_of(pattern) == literal
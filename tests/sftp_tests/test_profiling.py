@@ -0,0 +1,65 @@
+import json
+from unittest.mock import patch
+import pytest
+from tap_sftp import profiling
+from tap_sftp.profiling import RunProfile
+
+
+@pytest.fixture(autouse=True)
+def reset_profile():
+    profiling.PROFILE.reset()
+    yield
+    profiling.PROFILE.reset()
+
+
+def test_timer_records_phase_and_bytes():
+    """Testing scenario -
+            Testing a timed download that moved bytes and SUT should add the phase and the bytes to the run profile
+            and emit both a phase timer and a bytes counter as Singer metrics."""
+    with patch('tap_sftp.profiling.metrics.log') as mock_log:
+        with profiling.timer('download', '/sftp_path/a.csv', 1024 * 1024) as measurement:
+            measurement['transferred'] = 2 * 1024 * 1024
+
+    points = [call.args[1] for call in mock_log.call_args_list]
+    assert [(point.metric_type, point.metric) for point in points] == \
+        [('timer', 'sftp_phase_duration'), ('counter', 'sftp_bytes_transferred')]
+    assert points[0].tags == {'phase': 'download', 'file': '/sftp_path/a.csv', 'status': 'succeeded'}
+    assert points[1].value == 2 * 1024 * 1024
+    profile = profiling.PROFILE.to_dict()
+    assert profile['phases']['download']['count'] == 1
+    assert profile['files']['/sftp_path/a.csv']['bytes'] == 2 * 1024 * 1024
+
+
+def test_timer_does_not_count_bytes_of_failed_phase():
+    with patch('tap_sftp.profiling.metrics.log') as mock_log:
+        with pytest.raises(EOFError):
+            with profiling.timer('download', '/sftp_path/a.csv', 1024):
+                raise EOFError()
+
+    assert len(mock_log.call_args_list) == 1
+    assert mock_log.call_args.args[1].tags['status'] == 'failed'
+    assert profiling.PROFILE.to_dict()['files']['/sftp_path/a.csv']['bytes'] == 0
+
+
+def test_file_summary():
+    profile = RunProfile()
+    profile.add('download', 2.0, '/sftp_path/a.csv', 4 * 1024 * 1024)
+    profile.add('encoding', 0.5, '/sftp_path/a.csv')
+    profile.add('parse', 1.5, '/sftp_path/a.csv')
+    profile.add('connect', 0.3)
+
+    assert profile.file_summary('/sftp_path/a.csv') == (4 * 1024 * 1024, 2.0, [2.0, None, 0.5, 1.5])
+    assert profile.file_summary('/sftp_path/missing.csv') == (0, None, [None, None, None, None])
+
+
+def test_write_profile(tmp_path):
+    profile = RunProfile()
+    profile.add('connect', 0.25)
+    profile.add('download', 1.0, '/sftp_path/a.csv', 100)
+    profile.write(str(tmp_path / 'profile.json'))
+
+    with open(tmp_path / 'profile.json', 'r', encoding='utf-8') as profile_file:
+        written = json.load(profile_file)
+    assert written['bytes'] == 100
+    assert written['phases'] == {'connect': {'seconds': 0.25, 'count': 1}, 'download': {'seconds': 1.0, 'count': 1}}
+    assert written['files']['/sftp_path/a.csv']['phases'] == {'download': 1.0}
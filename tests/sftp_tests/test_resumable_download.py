@@ -0,0 +1,268 @@
+import filecmp
+import os
+from datetime import datetime
+from unittest.mock import patch
+import pytest
+import pytz  # type: ignore
+from tap_sftp import client
+from tests.configuration.sftp_server import LocalSFTPServerRunner
+
+FILE_SIZE = 3 * 1024 * 1024 + 17
+
+# paramiko's own readv prefetch threads fail when their connection is dropped under them
+pytestmark = pytest.mark.filterwarnings('ignore::pytest.PytestUnhandledThreadExceptionWarning')
+
+
+def write_remote_file(root, name, size=FILE_SIZE):
+    path = os.path.join(root, name)
+    with open(path, 'wb') as remote_file:
+        remote_file.write(os.urandom(size))
+    stat = os.stat(path)
+    return {"filepath": f'/{name}', "file_size": stat.st_size,
+            "last_modified": datetime.fromtimestamp(stat.st_mtime, tz=pytz.UTC)}
+
+
+@patch('tap_sftp.defaults.DOWNLOAD_RESUME_WAIT', 0)
+def test_download_resumes_after_dropped_connections(tmp_path):
+    """Testing scenario -
+            Testing download of a file while the server drops the connection twice during the transfer and SUT
+            should reconnect, continue from the bytes already written and produce an identical copy."""
+    root = tmp_path / 'remote'
+    root.mkdir()
+    f = write_remote_file(str(root), 'large.csv')
+    local_path = str(tmp_path / 'large.csv')
+    with LocalSFTPServerRunner(str(root), drop_at=[1024 * 1024 + 10, 2 * 1024 * 1024 + 10]) as server:
+        conn = client.connection(server.config(download_concurrency=1))
+        try:
+            with patch('tap_sftp.transfer.SequentialDownloader.download',
+                       autospec=True, side_effect=client.transfer.SequentialDownloader.download) as mock_download:
+                conn.download(f, local_path)
+        finally:
+            conn.close()
+    assert len(server.dropped) == 2
+    assert filecmp.cmp(root / 'large.csv', local_path, shallow=False)
+    # every attempt after the first continued from where the previous one stopped
+    resumed = [call.args[5] for call in mock_download.call_args_list]
+    assert resumed == [False, True, True]
+
+
+@patch('tap_sftp.defaults.DOWNLOAD_RESUME_WAIT', 0)
+def test_segmented_download_resumes_after_dropped_connection(tmp_path):
+    root = tmp_path / 'remote'
+    root.mkdir()
+    f = write_remote_file(str(root), 'large.csv.gz')
+    local_path = str(tmp_path / 'large.csv.gz')
+    with LocalSFTPServerRunner(str(root), drop_at=[2 * 1024 * 1024 + 10]) as server:
+        conn = client.connection(server.config(download_concurrency=2, download_segment_size=1024 * 1024))
+        try:
+            conn.download(f, local_path)
+        finally:
+            conn.close()
+    assert server.dropped == [2 * 1024 * 1024 + 10]
+    assert filecmp.cmp(root / 'large.csv.gz', local_path, shallow=False)
+
+
+@patch('tap_sftp.defaults.DOWNLOAD_RESUME_WAIT', 0)
+def test_download_restarts_when_file_changed(tmp_path):
+    """Testing scenario -
+            Testing download of a file that is rewritten remotely while the connection is down and SUT should not
+            resume the partial copy but download the new file from the start."""
+    root = tmp_path / 'remote'
+    root.mkdir()
+    f = write_remote_file(str(root), 'large.csv')
+    local_path = str(tmp_path / 'large.csv')
+    with LocalSFTPServerRunner(str(root), drop_at=[1024 * 1024 + 10]) as server:
+        drop_connection = server.drop_connection
+
+        def rewrite_and_drop(transport):
+            write_remote_file(str(root), 'large.csv', FILE_SIZE + 1000)
+            drop_connection(transport)
+
+        server.drop_connection = rewrite_and_drop
+        conn = client.connection(server.config(download_concurrency=1))
+        try:
+            conn.download(f, local_path)
+        finally:
+            conn.close()
+    assert os.path.getsize(local_path) == FILE_SIZE + 1000
+    assert filecmp.cmp(root / 'large.csv', local_path, shallow=False)
+
+
+def test_download_file_grown_since_listing(tmp_path):
+    """Testing scenario -
+            Testing download of a file that was appended to after it was listed and SUT should size the download from
+            a fresh stat and copy the whole current file instead of failing on the listed size."""
+    root = tmp_path / 'remote'
+    root.mkdir()
+    f = write_remote_file(str(root), 'large.csv', 4000)
+    with open(root / 'large.csv', 'ab') as remote_file:
+        remote_file.write(os.urandom(40))
+    local_path = str(tmp_path / 'large.csv')
+    with LocalSFTPServerRunner(str(root)) as server:
+        conn = client.connection(server.config(download_concurrency=1))
+        try:
+            conn.download(f, local_path)
+        finally:
+            conn.close()
+    assert os.path.getsize(local_path) == 4040
+    assert filecmp.cmp(root / 'large.csv', local_path, shallow=False)
+
+
+def test_segmented_download_restarts_when_file_grew(tmp_path):
+    """Testing scenario -
+            Testing segmented download of a file appended to while its segments are fetched and SUT should notice the
+            bytes past the last segment and download the file again instead of truncating it."""
+    root = tmp_path / 'remote'
+    root.mkdir()
+    f = write_remote_file(str(root), 'large.csv.gz', 400000)
+    local_path = str(tmp_path / 'large.csv.gz')
+    fetch_segments = client.transfer.SegmentedDownloader.fetch_segments
+    appended = []
+
+    def fetch_and_append(downloader, remote_path, fd, segments):
+        fetch_segments(downloader, remote_path, fd, segments)
+        if not appended:
+            with open(root / 'large.csv.gz', 'ab') as remote_file:
+                remote_file.write(os.urandom(40))
+            appended.append(True)
+
+    with LocalSFTPServerRunner(str(root)) as server, \
+            patch('tap_sftp.transfer.SegmentedDownloader.fetch_segments', autospec=True,
+                  side_effect=fetch_and_append) as mock_fetch:
+        conn = client.connection(server.config(download_concurrency=2, download_segment_size=100000))
+        try:
+            conn.download(f, local_path)
+        finally:
+            conn.close()
+    assert mock_fetch.call_count == 2
+    assert os.path.getsize(local_path) == 400040
+    assert filecmp.cmp(root / 'large.csv.gz', local_path, shallow=False)
+
+
+@patch('tap_sftp.defaults.DOWNLOAD_RESUME_WAIT', 0)
+@patch('file_processors.utils.decrypt.gpg_decrypt_to_file')
+def test_local_decryption_starts_over_when_file_changed(mock_decrypt_to_file, tmp_path):
+    """Testing scenario -
+            Testing local decryption of a file that is rewritten remotely while gpg is reading it and SUT should fail
+            the read instead of splicing the new file onto the bytes already read, and decrypt the new file from the
+            start."""
+    root = tmp_path / 'remote'
+    root.mkdir()
+    f = write_remote_file(str(root), 'large.csv.gpg')
+    read = []
+
+    def gpg_decrypt_to_file(src, key, gnupghome, passphrase, path, capturer, sign_key):
+        read.append(b'')
+        while True:
+            data = src.read(64 * 1024)
+            if not data:
+                break
+            read[-1] += data
+        with open(path, 'wb') as decrypted:
+            decrypted.write(read[-1])
+        return path
+
+    mock_decrypt_to_file.side_effect = gpg_decrypt_to_file
+    with LocalSFTPServerRunner(str(root), drop_at=[1024 * 1024 + 10]) as server:
+        drop_connection = server.drop_connection
+
+        def rewrite_and_drop(transport):
+            write_remote_file(str(root), 'large.csv.gpg', FILE_SIZE + 1000)
+            drop_connection(transport)
+
+        server.drop_connection = rewrite_and_drop
+        conn = client.connection(server.config(download_concurrency=1))
+        try:
+            with conn.get_file_handle(f, 'csv', 'utf-8', {'key': 'key', 'decrypt_remote': False}) as file_handle:
+                file_handle.read()
+        finally:
+            conn.close()
+    assert mock_decrypt_to_file.call_count == 2
+    assert read[-1] == (root / 'large.csv.gpg').read_bytes()
+
+
+@patch('tap_sftp.helper.load_file_decrypted')
+def test_remote_decryption_reads_file_grown_since_listing(mock_load_file_decrypted, tmp_path):
+    """Testing scenario -
+            Testing remote decryption of a file that grew between listing and sync and SUT should feed gpg the whole
+            current file rather than cut it at the listed size."""
+    root = tmp_path / 'remote'
+    root.mkdir()
+    f = write_remote_file(str(root), 'large.csv.gpg')
+    write_remote_file(str(root), 'large.csv.gpg', FILE_SIZE + 1000)
+    read = []
+
+    def load_file_decrypted(src, key, gnupghome, passphrase, path, max_records, sign_key):
+        read.append(src.read())
+        with open(path, 'wb') as decrypted:
+            decrypted.write(read[-1])
+        return path
+
+    mock_load_file_decrypted.side_effect = load_file_decrypted
+    with LocalSFTPServerRunner(str(root)) as server:
+        conn = client.connection(server.config())
+        try:
+            with conn.get_file_handle(f, 'csv', 'utf-8', {'key': 'key', 'decrypt_remote': True}) as file_handle:
+                file_handle.read()
+        finally:
+            conn.close()
+    assert read[0] == (root / 'large.csv.gpg').read_bytes()
+
+
+@patch('tap_sftp.helper.load_file_decrypted')
+def test_remote_decryption_raises_read_error_swallowed_by_gpg(mock_load_file_decrypted, tmp_path):
+    """Testing scenario -
+            Testing remote decryption when a block read fails and gpg ends without surfacing the error and SUT should
+            raise the read error rather than return the partly decrypted file."""
+    root = tmp_path / 'remote'
+    root.mkdir()
+    f = write_remote_file(str(root), 'large.csv.gpg')
+    read_block = client.transfer.PipelinedReader.fetch_block
+
+    def load_file_decrypted(src, key, gnupghome, passphrase, path, max_records, sign_key):
+        with open(path, 'wb') as decrypted:
+            try:
+                while True:
+                    data = src.read(64 * 1024)
+                    if not data:
+                        break
+                    decrypted.write(data)
+            except IOError:
+                pass
+        return path
+
+    def fetch_block(reader, offset, length):
+        if offset > 0:
+            raise IOError('connection dropped')
+        return read_block(reader, offset, length)
+
+    mock_load_file_decrypted.side_effect = load_file_decrypted
+    with LocalSFTPServerRunner(str(root)) as server, \
+            patch('tap_sftp.transfer.PipelinedReader.fetch_block', autospec=True, side_effect=fetch_block):
+        conn = client.connection(server.config())
+        try:
+            with pytest.raises(IOError, match='connection dropped'):
+                conn.get_file_handle(f, 'csv', 'utf-8',
+                                     {'key': 'key', 'decrypt_remote': True, 'read_block_size': 1024 * 1024})
+        finally:
+            conn.close()
+
+
+def test_following_download_stops_when_reader_fails(tmp_path):
+    """Testing scenario -
+            Testing a download followed by a consumer that fails after its first read and SUT should raise the
+            consumer's error once the download stopped, without fetching the rest of the file."""
+    root = tmp_path / 'remote'
+    root.mkdir()
+    f = write_remote_file(str(root), 'large.csv.gpg')
+    local_path = str(tmp_path / 'large.csv.gpg')
+    with LocalSFTPServerRunner(str(root), latency=0.01) as server:
+        conn = client.connection(server.config(download_concurrency=1))
+        try:
+            with pytest.raises(ValueError, match='bad packet'):
+                with conn.following_download(f, local_path) as reader:
+                    reader.read(1)
+                    raise ValueError('bad packet')
+        finally:
+            conn.close()
+    assert os.path.getsize(local_path) < FILE_SIZE
@@ -0,0 +1,73 @@
+import csv
+import io
+from unittest.mock import Mock
+import pytest
+from tap_sftp import streaming
+from tap_sftp.streaming import ReadAheadReader, TextStream
+
+csv_content = 'id,name\n1,"multi\nline"\n2,b\n3,c\nTotal rows: 3\nGenerated 2024-01-01\n'
+
+
+def build_text_stream(content, skip_footer_row=0, block_size=4, on_close=None):
+    reader = ReadAheadReader(io.BytesIO(content.encode('utf-8')), block_size, 2)
+    return TextStream(reader, 'utf-8', '/sftp_path/test.csv', skip_footer_row, on_close)
+
+
+def test_read_ahead_reader_returns_whole_file_in_small_blocks():
+    data = bytes(range(256)) * 10
+    with ReadAheadReader(io.BytesIO(data), 7, 2) as reader:
+        assert reader.peek(20) == data[:20]
+        assert reader.read() == data
+
+
+def test_read_ahead_reader_raises_remote_error():
+    remote_file = Mock()
+    remote_file.read.side_effect = EOFError()
+    reader = ReadAheadReader(remote_file, 4, 2)
+    with pytest.raises(EOFError):
+        reader.read()
+    reader.close()
+    remote_file.close.assert_called_once_with()
+
+
+def test_text_stream_without_footer_is_unchanged():
+    with build_text_stream(csv_content) as text_stream:
+        assert text_stream.read() == csv_content
+
+
+def test_text_stream_holds_back_footer_rows():
+    """Testing scenario -
+            Testing TextStream with skip_footer_row set and SUT should return every line except the footer while
+            keeping quoted newlines intact for the csv reader."""
+    with build_text_stream(csv_content, skip_footer_row=2) as text_stream:
+        rows = list(csv.reader(text_stream))
+    assert rows == [['id', 'name'], ['1', 'multi\nline'], ['2', 'b'], ['3', 'c']]
+
+
+def test_text_stream_partial_reads():
+    with build_text_stream(csv_content, skip_footer_row=2) as text_stream:
+        assert text_stream.read(5) == 'id,na'
+        assert text_stream.readline() == 'me\n'
+        assert text_stream.read() == '1,"multi\nline"\n2,b\n3,c\n'
+        assert text_stream.read() == ''
+
+
+def test_text_stream_close_releases_connection():
+    on_close = Mock()
+    text_stream = build_text_stream(csv_content, on_close=on_close)
+    text_stream.close()
+    text_stream.close()
+    on_close.assert_called_once_with()
+
+
+@pytest.mark.parametrize("file_path, file_type, decryption_configs, expected", [
+    ("/sftp_path/test.csv", "csv", None, True),
+    ("/sftp_path/test.TXT", "text", None, True),
+    ("/sftp_path/test.dat", "fwf", None, True),
+    ("/sftp_path/test.csv.zip", "csv", None, False),
+    ("/sftp_path/test.csv.gz", "csv", None, False),
+    ("/sftp_path/test.csv", "csv", {"key_name": "key"}, False),
+    ("/sftp_path/test.xlsx", "excel", None, False),
+])
+def test_is_streamable(file_path, file_type, decryption_configs, expected):
+    assert streaming.is_streamable(file_path, file_type, decryption_configs) == expected
@@ -1,6 +1,10 @@
+from tap_sftp import bookmarks
 from tap_sftp import sync
 from datetime import datetime
-from unittest.mock import patch, mock_open, Mock
+import threading
+import time
+from unittest.mock import patch, mock_open, Mock, MagicMock
+from tap_sftp import client
 from tap_sftp import defaults
 from singer.catalog import Catalog
 from singer import metadata
@@ -84,10 +88,11 @@ streams_excel = [
 ]
 
 
+@patch('tap_sftp.helper.update_decryption_key')
 @patch('tap_sftp.sync.sync_file')
 @patch('tap_sftp.client.SFTPConnection')
 @patch('tap_sftp.client.connection')
-def test_sync_stream(mock_connection, mock_sftp_client, mock_sync_file):
+def test_sync_stream(mock_connection, mock_sftp_client, mock_sync_file, mock_update_decryption_key):
     table_specs = [{
         "table_name": "test1",
         "file_type": "csv",
@@ -127,12 +132,13 @@ def test_sync_stream(mock_connection, mock_sftp_client, mock_sync_file):
     catalog = Catalog.from_dict({"streams": streams_csv + streams_excel})
     collect_sync_stats = False
     mock_connection.return_value = mock_sftp_client
-    mock_sftp_client.get_files.side_effect = lambda pre, pat, ms, ss: [files[0]] if pat == table_specs[0][
+    mock_sftp_client.get_files.side_effect = lambda pre, pat, ms, ss, bm: [files[0]] if pat == table_specs[0][
         "search_pattern"] else [files[1]]
     sync.stream_is_selected = Mock(return_value=True)
     sync.sync_stream(config, catalog, state, collect_sync_stats)
     assert mock_sync_file.call_count == 2
     mock_sync_file.assert_called()
+    mock_update_decryption_key.assert_called_with(decryption_configs)
 
 
 @patch('tap_sftp.sync.sync_file')
@@ -371,8 +377,9 @@ def test_sync_file_for_csv(mock_sync, mock_update_decryption_key, mock_connectio
     catalog = Catalog.from_dict({"streams": streams_csv})
     mock_connection.return_value = mock_sftp_client
     mock_sftp_client.get_file_handle.return_value.__enter__.return_value = mock_open
-    sync.sync_file(config, file, catalog.streams, table_spec,
-                   state, date_modified_since_oldest, collect_sync_stats, True)
+    with client.SFTPConnectionPool(config) as pool:
+        sync.sync_file(config, file, catalog.streams, table_spec,
+                       state, date_modified_since_oldest, collect_sync_stats, True, pool)
     mock_update_decryption_key.assert_called_with(decryption_configs)
     mock_sync.assert_called_with(mock_open, [stream.to_dict() for stream in catalog.streams], state,
                                  date_modified_since_oldest, columns_to_update=None)
@@ -408,8 +415,9 @@ def test_sync_file_for_excel(mock_sync, mock_update_decryption_key, mock_connect
     catalog = Catalog.from_dict({"streams": streams_excel})
     mock_connection.return_value = mock_sftp_client
     mock_sftp_client.get_file_handle.return_value.__enter__.return_value = mock_open
-    sync.sync_file(config, file, catalog.streams, table_spec,
-                   state, date_modified_since_oldest, collect_sync_stats, True)
+    with client.SFTPConnectionPool(config) as pool:
+        sync.sync_file(config, file, catalog.streams, table_spec,
+                       state, date_modified_since_oldest, collect_sync_stats, True, pool)
     mock_update_decryption_key.assert_not_called()
     mock_sync.assert_called_with(mock_open, [stream.to_dict() for stream in catalog.streams], state,
                                  date_modified_since_oldest)
@@ -421,3 +429,263 @@ def test_stream_is_selected():
     mdata = metadata.to_map(stream.metadata)
     result = sync.stream_is_selected(mdata)
     assert result is True
+
+
+def plan_files(files, table_spec):
+    target = sync.SyncTarget(table_spec.get("search_prefix"), table_spec, [], table_spec.get("table_name"))
+    return [sync.PlannedFile(file, [target]) for file in files]
+
+
+def build_prefetch_config(prefetch_files, prefetch_max_bytes=defaults.PREFETCH_MAX_BYTES):
+    return {
+        "host": "host",
+        "port": 22,
+        "username": "user",
+        "prefetch_files": prefetch_files,
+        "prefetch_max_bytes": prefetch_max_bytes
+    }
+
+
+@patch('tap_sftp.client.connection')
+def test_prefetch_file_handles_keeps_file_order(mock_connection):
+    """Testing scenario -
+            Testing prefetch_file_handles when the first file downloads slower than the ones after it and SUT should
+            still hand back the staged handles in file order."""
+    table_spec = {"table_name": "test1", "file_type": "csv"}
+    files = [{"filepath": f"/test_tmp/bin/test{i}.csv", "file_size": 10} for i in range(5)]
+
+    def get_file_handle(file, file_type, encoding, decryption_configs):
+        if file["filepath"].endswith("test0.csv"):
+            time.sleep(0.1)
+        return Mock(name=file["filepath"])
+
+    mock_connection.return_value.get_file_handle.side_effect = get_file_handle
+    with client.SFTPConnectionPool(build_prefetch_config(2)) as pool:
+        handles = list(sync.prefetch_file_handles(build_prefetch_config(2), plan_files(files, table_spec), pool))
+    assert [planned_file.file for planned_file, _ in handles] == files
+    assert [handle._mock_name for _, handle in handles] == [file["filepath"] for file in files]
+
+
+@patch('tap_sftp.client.connection')
+def test_prefetch_file_handles_bounds_staged_bytes(mock_connection):
+    """Testing scenario -
+            Testing prefetch_file_handles with a byte budget smaller than two files and SUT should never stage more
+            than the file being parsed plus what fits within the budget."""
+    table_spec = {"table_name": "test1", "file_type": "csv"}
+    files = [{"filepath": f"/test_tmp/bin/test{i}.csv", "file_size": 100} for i in range(4)]
+    staged = []
+    lock = threading.Lock()
+    max_staged = []
+
+    def get_file_handle(file, file_type, encoding, decryption_configs):
+        with lock:
+            staged.append(file["filepath"])
+            max_staged.append(len(staged))
+        handle = MagicMock()
+        handle.__exit__.side_effect = lambda *args: staged.remove(file["filepath"])
+        return handle
+
+    mock_connection.return_value.get_file_handle.side_effect = get_file_handle
+    config = build_prefetch_config(3, prefetch_max_bytes=150)
+    with client.SFTPConnectionPool(config) as pool:
+        for _, handle in sync.prefetch_file_handles(config, plan_files(files, table_spec), pool):
+            with handle:
+                time.sleep(0.01)
+    assert max(max_staged) == 1
+    assert staged == []
+
+
+@patch('tap_sftp.client.connection')
+def test_prefetch_file_handles_disabled(mock_connection):
+    """Testing scenario -
+            Testing prefetch_file_handles with prefetch_files set to 0 and SUT should leave downloading to sync_file."""
+    planned_files = plan_files([{"filepath": "/test_tmp/bin/test1.csv", "file_size": 10}], {"file_type": "csv"})
+    with client.SFTPConnectionPool(build_prefetch_config(0)) as pool:
+        handles = list(sync.prefetch_file_handles(build_prefetch_config(0), planned_files, pool))
+    assert handles == [(planned_files[0], None)]
+    mock_connection.return_value.get_file_handle.assert_not_called()
+
+
+@patch('tap_sftp.sync.CSVClient')
+@patch('tap_sftp.client.connection')
+def test_sync_file_streams_plain_csv(mock_connection, mock_csv_client):
+    """Testing scenario -
+            Testing sync_file with stream_sync enabled for a plain csv file and SUT should
+             - read the file through open_stream instead of staging it with get_file_handle
+             - leave footer rows to the stream rather than the csv client
+             - return the connection to the pool once the stream is closed."""
+    table_spec = {
+        "table_name": "test1",
+        "file_type": "csv",
+        "search_prefix": "/test_tmp/bin",
+        "search_pattern": "test1.csv",
+        "skip_footer_row": 2
+    }
+    config = {"host": "host", "port": 22, "username": "user", "stream_sync": True}
+    file = {"filepath": "/test_tmp/bin/test1.csv", "last_modified": date_modified_since_oldest, "file_size": 12404}
+    catalog = Catalog.from_dict({"streams": streams_csv})
+    mock_sftp_client = mock_connection.return_value
+    with client.SFTPConnectionPool(config) as pool:
+        sync.sync_file(config, file, catalog.streams, table_spec, {}, date_modified_since_oldest, False, True, pool)
+        mock_sftp_client.get_file_handle.assert_not_called()
+        args, kwargs = mock_sftp_client.open_stream.call_args
+        assert args == (file, None, 2)
+        kwargs['on_close']()
+        assert pool.stats() == {'opened': 1, 'reused': 0}
+        with pool.checkout() as reused_client:
+            assert reused_client is mock_sftp_client
+    assert mock_csv_client.call_args.kwargs['skip_footer_row'] == 0
+    mock_csv_client.return_value.sync.assert_called_once()
+
+
+@patch('tap_sftp.bookmarks.singer.write_state')
+@patch('tap_sftp.sync.sync_file')
+@patch('tap_sftp.client.SFTPConnection')
+@patch('tap_sftp.client.connection')
+def test_sync_stream_bookmarks_each_synced_file(mock_connection, mock_sftp_client, mock_sync_file,
+                                                mock_write_state):
+    """Testing scenario -
+            Testing sync_stream function over two runs and SUT should
+             - sync the files oldest first and write state after each one
+             - keep the latest last_modified and the fingerprint of the file at that time as the table's bookmark
+             - sync nothing on the second run when no file changed."""
+    table_specs = [{
+        "table_name": "test1",
+        "file_type": "csv",
+        "search_prefix": "/test_tmp/bin",
+        "search_pattern": "test1.csv",
+        "key_properties": []
+    }]
+    config = {
+        "host": "host",
+        "port": 22,
+        "username": "user",
+        "password": "password",
+        "start_date": "1800-01-01",
+        "tables": table_specs,
+        "prefetch_files": 0
+    }
+    files = [{"filepath": "/test_tmp/bin/b/test1.csv", "last_modified": date_modified_since_recent, "file_size": 20},
+             {"filepath": "/test_tmp/bin/a/test1.csv", "last_modified": date_modified_since_old, "file_size": 10}]
+    catalog = Catalog.from_dict({"streams": streams_csv})
+    mock_connection.return_value = mock_sftp_client
+    mock_sftp_client.get_files.side_effect = lambda pre, pat, ms, ss, bm: [f for f in files
+                                                                          if bookmarks.is_new(bm, f)]
+    sync.stream_is_selected = Mock(return_value=True)
+
+    state = {}
+    sync.sync_stream(config, catalog, state)
+    assert [c.args[1]["filepath"] for c in mock_sync_file.call_args_list] == \
+        ["/test_tmp/bin/a/test1.csv", "/test_tmp/bin/b/test1.csv"]
+    assert mock_write_state.call_count == 2
+    assert state == {"bookmarks": {"test1": {
+        "last_modified": "2022-01-01T00:00:00.000000Z",
+        "fingerprints": [["/test_tmp/bin/b/test1.csv", 20, 1640995200.0]]}}}
+
+    mock_sync_file.reset_mock()
+    sync.sync_stream(config, catalog, state)
+    mock_sync_file.assert_not_called()
+
+
+@patch('tap_sftp.bookmarks.singer.write_state')
+@patch('tap_sftp.sync.sync_file')
+@patch('tap_sftp.client.SFTPConnection')
+@patch('tap_sftp.client.connection')
+def test_sync_stream_plans_each_file_once(mock_connection, mock_sftp_client, mock_sync_file, mock_write_state):
+    """Testing scenario -
+            Testing sync_stream function with a workbook's worksheets listed apart in the catalog, after a stream
+            without a table configuration, and SUT should
+             - list the workbook's table once and sync the workbook once for both worksheets
+             - still sync the tables after the stream it skipped."""
+    table_specs = [{
+        "table_name": "test1",
+        "file_type": "csv",
+        "search_prefix": "/test_tmp/bin",
+        "search_pattern": "test1.csv",
+        "key_properties": []
+    },
+        {
+            "file_type": "excel",
+            "search_prefix": "/test_tmp/bin",
+            "search_pattern": "test2.xlsx",
+            "key_properties": []
+    }]
+    config = {
+        "host": "host",
+        "port": 22,
+        "username": "user",
+        "password": "password",
+        "start_date": "1800-01-01",
+        "tables": table_specs,
+        "prefetch_files": 0
+    }
+    unknown_stream = {**streams_csv[0], "tap_stream_id": "unknown", "metadata": [{
+        "breadcrumb": [], "metadata": {**streams_csv[0]["metadata"][0]["metadata"], "file_source": "/other/x.csv"}}]}
+    files = {"test1.csv": {"filepath": "/test_tmp/bin/test1.csv", "last_modified": date_modified_since_recent,
+                           "file_size": 10},
+             "test2.xlsx": {"filepath": "/test_tmp/bin/test2.xlsx", "last_modified": date_modified_since_old,
+                            "file_size": 20}}
+    catalog = Catalog.from_dict({"streams": [unknown_stream, streams_excel[0]] + streams_csv + [streams_excel[1]]})
+    mock_connection.return_value = mock_sftp_client
+    mock_sftp_client.get_files.side_effect = lambda pre, pat, ms, ss, bm: [files[pat]]
+    sync.stream_is_selected = Mock(return_value=True)
+
+    sync.sync_stream(config, catalog, {})
+    assert [c.args[1] for c in mock_sftp_client.get_files.call_args_list] == ["test2.xlsx", "test1.csv"]
+    assert [(c.args[1]["filepath"], [s.tap_stream_id for s in c.args[2]]) for c in mock_sync_file.call_args_list] == \
+        [("/test_tmp/bin/test2.xlsx", ["Sheet1", "Sheet2"]), ("/test_tmp/bin/test1.csv", ["test1"])]
+
+
+@patch('tap_sftp.bookmarks.singer.write_state')
+@patch('tap_sftp.sync.CSVClient')
+@patch('tap_sftp.client.connection')
+def test_sync_stream_fetches_a_file_once_for_several_tables(mock_connection, mock_csv_client, mock_write_state):
+    """Testing scenario -
+            Testing sync_stream function with two tables matching the same file and SUT should
+             - fetch the file once and rewind it for the second table
+             - bookmark the file for both tables
+             - print the plan with the file going to both tables."""
+    table_specs = [{
+        "table_name": "orders",
+        "file_type": "csv",
+        "search_prefix": "/test_tmp/bin",
+        "search_pattern": "test1.csv",
+        "key_properties": []
+    },
+        {
+            "table_name": "all_csv",
+            "file_type": "csv",
+            "search_prefix": "/test_tmp",
+            "search_pattern": "test.\\.csv",
+            "key_properties": []
+    }]
+    config = {
+        "host": "host",
+        "port": 22,
+        "username": "user",
+        "password": "password",
+        "start_date": "1800-01-01",
+        "tables": table_specs,
+        "print_sync_plan": True
+    }
+    other_stream = {**streams_csv[0], "tap_stream_id": "all_csv", "metadata": [{
+        "breadcrumb": [], "metadata": {**streams_csv[0]["metadata"][0]["metadata"],
+                                       "file_source": "/test_tmp/test3.csv"}}]}
+    file = {"filepath": "/test_tmp/bin/test1.csv", "last_modified": date_modified_since_recent, "file_size": 10}
+    catalog = Catalog.from_dict({"streams": streams_csv + [other_stream]})
+    mock_sftp_client = mock_connection.return_value
+    mock_sftp_client.get_files.return_value = [file]
+    handle = mock_sftp_client.get_file_handle.return_value
+    handle.__enter__.return_value = handle
+    sync.stream_is_selected = Mock(return_value=True)
+
+    state = {}
+    with patch('tap_sftp.sync.LOGGER.info') as mock_info:
+        sync.sync_stream(config, catalog, state)
+    mock_sftp_client.get_file_handle.assert_called_once()
+    assert handle.seek.call_count == 2
+    assert [c.args[0] for c in mock_csv_client.return_value.sync.call_args_list] == [handle, handle]
+    assert set(state["bookmarks"]) == {"orders", "all_csv"}
+    plan = next(str(c.args[1]) for c in mock_info.call_args_list if c.args[0] == '%s')
+    assert 'Sync plan: 1 files for 2 tables' in plan
+    assert '1. /test_tmp/bin/test1.csv (10 bytes' in plan and '-> "orders", "all_csv"' in plan
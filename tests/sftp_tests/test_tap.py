@@ -1,4 +1,5 @@
-from tap_sftp import tap
+import json
+from tap_sftp import profiling, tap
 from unittest.mock import patch
 from singer.catalog import Catalog
 from tests.configuration.fixtures import sftp_client, file_handle, get_full_file_path
@@ -19,3 +20,25 @@ def test_do_sync(mock_sync_stream):
     collect_sync_stats = False
     tap.do_sync(config, catalog, state)
     mock_sync_stream.assert_called_with(config, catalog, state, collect_sync_stats)
+
+
+@patch('tap_sftp.sync.sync_stream')
+def test_do_sync_writes_profile_and_summary(mock_sync_stream, tmp_path):
+    """Testing scenario -
+            Testing do_sync with show_stats and profile_path set and SUT should write the run profile and add the
+            bytes, MB/s and per-phase seconds of each file to the Extraction Summary."""
+    def sync_stream(*args):
+        profiling.PROFILE.add('download', 2.0, '/sftp_path/a.csv', 4 * 1024 * 1024)
+        profiling.PROFILE.add('parse', 0.5, '/sftp_path/a.csv')
+
+    mock_sync_stream.side_effect = sync_stream
+    config = {'show_stats': True, 'profile_path': str(tmp_path / 'profile.json')}
+    stats = {'table': {'files': {'/sftp_path/a.csv': {'row_count': 10, 'last_modified': '2024-01-01'}}}}
+    with patch.dict(tap.FILE_SYNC_STATS, stats, clear=True), patch('tap_sftp.tap.AsciiTable') as mock_table:
+        tap.do_sync(config, Catalog.from_dict({"streams": []}), {})
+
+    data = mock_table.call_args.args[0]
+    assert data[0][4:] == ['bytes', 'MB/s', 'download s', 'decrypt s', 'encoding s', 'parse s']
+    assert data[1][4:] == [4 * 1024 * 1024, '2.0', '2.00', '', '', '0.50']
+    with open(tmp_path / 'profile.json', 'r', encoding='utf-8') as profile_file:
+        assert json.load(profile_file)['files']['/sftp_path/a.csv']['bytes'] == 4 * 1024 * 1024
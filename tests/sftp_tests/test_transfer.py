@@ -0,0 +1,280 @@
+import io
+import os
+import time
+import threading
+from contextlib import contextmanager
+from unittest.mock import patch, Mock
+import pytest
+from tap_sftp.client import connection
+from tap_sftp.transfer import FileChangedError, FollowingFileReader, PipelinedReader, RemoteRangeFile, SegmentedDownloader, \
+    TransferProgress, TransferStalledError
+from tests.configuration.sftp_server import LocalSFTPServerRunner
+
+
+class FakeRemoteFile():
+    def __init__(self, data, delay=0):
+        self.data = data
+        self.delay = delay
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def readv(self, chunks, max_concurrent_prefetch_requests=None):
+        for offset, length in chunks:
+            time.sleep(self.delay)
+            yield self.data[offset:offset + length]
+
+
+class FakeSessions():
+    """ Stands in for SFTPSessionMultiplexer, delaying every read of the segments listed in slow_offsets once. """
+
+    def __init__(self, data, slow_offsets=(), delay=0.2):
+        self.data = data
+        self.slow_offsets = set(slow_offsets)
+        self.delay = delay
+        self.opened = []
+        self.lock = threading.Lock()
+        self.position = 0
+
+    @contextmanager
+    def checkout(self):
+        yield self
+
+    def open(self, path, mode):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def seek(self, offset):
+        self.position = offset
+
+    def read(self, size):
+        return self.data[self.position:self.position + size]
+
+    def readv(self, chunks, max_concurrent_prefetch_requests=None):
+        offset = chunks[0][0]
+        with self.lock:
+            self.opened.append(offset)
+            slow = offset in self.slow_offsets
+            self.slow_offsets.discard(offset)
+        return FakeRemoteFile(self.data, self.delay if slow else 0).readv(chunks)
+
+
+def test_split_covers_file_in_segments():
+    downloader = SegmentedDownloader(None, 4, 100)
+    assert downloader.split(250) == [(0, 100), (100, 100), (200, 50)]
+
+
+def test_segmented_download_is_byte_identical(tmp_path):
+    """Testing scenario -
+            Testing SegmentedDownloader with several concurrent segments and SUT should write every range at its
+            offset into the preallocated file so it matches the remote file byte for byte."""
+    data = os.urandom(1000)
+    local_path = tmp_path / 'download.bin'
+    downloader = SegmentedDownloader(FakeSessions(data), 3, 128, chunk_size=50)
+    downloader.download('/remote/file.bin', str(local_path), len(data))
+    assert local_path.read_bytes() == data
+    assert downloader.hedged_segments == 0
+
+
+@patch('tap_sftp.defaults.DOWNLOAD_POLL_INTERVAL', 0.01)
+def test_segmented_download_hedges_slow_segment(tmp_path):
+    """Testing scenario -
+            Testing SegmentedDownloader when one segment is much slower than the others and SUT should re-request it
+            on another session and still produce an identical file."""
+    data = os.urandom(800)
+    sessions = FakeSessions(data, slow_offsets=[600])
+    local_path = tmp_path / 'download.bin'
+    downloader = SegmentedDownloader(sessions, 2, 200, chunk_size=10, hedge_after_factor=2)
+    downloader.download('/remote/file.bin', str(local_path), len(data))
+    assert local_path.read_bytes() == data
+    assert downloader.hedged_segments == 1
+    assert sessions.opened.count(600) == 2
+
+
+def test_segmented_download_raises_on_short_read(tmp_path):
+    """Testing scenario -
+            Testing SegmentedDownloader when the remote file shrank since it was listed and SUT should raise
+            an exception rather than leave a partly filled file."""
+    data = os.urandom(300)
+    downloader = SegmentedDownloader(FakeSessions(data), 2, 200, chunk_size=50)
+    with pytest.raises(IOError, match='size mismatch'):
+        downloader.download('/remote/file.bin', str(tmp_path / 'download.bin'), 400)
+
+
+def test_segmented_download_raises_when_file_grew(tmp_path):
+    """Testing scenario -
+            Testing SegmentedDownloader when the remote file is longer than the size it was split by and SUT should
+            raise FileChangedError rather than silently leave a copy truncated to that size."""
+    data = os.urandom(440)
+    downloader = SegmentedDownloader(FakeSessions(data), 2, 200, chunk_size=50)
+    with pytest.raises(FileChangedError):
+        downloader.download('/remote/file.bin', str(tmp_path / 'download.bin'), 400)
+
+
+def test_segmented_download_fails_fast_when_a_segment_fails(tmp_path):
+    """Testing scenario -
+            Testing SegmentedDownloader when one segment fails while the others are still slowly downloading and SUT
+            should stop the other segments and raise the error without waiting for them to finish."""
+    class FailingSessions(FakeSessions):
+        def readv(self, chunks, max_concurrent_prefetch_requests=None):
+            if chunks[0][0] == 0:
+                raise IOError('connection reset')
+            return super().readv(chunks)
+
+    data = os.urandom(800)
+    sessions = FailingSessions(data, slow_offsets=[200, 400, 600], delay=0.2)
+    downloader = SegmentedDownloader(sessions, 4, 200, chunk_size=10)
+    started = time.monotonic()
+    with pytest.raises(IOError, match='connection reset'):
+        downloader.download('/remote/file.bin', str(tmp_path / 'download.bin'), len(data))
+    assert time.monotonic() - started < 1
+
+
+def test_remote_range_file_reads_blocks():
+    data = bytes(range(256)) * 100
+    remote_file = Mock(wraps=FakeRemoteFile(data))
+    range_file = RemoteRangeFile(remote_file, len(data), block_size=1000)
+    range_file.seek(-22, io.SEEK_END)
+    assert range_file.read(22) == data[-22:]
+    range_file.seek(len(data) - 500)
+    assert range_file.read(100) == data[-500:-400]
+    # both reads near the end were served by one block
+    assert remote_file.readv.call_count == 1
+    range_file.seek(10)
+    assert range_file.read() == data[10:]
+    assert range_file.bytes_read < 2 * len(data)
+
+
+def test_pipelined_reader_returns_file_in_order():
+    """Testing scenario -
+            Testing PipelinedReader with blocks fetched concurrently and some of them slow and SUT should still return
+            the whole file in order while keeping at most max_blocks blocks ahead of the consumer."""
+    data = os.urandom(100 * 1024 + 123)
+    sessions = FakeSessions(data, slow_offsets=[8 * 1024], delay=0.1)
+    with PipelinedReader(sessions, '/remote/file.gpg', len(data), block_size=8 * 1024, concurrency=3,
+                         max_blocks=4) as reader:
+        assert len(reader.pending) == 4
+        assert reader.read() == data
+        assert reader.blocks == 13
+        assert reader.wait_seconds > 0
+    assert sorted(sessions.opened) == list(range(0, len(data), 8 * 1024))
+
+
+def test_pipelined_reader_raises_on_short_read():
+    data = os.urandom(10 * 1024)
+    reader = PipelinedReader(FakeSessions(data), '/remote/file.gpg', len(data) + 100, block_size=4096)
+    with pytest.raises(IOError):
+        reader.read()
+    reader.close()
+
+
+def test_following_file_reader_waits_for_download(tmp_path):
+    """Testing scenario -
+            Testing FollowingFileReader while a download writes the file in pieces and SUT should only return bytes
+            already downloaded and end once the download finishes."""
+    data = os.urandom(64 * 1024)
+    local_path = str(tmp_path / 'file.gpg')
+    open(local_path, 'wb').close()
+    reader = FollowingFileReader(local_path)
+
+    def download():
+        with open(local_path, 'wb') as local_file:
+            for offset in range(0, len(data), 4096):
+                local_file.write(data[offset:offset + 4096])
+                local_file.flush()
+                reader.progress(offset + 4096, len(data))
+                time.sleep(0.005)
+        reader.finish()
+
+    thread = threading.Thread(target=download)
+    thread.start()
+    with reader:
+        assert reader.read() == data
+    thread.join()
+    assert reader.wait_seconds > 0
+
+
+def test_following_file_reader_raises_download_error(tmp_path):
+    local_path = str(tmp_path / 'file.gpg')
+    open(local_path, 'wb').close()
+    with FollowingFileReader(local_path) as reader:
+        reader.finish(EOFError())
+        with pytest.raises(EOFError):
+            reader.read()
+
+
+def test_segmented_download_reports_progress(tmp_path):
+    data = os.urandom(10000)
+    progress = Mock()
+    downloader = SegmentedDownloader(FakeSessions(data), 3, 4000, chunk_size=1000, transfer_progress=progress)
+    downloader.download('/remote/file', str(tmp_path / 'file'), len(data))
+    assert progress.update.call_args_list[-1].args == (len(data),)
+
+
+def test_transfer_progress_logs_rate_and_eta():
+    """Testing scenario -
+            Testing TransferProgress over a transfer that keeps moving bytes and SUT should log the bytes so far, the
+            current and average rate and an ETA at every interval, and a summary once it is done."""
+    with patch('tap_sftp.transfer.LOGGER') as mock_logger:
+        with TransferProgress('/remote/file', 100 * 1024 * 1024, interval=0.05) as progress:
+            for _ in range(4):
+                progress.add(1024 * 1024)
+                time.sleep(0.06)
+
+    reports = [call.args for call in mock_logger.info.call_args_list if call.args[0].startswith('Transferring')]
+    assert reports
+    assert reports[-1][1:3] == ('/remote/file', 4 * 1024 * 1024)
+    assert reports[-1][6].endswith('s')
+    assert mock_logger.info.call_args.args[0].startswith('Transferred')
+    mock_logger.warning.assert_not_called()
+
+
+def test_transfer_progress_flags_stall_without_aborting():
+    abort = Mock()
+    with patch('tap_sftp.transfer.LOGGER') as mock_logger:
+        with TransferProgress('/remote/file', 1000, interval=10, stall_timeout=0.1, abort=abort) as progress:
+            time.sleep(0.3)
+            assert progress.stalled
+            progress.add(10)
+            time.sleep(0.1)
+            assert not progress.stalled
+    abort.assert_not_called()
+    assert mock_logger.warning.call_count == 1
+
+
+def test_transfer_progress_aborts_stalled_transfer():
+    """Testing scenario -
+            Testing TransferProgress with abort_on_stall over a transfer blocked on the network and SUT should call
+            abort to break the blocked read and raise TransferStalledError from the error the read failed with."""
+    unblocked = threading.Event()
+    with pytest.raises(TransferStalledError) as ex:
+        with TransferProgress('/remote/file', 1000, interval=10, stall_timeout=0.1, abort_on_stall=True,
+                              abort=unblocked.set):
+            assert unblocked.wait(5)
+            raise EOFError()
+    assert isinstance(ex.value.__cause__, EOFError)
+
+
+def test_download_aborts_stalled_transfer(tmp_path):
+    """Testing scenario -
+            Testing a download from a server that stops answering with abort_stalled_transfers set and SUT should
+            close the connection after the stall timeout and raise TransferStalledError instead of resuming."""
+    (tmp_path / 'file.bin').write_bytes(os.urandom(1024))
+    with LocalSFTPServerRunner(str(tmp_path), latency=5) as server:
+        conn = connection(server.config(stall_timeout=0.5, abort_stalled_transfers=True))
+        try:
+            conn.sftp
+            started = time.monotonic()
+            with pytest.raises(TransferStalledError):
+                conn.download({'filepath': '/file.bin', 'file_size': 1024}, str(tmp_path / 'local.bin'))
+            assert time.monotonic() - started < 4
+        finally:
+            conn.close()